@@ -18,7 +18,8 @@ except ImportError:
 info = "'rethinkdb export` exports data from a RethinkDB cluster into a directory"
 usage = "\
   rethinkdb export [-c HOST:PORT] [-a AUTH_KEY] [-d DIR] [-e (DB | DB.TABLE)]...\n\
-      [--format (csv | json)] [--fields FIELD,FIELD...] [--clients NUM]"
+      [--format (csv | json | jsonl)] [--fields FIELD,FIELD...] [--clients NUM]\n\
+      [--partitions NUM [--shards]]"
 
 def print_export_help():
     print info
@@ -30,13 +31,19 @@ def print_export_help():
     print "  -a [ --auth ] AUTH_KEY           authorization key for rethinkdb clients"
     print "  -d [ --directory ] DIR           directory to output to (defaults to"
     print "                                   rethinkdb_export_DATE_TIME)"
-    print "  --format (csv | json)            format to write (defaults to json)"
+    print "  --format (csv | json | jsonl)    format to write (defaults to json), jsonl writes one"
+    print "                                   JSON object per line"
     print "  --fields FIELD,FIELD...          limit the exported fields to those specified"
     print "                                   (required for CSV format)"
     print "  -e [ --export ] (DB | DB.TABLE)  limit dump to the given database or table (may"
     print "                                   be specified multiple times)"
     print "  --clients NUM                    number of tables to export simultaneously (defaults"
     print "                                   to 3)"
+    print "  --partitions NUM                 number of ranges of primary keys to split each table"
+    print "                                   into, which are read and written in parallel (defaults"
+    print "                                   to 1)"
+    print "  --shards                         keep the file written for each range, as"
+    print "                                   TABLE.N.FORMAT, rather than joining them into one file"
     print ""
     print "EXAMPLES:"
     print "rethinkdb export -c mnemosyne:39500"
@@ -53,16 +60,25 @@ def print_export_help():
     print ""
     print "rethinkdb export --fields id,value -e test.data"
     print "  Export a specific table from a local cluster in JSON format with only the fields 'id' and 'value'."
+    print ""
+    print "rethinkdb export --format jsonl -e test.events"
+    print "  Export a specific table from a local cluster with one JSON object per line."
+    print ""
+    print "rethinkdb export -e test.events --partitions 32"
+    print "  Export a specific table from a local cluster, reading and writing 32 ranges of it in"
+    print "  parallel."
 
 def parse_options():
     parser = OptionParser(add_help_option=False, usage=usage)
     parser.add_option("-c", "--connect", dest="host", metavar="HOST:PORT", default="localhost:28015", type="string")
     parser.add_option("-a", "--auth", dest="auth_key", metavar="AUTHKEY", default="", type="string")
-    parser.add_option("--format", dest="format", metavar="json | csv", default="json", type="string")
+    parser.add_option("--format", dest="format", metavar="json | jsonl | csv", default="json", type="string")
     parser.add_option("-d", "--directory", dest="directory", metavar="DIRECTORY", default=None, type="string")
     parser.add_option("-e", "--export", dest="tables", metavar="DB | DB.TABLE", default=[], action="append", type="string")
     parser.add_option("--fields", dest="fields", metavar="<FIELD>,<FIELD>...", default=None, type="string")
     parser.add_option("--clients", dest="clients", metavar="NUM", default=3, type="int")
+    parser.add_option("--partitions", dest="partitions", metavar="NUM", default=1, type="int")
+    parser.add_option("--shards", dest="shards", default=False, action="store_true")
     parser.add_option("-h", "--help", dest="help", default=False, action="store_true")
     parser.add_option("--debug", dest="debug", default=False, action="store_true")
     (options, args) = parser.parse_args()
@@ -86,8 +102,8 @@ def parse_options():
     (res["host"], res["port"]) = host_port
 
     # Verify valid --format option
-    if options.format not in ["csv", "json"]:
-        raise RuntimeError("Error: Unknown format '%s', valid options are 'csv' and 'json'" % options.format)
+    if options.format not in ["csv", "json", "jsonl"]:
+        raise RuntimeError("Error: Unknown format '%s', valid options are 'csv', 'json' and 'jsonl'" % options.format)
     res["format"] = options.format
 
     # Verify valid directory option
@@ -131,6 +147,13 @@ def parse_options():
        raise RuntimeError("Error: invalid number of clients (%d), must be greater than zero" % options.clients)
     res["clients"] = options.clients
 
+    if options.partitions < 1:
+       raise RuntimeError("Error: invalid number of partitions (%d), must be greater than zero" % options.partitions)
+    if options.shards and options.partitions == 1:
+       raise RuntimeError("Error: --shards is only valid with more than one partition")
+    res["partitions"] = options.partitions
+    res["shards"] = options.shards
+
     res["auth_key"] = options.auth_key
     res["debug"] = options.debug
     return res
@@ -186,19 +209,34 @@ def write_table_metadata(conn, db, table, base_path):
     table_info = r.db(db).table(table).info().run(conn)
     out.write(json.dumps(table_info) + "\n")
     out.close()
-
-def read_table_into_queue(conn, db, table, task_queue, progress_info, exit_event):
-    read_rows = 0
-    for row in r.db(db).table(table).run(conn, time_format="raw"):
-        if exit_event.is_set():
+    return table_info
+
+def table_filename(base_path, db, table, format, part=None):
+    if part is None:
+        return base_path + "/%s/%s.%s" % (db, table, format)
+    return base_path + "/%s/%s.%d.%s" % (db, table, part, format)
+
+# Keep several batches in flight so the server is producing the next ones
+# while the current one is handed to the writer, within a bounded buffer
+read_prefetch = 4
+read_buffer_bytes = 64 * 1024 * 1024
+
+# Reads the whole table, or the rows with primary keys in 'key_range', which may
+#  be unbounded at either end
+def read_table_into_queue(conn, db, table, key_range, task_queue, progress_info, exit_event):
+    query = r.db(db).table(table)
+    if key_range is not None:
+        query = query.between(key_range[0], key_range[1])
+    cursor = query.run(conn, time_format="raw", prefetch=read_prefetch, max_buffered_bytes=read_buffer_bytes)
+    while not exit_event.is_set():
+        rows = cursor.next_batch()
+        if rows is None:
             break
-        task_queue.put([row])
-
-        # Update the progress every 20 rows - to reduce locking overhead
-        read_rows += 1
-        if read_rows % 20 == 0:
-            progress_info[0].value += 20
-    progress_info[0].value += read_rows % 20
+        for row in rows:
+            task_queue.put([row])
+        # The ranges of a table are read in parallel, and share its progress
+        with progress_info[0].get_lock():
+            progress_info[0].value += len(rows)
 
 def json_writer(filename, fields, task_queue, error_queue):
     try:
@@ -225,6 +263,25 @@ def json_writer(filename, fields, task_queue, error_queue):
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
 
+# Writes each row on a line of its own, as it arrives
+def jsonl_writer(filename, fields, task_queue, error_queue):
+    try:
+        with open(filename, "w") as out:
+            while True:
+                item = task_queue.get()
+                if len(item) != 1:
+                    break
+                row = item[0]
+
+                if fields is not None:
+                    for item in list(row.iterkeys()):
+                        if item not in fields:
+                            del row[item]
+                out.write(json.dumps(row) + "\n")
+    except:
+        ex_type, ex_class, tb = sys.exc_info()
+        error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
+
 def csv_writer(filename, fields, task_queue, error_queue):
     try:
         with open(filename, "w") as out:
@@ -252,47 +309,147 @@ def csv_writer(filename, fields, task_queue, error_queue):
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
 
-def launch_writer(format, directory, db, table, fields, task_queue, error_queue):
+def launch_writer(format, filename, fields, task_queue, error_queue):
     if format == "json":
-        filename = directory + "/%s/%s.json" % (db, table)
         return multiprocessing.Process(target=json_writer,
                                        args=(filename, fields, task_queue, error_queue))
+    elif format == "jsonl":
+        return multiprocessing.Process(target=jsonl_writer,
+                                       args=(filename, fields, task_queue, error_queue))
     elif format == "csv":
-        filename = directory + "/%s/%s.csv" % (db, table)
         return multiprocessing.Process(target=csv_writer,
                                        args=(filename, fields, task_queue, error_queue))
     else:
         raise RuntimeError("unknown format type: %s" % format)
 
-def export_table(host, port, auth_key, db, table, directory, fields, format, error_queue, progress_info, stream_semaphore, exit_event):
-    writer = None
+def export_rows(conn, db, table, key_range, filename, fields, format, error_queue, progress_info, exit_event):
+    task_queue = multiprocessing.queues.SimpleQueue()
+    writer = launch_writer(format, filename, fields, task_queue, error_queue)
+    writer.start()
+
+    try:
+        read_table_into_queue(conn, db, table, key_range, task_queue, progress_info, exit_event)
+    finally:
+        if writer.is_alive():
+            task_queue.put(("exit", "event")) # Exit is triggered by sending a message with two objects
+            writer.join()
+        else:
+            error_queue.put((RuntimeError, RuntimeError("writer unexpectedly stopped"),
+                             traceback.extract_tb(sys.exc_info()[2])))
+
+# Split points are taken from a sample of this many primary keys per partition
+split_sample_factor = 16
+
+# Picks up to 'partitions' - 1 primary keys that split the table into ranges of
+#  about the same number of rows, from a sample of its keys sorted by the server
+def sample_split_keys(conn, db, table, primary_key, partitions):
+    sample = r.db(db).table(table).sample(partitions * split_sample_factor).pluck(primary_key).order_by(primary_key)
+    keys = [row[primary_key] for row in sample.run(conn, time_format="raw")]
+
+    splits = [ ]
+    for i in xrange(1, partitions):
+        if len(keys) > 0:
+            key = keys[i * len(keys) // partitions]
+            if len(splits) == 0 or splits[-1] != key:
+                splits.append(key)
+    return splits
+
+def export_range(host, port, auth_key, db, table, key_range, filename, fields, format, error_queue, progress_info, exit_event):
+    try:
+        conn = r.connect(host, port, auth_key=auth_key)
+        export_rows(conn, db, table, key_range, filename, fields, format, error_queue, progress_info, exit_event)
+    except (r.RqlError, r.RqlDriverError) as ex:
+        error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
+    except:
+        ex_type, ex_class, tb = sys.exc_info()
+        error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
+
+part_copy_size = 1024 * 1024
 
+# Joins the files written for the ranges of a table into the one file a single
+#  writer would have written: the rows of the JSON arrays are joined into one, and
+#  the CSV header is only kept from the first file
+def join_parts(format, part_filenames, filename):
+    with open(filename, "w") as out:
+        if format == "json":
+            out.write("[")
+        first = True
+        for part_filename in part_filenames:
+            with open(part_filename, "r") as part:
+                start = 0
+                end = os.path.getsize(part_filename)
+                if format == "json":
+                    # Leave out the '[' and '\n]\n' around the rows
+                    start += 1
+                    end -= 3
+                    if end <= start:
+                        continue
+                    if not first:
+                        out.write(",")
+                elif format == "csv" and not first:
+                    part.readline()
+                    start = part.tell()
+                first = False
+
+                part.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = part.read(min(remaining, part_copy_size))
+                    out.write(data)
+                    remaining -= len(data)
+        if format == "json":
+            out.write("\n]\n")
+
+    for part_filename in part_filenames:
+        os.remove(part_filename)
+
+# Each range of the table is read and written by a process and writer of its own
+def export_partitioned(conn, host, port, auth_key, db, table, primary_key, directory, fields, format,
+                       partitions, shards, error_queue, progress_info, exit_event):
+    bounds = [None] + sample_split_keys(conn, db, table, primary_key, partitions) + [None]
+    part_filenames = [table_filename(directory, db, table, format, i) for i in xrange(len(bounds) - 1)]
+
+    processes = [ ]
+    for i in xrange(len(bounds) - 1):
+        processes.append(multiprocessing.Process(target=export_range,
+                                                 args=(host, port, auth_key, db, table,
+                                                       (bounds[i], bounds[i + 1]),
+                                                       part_filenames[i],
+                                                       fields,
+                                                       format,
+                                                       error_queue,
+                                                       progress_info,
+                                                       exit_event)))
+        processes[-1].start()
+    for process in processes:
+        process.join()
+
+    if not shards and not exit_event.is_set() and error_queue.empty():
+        join_parts(format, part_filenames, table_filename(directory, db, table, format))
+
+def export_table(host, port, auth_key, db, table, directory, fields, format, partitions, shards,
+                 error_queue, progress_info, stream_semaphore, exit_event):
     try:
         conn = r.connect(host, port, auth_key=auth_key)
 
         table_size = r.db(db).table(table).count().run(conn)
         progress_info[1].value = table_size
         progress_info[0].value = 0
-        write_table_metadata(conn, db, table, directory)
+        table_info = write_table_metadata(conn, db, table, directory)
 
         with stream_semaphore:
-            task_queue = multiprocessing.queues.SimpleQueue()
-            writer = launch_writer(format, directory, db, table, fields, task_queue, error_queue)
-            writer.start()
-
-            read_table_into_queue(conn, db, table, task_queue, progress_info, exit_event)
+            if partitions == 1:
+                export_rows(conn, db, table, None, table_filename(directory, db, table, format),
+                            fields, format, error_queue, progress_info, exit_event)
+            else:
+                export_partitioned(conn, host, port, auth_key, db, table, table_info["primary_key"],
+                                   directory, fields, format, partitions, shards,
+                                   error_queue, progress_info, exit_event)
     except (r.RqlError, r.RqlDriverError) as ex:
         error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except:
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
-    finally:
-        if writer is not None and writer.is_alive():
-            task_queue.put(("exit", "event")) # Exit is triggered by sending a message with two objects
-            writer.join()
-        else:
-            error_queue.put((RuntimeError, RuntimeError("writer unexpectedly stopped"),
-                             traceback.extract_tb(sys.exc_info()[2])))
 
 def abort_export(signum, frame, exit_event, interrupt_event):
     interrupt_event.set()
@@ -349,6 +506,8 @@ def run_clients(options, db_table_set):
                                                            options["directory_partial"],
                                                            options["fields"],
                                                            options["format"],
+                                                           options["partitions"],
+                                                           options["shards"],
                                                            error_queue,
                                                            progress_info[-1],
                                                            stream_semaphore,
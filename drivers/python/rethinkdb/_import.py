@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 import signal
 
-import sys, os, datetime, time, copy, json, traceback, csv, cPickle, string
-import multiprocessing, multiprocessing.queues, subprocess, re, ctypes
+import sys, os, datetime, time, copy, json, traceback, csv, string
+import multiprocessing, multiprocessing.queues, subprocess, re, ctypes, mmap
 from optparse import OptionParser
 
 try:
     import rethinkdb as r
+    from rethinkdb.bulk import RowBatcher
 except ImportError:
     print "The RethinkDB python driver is required to use this command."
     print "Please install the driver via `pip install rethinkdb`."
@@ -15,10 +16,13 @@ except ImportError:
 info = "'rethinkdb import` loads data into a RethinkDB cluster"
 usage = "\
   rethinkdb import -d DIR [-c HOST:PORT] [-a AUTH_KEY] [--force]\n\
-      [-i (DB | DB.TABLE)] [--clients NUM]\n\
+      [-i (DB | DB.TABLE)] [--clients NUM] [--parsers NUM]\n\
+      [--checkpoint FILE] [--resume]\n\
   rethinkdb import -f FILE --table DB.TABLE [-c HOST:PORT] [-a AUTH_KEY]\n\
-      [--force] [--clients NUM] [--format (csv | json)] [--pkey PRIMARY_KEY]\n\
-      [--delimiter CHARACTER] [--custom-header FIELD,FIELD... [--no-header]]"
+      [--force] [--clients NUM] [--parsers NUM] [--format (csv | json | jsonl)]\n\
+      [--checkpoint FILE] [--resume]\n\
+      [--pkey PRIMARY_KEY] [--delimiter CHARACTER]\n\
+      [--custom-header FIELD,FIELD... [--no-header]] [--column-types TYPES]"
 
 def print_import_help():
     print info
@@ -30,11 +34,19 @@ def print_import_help():
     print "  -a [ --auth ] AUTH_KEY           authorization key for rethinkdb clients"
     print "  --clients NUM_CLIENTS            the number of client connections to use (defaults"
     print "                                   to 8)"
+    print "  --parsers NUM_PARSERS            the number of processes to use to parse each large"
+    print "                                   JSON or CSV file (defaults to the number of CPUs)"
     print "  --hard-durability                use hard durability writes (slower, but less memory"
     print "                                   consumption on the server)"
     print "  --force                          import data even if a table already exists, and"
-    print "                                   overwrite duplicate primary keys"
+    print "                                   overwrite duplicate primary keys (also starts over"
+    print "                                   rather than resuming an interrupted import)"
     print "  --fields                         limit which fields to use when importing one table"
+    print "  --checkpoint FILE                the file to record the progress of the import in, so"
+    print "                                   an interrupted import can be resumed (defaults to the"
+    print "                                   imported file or directory with '.checkpoint' appended)"
+    print "  --resume                         continue an interrupted import from its checkpoint,"
+    print "                                   skipping the data already imported (implies --force)"
     print ""
     print "Import directory:"
     print "  -d [ --directory ] DIR           the directory to import data from"
@@ -44,7 +56,8 @@ def print_import_help():
     print "Import file:"
     print "  -f [ --file ] FILE               the file to import data from"
     print "  --table DB.TABLE                 the table to import the data into"
-    print "  --format (csv | json)            the format of the file (defaults to json)"
+    print "  --format (csv | json | jsonl)    the format of the file (defaults to json), jsonl"
+    print "                                   files have one JSON object per line"
     print "  --pkey PRIMARY_KEY               the field to use as the primary key in the table"
     print ""
     print "Import CSV format:"
@@ -52,6 +65,11 @@ def print_import_help():
     print "  --no-header                      do not read in a header of field names"
     print "  --custom-header FIELD,FIELD...   header to use (overriding file header), must be"
     print "                                   specified if --no-header"
+    print "  --column-types FIELD:TYPE,...    the types to import fields as, where TYPE is one of"
+    print "                                   string, int, float, number, bool, json or auto (which"
+    print "                                   imports numbers and true/false as such, and anything"
+    print "                                   else as a string).  A TYPE on its own sets the type of"
+    print "                                   all other fields (defaults to string)"
     print ""
     print "EXAMPLES:"
     print ""
@@ -75,6 +93,18 @@ def print_import_help():
     print "  Import data into a local cluster using the named CSV file with no header and instead"
     print "  use the fields 'id', 'name', and 'number', the delimiter is a semicolon (rather than"
     print "  a comma)."
+    print ""
+    print "rethinkdb import -f events.jsonl --table test.events --parsers 16"
+    print "  Import data into a local cluster using the named file, which has one JSON object per"
+    print "  line, using 16 processes to parse it."
+    print ""
+    print "rethinkdb import -f trades.csv --table test.trades --column-types auto,symbol:string"
+    print "  Import data into a local cluster using the named CSV file, importing numbers and"
+    print "  booleans as such, except in the 'symbol' field which is always imported as a string."
+    print ""
+    print "rethinkdb import -f events.jsonl --table test.events --resume"
+    print "  Continue an import of the named file that was interrupted, from the checkpoint it"
+    print "  left in 'events.jsonl.checkpoint'."
 
 def parse_options():
     parser = OptionParser(add_help_option=False, usage=usage)
@@ -82,8 +112,11 @@ def parse_options():
     parser.add_option("-a", "--auth", dest="auth_key", metavar="AUTHKEY", default="", type="string")
     parser.add_option("--fields", dest="fields", metavar="FIELD,FIELD...", default=None, type="string")
     parser.add_option("--clients", dest="clients", metavar="NUM_CLIENTS", default=8, type="int")
+    parser.add_option("--parsers", dest="parsers", metavar="NUM_PARSERS", default=multiprocessing.cpu_count(), type="int")
     parser.add_option("--hard-durability", dest="hard", action="store_true", default=False)
     parser.add_option("--force", dest="force", action="store_true", default=False)
+    parser.add_option("--checkpoint", dest="checkpoint", metavar="FILE", default=None, type="string")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False)
     parser.add_option("--debug", dest="debug", action="store_true", default=False)
 
     # Directory import options
@@ -92,12 +125,13 @@ def parse_options():
 
     # File import options
     parser.add_option("-f", "--file", dest="import_file", metavar="FILE", default=None, type="string")
-    parser.add_option("--format", dest="import_format", metavar="json | csv", default=None, type="string")
+    parser.add_option("--format", dest="import_format", metavar="json | jsonl | csv", default=None, type="string")
     parser.add_option("--table", dest="import_table", metavar="DB.TABLE", default=None, type="string")
     parser.add_option("--pkey", dest="primary_key", metavar="KEY", default = None, type="string")
     parser.add_option("--delimiter", dest="delimiter", metavar="CHARACTER", default = None, type="string")
     parser.add_option("--no-header", dest="no_header", action="store_true", default = False)
     parser.add_option("--custom-header", dest="custom_header", metavar="FIELD,FIELD...", default = None, type="string")
+    parser.add_option("--column-types", dest="column_types", metavar="FIELD:TYPE,...", default = None, type="string")
     parser.add_option("-h", "--help", dest="help", default=False, action="store_true")
     (options, args) = parser.parse_args()
 
@@ -122,16 +156,22 @@ def parse_options():
     if options.clients < 1:
         raise RuntimeError("Error: --client option too low, must have at least one client connection")
 
+    if options.parsers < 1:
+        raise RuntimeError("Error: --parsers option too low, must have at least one parser process")
+
     res["auth_key"] = options.auth_key
     res["clients"] = options.clients
+    res["parsers"] = options.parsers
     res["durability"] = "hard" if options.hard else "soft"
-    res["force"] = options.force
+    res["force"] = options.force or options.resume
+    res["resume"] = options.resume
     res["debug"] = options.debug
 
     # Default behavior for csv files - may be changed by options
     res["delimiter"] = ","
     res["no_header"] = False
     res["custom_header"] = None
+    res["column_types"] = None
 
     if options.directory is not None:
         # Directory mode, verify directory import options
@@ -149,6 +189,8 @@ def parse_options():
             raise RuntimeError("Error: --no-header option is not valid when importing a directory")
         if options.custom_header is not None:
             raise RuntimeError("Error: --custom-header option is not valid when importing a directory")
+        if options.column_types is not None:
+            raise RuntimeError("Error: --column-types option is not valid when importing a directory")
 
         # Verify valid directory option
         dirname = options.directory
@@ -156,6 +198,7 @@ def parse_options():
 
         if not os.path.exists(res["directory"]):
             raise RuntimeError("Error: Directory to import does not exist: %d" % res["directory"])
+        res["checkpoint"] = os.path.abspath(options.checkpoint or res["directory"] + ".checkpoint")
 
         # Verify valid --import options
         res["dbs"] = []
@@ -191,16 +234,17 @@ def parse_options():
 
         if not os.path.exists(res["import_file"]):
             raise RuntimeError("Error: File to import does not exist: %s" % res["import_file"])
+        res["checkpoint"] = os.path.abspath(options.checkpoint or res["import_file"] + ".checkpoint")
 
         # Verify valid --format option
         if options.import_format is None:
             options.import_format = os.path.split(options.import_file)[1].split(".")[-1]
-            if options.import_format not in ["csv", "json"]:
+            if options.import_format not in ["csv", "json", "jsonl"]:
                 options.import_format = "json"
 
             res["import_format"] = options.import_format
-        elif options.import_format not in ["csv", "json"]:
-            raise RuntimeError("Error: Unknown format '%s', valid options are 'csv' and 'json'" % options.import_format)
+        elif options.import_format not in ["csv", "json", "jsonl"]:
+            raise RuntimeError("Error: Unknown format '%s', valid options are 'csv', 'json' and 'jsonl'" % options.import_format)
         else:
             res["import_format"] = options.import_format
 
@@ -239,6 +283,18 @@ def parse_options():
             if options.no_header == True and options.custom_header is None:
                 raise RuntimeError("Error: Cannot import a CSV file with --no-header and no --custom-header option")
             res["no_header"] = options.no_header
+
+            if options.column_types is not None:
+                res["column_types"] = { }
+                for item in options.column_types.split(","):
+                    name_type = item.rsplit(":", 1)
+                    if name_type[-1] not in csv_column_types:
+                        raise RuntimeError("Error: Unknown column type '%s', valid types are %s" %
+                                           (name_type[-1], ", ".join(sorted(csv_column_types))))
+                    if len(name_type) == 1:
+                        res["column_types"][None] = name_type[0]
+                    else:
+                        res["column_types"][name_type[0]] = name_type[1]
         else:
             if options.delimiter is not None:
                 raise RuntimeError("Error: --delimiter option is only valid for CSV file formats")
@@ -246,6 +302,8 @@ def parse_options():
                 raise RuntimeError("Error: --no-header option is only valid for CSV file formats")
             if options.custom_header is not None:
                 raise RuntimeError("Error: --custom-header option is only valid for CSV file formats")
+            if options.column_types is not None:
+                raise RuntimeError("Error: --column-types option is only valid for CSV file formats")
 
         res["primary_key"] = options.primary_key
     else:
@@ -254,42 +312,118 @@ def parse_options():
     return res
 
 # This is run for each client requested, and accepts tasks from the reader processes
-def client_process(host, port, auth_key, task_queue, error_queue, use_upsert, durability):
+def client_process(host, port, auth_key, task_queue, error_queue, ack_queue, use_upsert, durability):
     try:
         conn = r.connect(host, port, auth_key=auth_key)
         while True:
             task = task_queue.get()
-            if len(task) == 3:
-                # Unpickle objects (TODO: super inefficient, would be nice if we could pass down json)
-                objs = [cPickle.loads(obj) for obj in task[2]]
-                res = r.db(task[0]).table(task[1]).insert(objs, durability=durability, upsert=use_upsert).run(conn)
-                if res["errors"] > 0:
-                    raise RuntimeError("Error when importing into table '%s.%s': %s" %
-                                       (task[0], task[1], res["first_error"]))
-            else:
+            if task == "exit":
                 break
+
+            # Rows arrive as JSON text, so the batch is sent as one JSON array for the server to parse
+            rows = r.json("[" + ",".join(task[2]) + "]")
+            start_time = time.time()
+            res = r.db(task[0]).table(task[1]).insert(rows, durability=durability, upsert=use_upsert).run(conn)
+            batch_size.adjust(len(task[2]), time.time() - start_time)
+            if res["errors"] > 0:
+                raise RuntimeError("Error when importing into table '%s.%s': %s" %
+                                   (task[0], task[1], res["first_error"]))
+
+            # Let the checkpoint know the batch is in
+            ack_queue.put(("acked",) + task[3])
     except (r.RqlError, r.RqlDriverError) as ex:
         error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except:
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
 
-batch_length_limit = 200
+# Batches are limited to 'batch_size_limit' bytes, and their number of rows is
+#  set by the clients, aiming for each insert to take 'batch_latency_target'
+#  seconds.  A batch that takes longer than that ties up a client and its memory
+#  on the server, and much shorter ones spend their time on round trips.
 batch_size_limit = 500000
+batch_latency_target = 0.5
+min_batch_rows = 10
+max_batch_rows = 20000
+
+class BatchSize(object):
+    def __init__(self, rows=200):
+        self.rows = multiprocessing.Value(ctypes.c_long, rows)
+
+    # Batches cut short by the byte limit or the end of a file say little about
+    #  how long a full one would take, and don't count
+    def adjust(self, rows, latency):
+        with self.rows.get_lock():
+            current = self.rows.value
+            if rows * 2 < current:
+                return
+            ideal = rows * batch_latency_target / max(latency, 0.001)
+            self.rows.value = int(min(max(current * 0.75 + ideal * 0.25, min_batch_rows), max_batch_rows))
+
+# Shared by the clients and readers, as they are forked from this process
+batch_size = BatchSize()
+
+# Takes up the batch size the clients ask for after each batch
+class ImportBatcher(RowBatcher):
+    def __init__(self):
+        RowBatcher.__init__(self, batch_size.rows.value, batch_size_limit, encode_row)
+
+    def flush(self):
+        batch = RowBatcher.flush(self)
+        self.batch_rows = batch_size.rows.value
+        return batch
+
+# The queue of batches for the clients, which holds at most 'max_batches' of
+#  them, so readers wait for the clients to catch up rather than running ahead
+#  with the whole file in memory.  Batches put after 'exit_event' is set are
+#  dropped, as the import is stopping.
+class TaskQueue(object):
+    def __init__(self, max_batches, exit_event):
+        self.queue = multiprocessing.queues.SimpleQueue()
+        self.max_batches = max_batches
+        self.slots = multiprocessing.Semaphore(max_batches)
+        self.depth = multiprocessing.Value(ctypes.c_int, 0)
+        self.exit_event = exit_event
+
+    def put(self, task):
+        if task != "exit":
+            while not self.slots.acquire(True, 0.1):
+                if self.exit_event.is_set():
+                    return
+            with self.depth.get_lock():
+                self.depth.value += 1
+        self.queue.put(task)
+
+    def get(self):
+        task = self.queue.get()
+        if task != "exit":
+            with self.depth.get_lock():
+                self.depth.value -= 1
+            self.slots.release()
+        return task
+
+    def empty(self):
+        return self.queue.empty()
+
+queued_batches_per_client = 4
 
 class InterruptedError(Exception):
     def __str__(self):
         return "Interrupted"
 
-# This function is called for each object read from a file by the reader processes
-#  and will push tasks to the client processes on the task queue
-def object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, fields, exit_event):
-    global batch_size_limit
-    global batch_length_limit
+# Rows are passed from the readers to the clients as JSON text
+json_encoder = json.JSONEncoder()
 
-    if exit_event.is_set():
-        raise InterruptedError()
+def encode_row(row):
+    if isinstance(row, str):
+        return row
+    return json_encoder.encode(row)
 
+# This function is called for each object read from a file by the reader processes
+#  and will push tasks to the client processes on the task queue.  'text' is the
+#  object's JSON text as read from the file, if there is any.  The exit event is
+#  checked once per batch, as checking it takes a lock.
+def object_callback(obj, db, table, task_queue, batcher, fields, exit_event, text=None):
     if not isinstance(obj, dict):
         raise RuntimeError("Error: Invalid input, expected an object, but got %s" % type(obj))
 
@@ -298,16 +432,48 @@ def object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, fi
         for key in list(obj.iterkeys()):
             if key not in fields:
                 del obj[key]
-
-    # Pickle the object here because we want an accurate size, and it'll pickle anyway for IPC
-    object_buffers.append(cPickle.dumps(obj))
-    buffer_sizes.append(len(object_buffers[-1]))
-    if len(object_buffers) >= batch_length_limit or sum(buffer_sizes) > batch_size_limit:
-        task_queue.put((db, table, object_buffers))
-        del object_buffers[0:len(object_buffers)]
-        del buffer_sizes[0:len(buffer_sizes)]
+        text = None
+
+    # The text from the file is passed on as is unless fields were removed,
+    #  which saves encoding the object again
+    batch = batcher.add(obj if text is None else text)
+    if batch is not None:
+        if exit_event.is_set():
+            raise InterruptedError()
+        task_queue.put((db, table, batch))
     return obj
 
+# Files are read in units, which are the chunks of files that are split up, or
+#  the whole file otherwise.  Each batch is tagged with the file and unit it came
+#  from, so the checkpoint can tell when all of a unit's batches are in.
+class UnitQueue(object):
+    def __init__(self, task_queue, filename, unit):
+        self.task_queue = task_queue
+        self.key = (filename, unit)
+        self.batches = 0
+
+    def put(self, task):
+        self.batches += 1
+        self.task_queue.put(task + (self.key,))
+
+# The reader's side of the checkpoint of a file: the units finished by an earlier
+#  import ('done', mapping each to the offset its rows end at), and reporting how
+#  many batches each unit was read as
+class FileCheckpoint(object):
+    def __init__(self, filename, ack_queue, done):
+        self.filename = filename
+        self.ack_queue = ack_queue
+        self.done = done
+
+    def unit_queue(self, task_queue, unit):
+        return UnitQueue(task_queue, self.filename, unit)
+
+    def finish_unit(self, unit, batches, end):
+        self.ack_queue.put(("unit", self.filename, unit, batches, end))
+
+    def finish_file(self):
+        self.ack_queue.put(("file", self.filename))
+
 json_read_chunk_size = 32 * 1024
 json_max_buffer_size = 16 * 1024 * 1024
 
@@ -316,8 +482,8 @@ def read_json_single_object(json_data, file_in, callback):
     while True:
         try:
             (obj, offset) = decoder.raw_decode(json_data)
+            callback(obj, json_data[:offset])
             json_data = json_data[offset:]
-            callback(obj)
             break
         except ValueError:
             before_len = len(json_data)
@@ -337,8 +503,9 @@ def read_json_array(json_data, file_in, callback, progress_info):
             if json_data[offset] == "]": # End of JSON
                 break
 
-            (obj, offset) = decoder.raw_decode(json_data, idx=offset)
-            callback(obj)
+            (obj, end) = decoder.raw_decode(json_data, idx=offset)
+            callback(obj, json_data[offset:end])
+            offset = end
             progress_info[2].value += 1
 
             # Read past whitespace to the next record
@@ -365,22 +532,245 @@ def read_json_array(json_data, file_in, callback, progress_info):
     json_data += file_in.read()
     return json_data[offset + 1:]
 
-def json_reader(task_queue, filename, db, table, primary_key, fields, progress_info, exit_event):
-    object_buffers = []
-    buffer_sizes = []
+# Large JSON arrays and CSV files are split into chunks of about this many bytes,
+#  which are parsed in parallel by a pool of parser processes
+parse_chunk_size = 16 * 1024 * 1024
+
+json_escape_re = re.compile(r'\\.', re.DOTALL)
+json_string_special_re = re.compile(r'["\\]')
+json_structural_re = re.compile(r'[][{}",]')
+
+# Parser processes send their batches straight to the client processes, these
+#  are inherited from the reader when the pool is created
+parser_task_queue = None
+parser_exit_event = None
+
+def init_parser(task_queue, exit_event):
+    global parser_task_queue, parser_exit_event
+    parser_task_queue = task_queue
+    parser_exit_event = exit_event
+
+# Splits the bytes from 'start' to the end of the file into chunks, none of
+#  which start right after a backslash, so no escape sequence spans two chunks
+def json_chunk_bounds(file_in, start, file_size):
+    bounds = [start]
+    pos = start + parse_chunk_size
+    while pos < file_size:
+        file_in.seek(pos - 1)
+        while pos < file_size and file_in.read(1) == "\\":
+            pos += 1
+        if pos >= file_size:
+            break
+        bounds.append(pos)
+        pos += parse_chunk_size
+    bounds.append(file_size)
+    return zip(bounds[:-1], bounds[1:])
+
+def json_nesting_delta(pieces):
+    text = "".join(pieces)
+    return text.count("{") + text.count("[") - text.count("}") - text.count("]")
+
+# First pass over a chunk, done without knowing whether the chunk starts inside
+#  a string.  Returns whether the chunk has an odd number of quotes, and how much
+#  it changes the nesting depth if it starts outside or inside a string.
+def json_chunk_delta(filename, start, end):
+    with open(filename, "r") as file_in:
+        file_in.seek(start)
+        data = file_in.read(end - start)
+    pieces = json_escape_re.sub("", data).split('"')
+    return ((len(pieces) - 1) % 2 == 1, json_nesting_delta(pieces[0::2]), json_nesting_delta(pieces[1::2]))
+
+# Returns the offset of the first ',' between elements of the top-level array
+#  in data[offset:end], or None if there isn't one
+def find_json_separator(data, offset, end, in_string, depth):
+    while offset < end:
+        if in_string:
+            match = json_string_special_re.search(data, offset, end)
+            if match is None:
+                return None
+            if match.group() == "\\":
+                offset = match.end() + 1
+                continue
+            in_string = False
+        else:
+            match = json_structural_re.search(data, offset, end)
+            if match is None:
+                return None
+            char = match.group()
+            if char == '"':
+                in_string = True
+            elif char == ",":
+                if depth == 1:
+                    return match.start()
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return None
+        offset = match.end()
+    return None
+
+# Second pass over a chunk, run once the state at its start is known.  Parses
+#  each element of the array whose preceding ',' lies within the chunk (or the
+#  first element, for the first chunk), reading past the end of the chunk to
+#  finish the last one.  Returns the number of rows parsed, the offset just past
+#  the closing ']' if the array ended in this chunk, and the number of batches.
+def json_parse_chunk(filename, start, end, in_string, depth, first, db, table, fields, unit):
+    task_queue = UnitQueue(parser_task_queue, filename, unit)
+    batcher = ImportBatcher()
+    decoder = json.JSONDecoder()
+    rows = 0
+    array_end = None
+
+    with open(filename, "r") as file_in:
+        file_in.seek(start)
+        data = file_in.read(end - start)
+        base = start # File offset of data[0]
+
+        def skip_whitespace(data, base, offset):
+            while True:
+                offset = json.decoder.WHITESPACE.match(data, offset).end()
+                if offset < len(data):
+                    return (data, base, offset)
+                more = file_in.read(json_read_chunk_size)
+                if len(more) == 0:
+                    raise ValueError("Error: JSON format not recognized - unexpected end of file")
+                (data, base, offset) = (data[offset:] + more, base + offset, 0)
+
+        if first:
+            offset = 0
+            (data, base, offset) = skip_whitespace(data, base, offset)
+            if data[offset] == "]":
+                return (0, base + offset + 1, 0)
+        else:
+            offset = find_json_separator(data, 0, len(data), in_string, depth)
+            if offset is None:
+                return (0, None, 0)
+            (data, base, offset) = skip_whitespace(data, base, offset + 1)
+
+        while True:
+            try:
+                (obj, obj_end) = decoder.raw_decode(data, idx=offset)
+            except ValueError:
+                more = file_in.read(max(json_read_chunk_size, len(data) - offset))
+                if len(more) == 0 or len(data) - offset > json_max_buffer_size:
+                    raise
+                (data, base, offset) = (data[offset:] + more, base + offset, 0)
+                continue
+
+            object_callback(obj, db, table, task_queue, batcher, fields, parser_exit_event,
+                            data[offset:obj_end])
+            offset = obj_end
+            rows += 1
+
+            (data, base, offset) = skip_whitespace(data, base, offset)
+            if data[offset] == "]":
+                array_end = base + offset + 1
+                break
+            elif data[offset] != ",":
+                raise ValueError("Error: JSON format not recognized - expected ',' or ']' after object")
+            elif base + offset >= end:
+                break
+            (data, base, offset) = skip_whitespace(data, base, offset + 1)
+
+    batch = batcher.flush()
+    if len(batch) > 0:
+        task_queue.put((db, table, batch))
+    return (rows, array_end, task_queue.batches)
+
+# Parses the array starting at 'start' (just past the '[') across a pool of
+#  'parsers' processes.  Each chunk is first scanned for its quotes and nesting,
+#  which tells where the next chunk starts relative to strings and the array, and
+#  is then parsed.  Chunks finished by an earlier import are skipped, except for
+#  the last, which is parsed again to find the end of the array.  Returns the
+#  offset just past the end of the array.
+def read_json_array_parallel(filename, start, file_size, parsers, db, table, fields,
+                             task_queue, checkpoint, progress_info, exit_event):
+    with open(filename, "r") as file_in:
+        chunks = json_chunk_bounds(file_in, start, file_size)
+
+    pool = multiprocessing.Pool(parsers, initializer=init_parser, initargs=(task_queue, exit_event))
+    try:
+        # Keep a few chunks scanned and parsed ahead, so each chunk is read
+        #  the second time while it is still in the page cache
+        window = parsers * 2
+        deltas = [pool.apply_async(json_chunk_delta, (filename, chunk_start, chunk_end))
+                  for (chunk_start, chunk_end) in chunks[:window]]
+        parses = [ ]
+        array_end = None
+
+        def collect():
+            (result, unit, chunk_end) = parses.pop(0)
+            progress_info[0].value = chunk_end
+            if result is None:
+                return None
+            (rows, chunk_array_end, batches) = result.get()
+            checkpoint.finish_unit(unit, batches, chunk_end)
+            progress_info[2].value += rows
+            return chunk_array_end
+
+        in_string = False
+        depth = 1
+        for (i, (chunk_start, chunk_end)) in enumerate(chunks):
+            if exit_event.is_set():
+                raise InterruptedError()
+
+            if i in checkpoint.done and i < len(chunks) - 1:
+                parses.append((None, i, chunk_end))
+            else:
+                parses.append((pool.apply_async(json_parse_chunk, (filename, chunk_start, chunk_end,
+                                                                    in_string, depth, i == 0,
+                                                                    db, table, fields, i)),
+                               i, chunk_end))
+            if i + window < len(chunks):
+                deltas.append(pool.apply_async(json_chunk_delta, (filename,) + chunks[i + window]))
+
+            (odd_quotes, outside_delta, inside_delta) = deltas[i].get()
+            deltas[i] = None
+            depth += inside_delta if in_string else outside_delta
+            in_string = in_string != odd_quotes
+
+            while len(parses) > window or (len(parses) > 0 and (parses[0][0] is None or parses[0][0].ready())):
+                array_end = collect() or array_end
+
+        while len(parses) > 0:
+            array_end = collect() or array_end
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if array_end is None:
+        raise RuntimeError("Error: JSON format not recognized - array is never closed")
+    return array_end
+
+# Big arrays are read in chunks, anything else is read as a single unit
+def json_reader(task_queue, filename, db, table, primary_key, fields, parsers, checkpoint, progress_info, exit_event):
+    batcher = ImportBatcher()
+    unit_queue = checkpoint.unit_queue(task_queue, 0)
 
     with open(filename, "r") as file_in:
         # Scan to the first '[', then load objects one-by-one
         # Read in the data in chunks, since the json module would just read the whole thing at once
         json_data = file_in.read(json_read_chunk_size)
 
-        callback = lambda x: object_callback(x, db, table, task_queue, object_buffers,
-                                             buffer_sizes, fields, exit_event)
+        callback = lambda x, text: object_callback(x, db, table, unit_queue, batcher, fields, exit_event, text)
 
-        progress_info[1].value = os.path.getsize(filename)
+        file_size = os.path.getsize(filename)
+        progress_info[1].value = file_size
 
         offset = json.decoder.WHITESPACE.match(json_data, 0).end()
-        if json_data[offset] == "[":
+        if json_data[offset] == "[" and file_size > offset + 2 * parse_chunk_size:
+            # Big arrays are split up and parsed in parallel, leaving the rest of the file to check
+            array_end = read_json_array_parallel(filename, offset + 1, file_size, parsers, db, table, fields,
+                                                 task_queue, checkpoint, progress_info, exit_event)
+            file_in.seek(array_end)
+            json_data = file_in.read(json_read_chunk_size)
+            unit_queue = None
+        elif 0 in checkpoint.done:
+            return
+        elif json_data[offset] == "[":
             json_data = read_json_array(json_data[offset + 1:], file_in, callback, progress_info)
         elif json_data[offset] == "{":
             json_data = read_json_single_object(json_data[offset:], file_in, callback)
@@ -396,25 +786,367 @@ def json_reader(task_queue, filename, db, table, primary_key, fields, progress_i
 
     progress_info[0].value = progress_info[1].value
 
-    if len(object_buffers) > 0:
-        task_queue.put((db, table, object_buffers))
+    batch = batcher.flush()
+    if len(batch) > 0:
+        unit_queue.put((db, table, batch))
+    if unit_queue is not None:
+        checkpoint.finish_unit(0, unit_queue.batches, file_size)
 
-def csv_reader(task_queue, filename, db, table, primary_key, options, progress_info, exit_event):
-    object_buffers = []
-    buffer_sizes = []
+# Parses the lines from 'start' to 'end' of a JSONL file, which has one JSON object
+#  per line.  Each line is passed on to the clients as is.  Returns the number of rows.
+def read_jsonl_range(data, start, end, filename, db, table, fields, task_queue, exit_event):
+    batcher = ImportBatcher()
+    decode = json.JSONDecoder().decode
+    rows = 0
 
-    # Count the lines so we can report progress
-    # TODO: this requires us to make two passes on csv files
-    line_count = 0
+    chunk = data[start:end]
+    offset = 0
+    while offset < len(chunk):
+        line_end = chunk.find("\n", offset)
+        if line_end == -1:
+            line_end = len(chunk)
+        line = chunk[offset:line_end].strip()
+        if len(line) > 0:
+            try:
+                obj = decode(line)
+            except ValueError as ex:
+                raise RuntimeError("Error: File '%s' has invalid JSON at offset %d: %s" %
+                                   (filename, start + offset, ex))
+            object_callback(obj, db, table, task_queue, batcher, fields, exit_event, line)
+            rows += 1
+        offset = line_end + 1
+
+    batch = batcher.flush()
+    if len(batch) > 0:
+        task_queue.put((db, table, batch))
+    return rows
+
+# Returns the number of rows and batches
+def jsonl_parse_chunk(filename, start, end, db, table, fields, unit):
+    task_queue = UnitQueue(parser_task_queue, filename, unit)
     with open(filename, "r") as file_in:
-        for i, l in enumerate(file_in):
-            pass
-        line_count = i + 1
+        data = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            rows = read_jsonl_range(data, start, end, filename, db, table, fields, task_queue, parser_exit_event)
+        finally:
+            data.close()
+    return (rows, task_queue.batches)
+
+# The file is memory-mapped and split into chunks at newlines, which are parsed in
+#  order by this process or, for large files, across a pool of 'parsers' processes.
+#  Each chunk is a unit of the checkpoint.
+def jsonl_reader(task_queue, filename, db, table, primary_key, fields, parsers, checkpoint, progress_info, exit_event):
+    file_size = os.path.getsize(filename)
+    progress_info[1].value = file_size
+    if file_size == 0:
+        progress_info[0].value = 0
+        return
+
+    with open(filename, "r") as file_in:
+        data = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            bounds = [0]
+            while bounds[-1] < file_size:
+                line_end = data.find("\n", bounds[-1] + parse_chunk_size)
+                bounds.append(file_size if line_end == -1 else line_end + 1)
+            chunks = zip(bounds[:-1], bounds[1:])
+
+            if parsers == 1 or len(chunks) <= 2:
+                for (i, (chunk_start, chunk_end)) in enumerate(chunks):
+                    if i not in checkpoint.done:
+                        unit_queue = checkpoint.unit_queue(task_queue, i)
+                        progress_info[2].value += read_jsonl_range(data, chunk_start, chunk_end, filename,
+                                                                   db, table, fields, unit_queue, exit_event)
+                        checkpoint.finish_unit(i, unit_queue.batches, chunk_end)
+                    progress_info[0].value = chunk_end
+                return
+        finally:
+            data.close()
+
+    pool = multiprocessing.Pool(parsers, initializer=init_parser, initargs=(task_queue, exit_event))
+    try:
+        parses = [pool.apply_async(jsonl_parse_chunk, (filename, chunk_start, chunk_end, db, table, fields, i))
+                  if i not in checkpoint.done else None
+                  for (i, (chunk_start, chunk_end)) in enumerate(chunks)]
+        for (i, (result, (chunk_start, chunk_end))) in enumerate(zip(parses, chunks)):
+            if result is not None:
+                (rows, batches) = result.get()
+                checkpoint.finish_unit(i, batches, chunk_end)
+                progress_info[2].value += rows
+            progress_info[0].value = chunk_end
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Converters for the values of CSV fields given a type with --column-types, a
+#  ValueError means the value is not of that type
+def csv_int(value):
+    return int(value)
+
+def csv_float(value):
+    return float(value)
+
+csv_number_re = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?\Z')
+
+def csv_number(value):
+    match = csv_number_re.match(value)
+    if match is None:
+        raise ValueError(value)
+    elif match.group(2) is None and match.group(3) is None:
+        return int(value)
+    return float(value)
+
+def csv_bool(value):
+    lower = value.lower()
+    if lower == "true":
+        return True
+    elif lower == "false":
+        return False
+    raise ValueError(value)
+
+def csv_json(value):
+    return json.loads(value)
+
+# Values that look like JSON numbers or booleans become those, anything else stays a string
+def csv_auto(value):
+    if value[0] in "-0123456789":
+        match = csv_number_re.match(value)
+        if match is None:
+            return value
+        elif match.group(2) is None and match.group(3) is None:
+            return int(value)
+        return float(value)
+    elif value == "true":
+        return True
+    elif value == "false":
+        return False
+    return value
+
+csv_column_types = {"string": None, "int": csv_int, "float": csv_float, "number": csv_number,
+                    "bool": csv_bool, "json": csv_json, "auto": csv_auto}
+
+# Returns the converter for each field, the type of a field not in 'column_types'
+#  is the type stored under None
+def csv_converters(fields_in, column_types):
+    if column_types is None:
+        return [None] * len(fields_in)
+    for name in column_types:
+        if name is not None and name not in fields_in:
+            raise RuntimeError("Error: Field '%s' given in --column-types is not a CSV field" % name)
+    default = column_types.get(None, "string")
+    return [csv_column_types[column_types.get(name, default)] for name in fields_in]
+
+# Rows are located by 'line' in error messages if it is known, otherwise by 'offset'
+def csv_row_object(fields_in, converters, row, filename, line, offset):
+    def location():
+        return "line %d" % line if line is not None else "offset %d" % offset
+
+    if len(fields_in) != len(row):
+        raise RuntimeError("Error: File '%s' %s has an inconsistent number of columns" % (filename, location()))
+    obj = { }
+    for (name, convert, value) in zip(fields_in, converters, row):
+        if len(value) == 0: # Treat empty fields as no entry rather than empty string
+            continue
+        if convert is not None:
+            try:
+                value = convert(value)
+            except ValueError:
+                raise RuntimeError("Error: File '%s' %s has an invalid value for field '%s': %s" %
+                                   (filename, location(), name, value))
+        obj[name] = value
+    return obj
+
+# Yields the lines of a file, keeping the file offset of the next line in position[0]
+def counted_lines(file_in, position):
+    for line in file_in:
+        position[0] += len(line)
+        yield line
+
+# Collects the batches of a parser process, to be put on the task queue by the reader
+class ParsedBatches(list):
+    def put(self, task):
+        self.append(task)
 
-    progress_info[1].value = line_count
+csv_read_chunk_size = 32 * 1024
+csv_progress_interval = 1000
+csv_special_re = re.compile(r'["\n]')
 
+def csv_chunk_quotes(filename, start, end):
     with open(filename, "r") as file_in:
-        reader = csv.reader(file_in, delimiter=options["delimiter"])
+        file_in.seek(start)
+        return file_in.read(end - start).count('"') % 2 == 1
+
+# Returns the offset just past the first newline in the given range that is not
+#  inside a quoted field, or None if there isn't one
+def find_csv_row_start(file_in, start, end, in_quotes):
+    file_in.seek(start)
+    pos = start
+    while pos < end:
+        data = file_in.read(min(csv_read_chunk_size, end - pos))
+        if len(data) == 0:
+            break
+        for match in csv_special_re.finditer(data):
+            if match.group() == '"':
+                in_quotes = not in_quotes
+            elif not in_quotes:
+                return pos + match.end()
+        pos += len(data)
+    return None
+
+# Parses the rows of a chunk of a CSV file, which are those following a newline
+#  within the chunk (and the first row, for the first chunk).  Whether the chunk
+#  starts inside a quoted field is worked out from the number of quotes before it,
+#  which only holds if quotes are never used within unquoted fields, so the batches
+#  are returned rather than sent to the clients, for the reader to check that each
+#  chunk starts where the previous one ended.  Returns the offsets of the first row
+#  and of the end of the last row (None if there is no row), the number of rows,
+#  and the batches.
+def csv_parse_chunk(filename, start, end, in_quotes, first, fields_in, options, db, table):
+    batches = ParsedBatches()
+    batcher = ImportBatcher()
+    converters = csv_converters(fields_in, options["column_types"])
+    rows = 0
+
+    with open(filename, "r") as file_in:
+        row_start = start if first else find_csv_row_start(file_in, start, end, in_quotes)
+        if row_start is None:
+            return (None, None, 0, batches)
+
+        file_in.seek(row_start)
+        position = [row_start]
+        reader = csv.reader(counted_lines(file_in, position), delimiter=options["delimiter"])
+        while position[0] <= end:
+            offset = position[0]
+            try:
+                row = reader.next()
+            except StopIteration:
+                break
+            obj = csv_row_object(fields_in, converters, row, filename, None, offset)
+            object_callback(obj, db, table, batches, batcher, options["fields"], parser_exit_event)
+            rows += 1
+
+    batch = batcher.flush()
+    if len(batch) > 0:
+        batches.put((db, table, batch))
+    return (row_start, position[0], rows, batches)
+
+# Parses the rows of a CSV file from 'start' across a pool of 'parsers' processes,
+#  skipping chunks finished by an earlier import.  Returns None if all went well,
+#  or the offset of the first row that couldn't be parsed in parallel, because the
+#  quotes in the file didn't split it up correctly, and the chunk it is in.
+def read_csv_parallel(filename, start, file_size, parsers, fields_in, options, db, table,
+                      task_queue, checkpoint, progress_info, exit_event):
+    bounds = range(start, file_size, parse_chunk_size) + [file_size]
+    chunks = zip(bounds[:-1], bounds[1:])
+
+    pool = multiprocessing.Pool(parsers, initializer=init_parser, initargs=(None, exit_event))
+    try:
+        window = parsers * 2
+        quotes = [pool.apply_async(csv_chunk_quotes, (filename, chunk_start, chunk_end))
+                  for (chunk_start, chunk_end) in chunks[:window]]
+        parses = [ ]
+        expected = start # Where the next row starts
+
+        def collect():
+            (result, unit, chunk_end) = parses[0]
+            if result is None:
+                del parses[0]
+                progress_info[0].value = chunk_end
+                return checkpoint.done[unit]
+
+            (row_start, row_end, rows, batches) = result.get()
+            if expected > chunk_end:
+                if row_start is not None:
+                    return False
+            elif row_start != expected:
+                return False
+            del parses[0]
+
+            unit_queue = checkpoint.unit_queue(task_queue, unit)
+            for task in batches:
+                unit_queue.put(task)
+            checkpoint.finish_unit(unit, unit_queue.batches, row_end)
+            if row_end is not None:
+                progress_info[2].value += rows
+                progress_info[0].value = row_end
+            return row_end
+
+        in_quotes = False
+        for (i, (chunk_start, chunk_end)) in enumerate(chunks):
+            if exit_event.is_set():
+                raise InterruptedError()
+
+            if i in checkpoint.done:
+                parses.append((None, i, chunk_end))
+            else:
+                parses.append((pool.apply_async(csv_parse_chunk, (filename, chunk_start, chunk_end, in_quotes,
+                                                                   i == 0, fields_in, options, db, table)),
+                               i, chunk_end))
+            if i + window < len(chunks):
+                quotes.append(pool.apply_async(csv_chunk_quotes, (filename,) + chunks[i + window]))
+
+            in_quotes = in_quotes != quotes[i].get()
+            quotes[i] = None
+
+            while len(parses) > window or (len(parses) > 0 and (parses[0][0] is None or parses[0][0].ready())):
+                row_end = collect()
+                if row_end is False:
+                    return (expected, parses[0][1])
+                expected = row_end or expected
+
+        while len(parses) > 0:
+            row_end = collect()
+            if row_end is False:
+                return (expected, parses[0][1])
+            expected = row_end or expected
+    finally:
+        pool.terminate()
+        pool.join()
+    return None
+
+# Reads rows one at a time, with 'position' holding the file offset of the next
+#  row.  Rows are located by line number if 'first_line' (the line number of the
+#  first row) is known, otherwise by offset.
+def read_csv_rows(reader, filename, position, first_line, fields_in, options, db, table,
+                  task_queue, progress_info, exit_event):
+    batcher = ImportBatcher()
+    converters = csv_converters(fields_in, options["column_types"])
+    line_base = reader.line_num
+    rows = 0
+
+    while True:
+        line = first_line + reader.line_num - line_base if first_line is not None else None
+        offset = position[0]
+        try:
+            row = reader.next()
+        except StopIteration:
+            break
+        obj = csv_row_object(fields_in, converters, row, filename, line, offset)
+        object_callback(obj, db, table, task_queue, batcher, options["fields"], exit_event)
+        rows += 1
+
+        # The progress values take a lock to update, so only do so every so often
+        if rows == csv_progress_interval:
+            progress_info[0].value = position[0]
+            progress_info[2].value += rows
+            rows = 0
+
+    progress_info[0].value = position[0]
+    progress_info[2].value += rows
+
+    batch = batcher.flush()
+    if len(batch) > 0:
+        task_queue.put((db, table, batch))
+
+# Big files are read in chunks, smaller ones as a single unit
+def csv_reader(task_queue, filename, db, table, primary_key, options, checkpoint, progress_info, exit_event):
+    # Progress is reported by file offset, so the file is only read once
+    file_size = os.path.getsize(filename)
+    progress_info[1].value = file_size
+
+    with open(filename, "r") as file_in:
+        position = [0]
+        reader = csv.reader(counted_lines(file_in, position), delimiter=options["delimiter"])
 
         if not options["no_header"]:
             fields_in = reader.next()
@@ -427,24 +1159,35 @@ def csv_reader(task_queue, filename, db, table, primary_key, options, progress_i
         elif options["no_header"]:
             raise RuntimeError("Error: No field name information available")
 
-        for row in reader:
-            file_line = reader.line_num
-            progress_info[0].value = file_line
-            if len(fields_in) != len(row):
-                raise RuntimeError("Error: File '%s' line %d has an inconsistent number of columns" % (filename, file_line))
-            # We import all csv fields as strings (since we can't assume the type of the data)
-            obj = dict(zip(fields_in, row))
-            for key in list(obj.iterkeys()): # Treat empty fields as no entry rather than empty string
-                if len(obj[key]) == 0:
-                    del obj[key]
-            object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, options["fields"], exit_event)
-            progress_info[2].value += 1
-
-    if len(object_buffers) > 0:
-        task_queue.put((db, table, object_buffers))
-
-def table_reader(options, file_info, task_queue, error_queue, progress_info, exit_event):
+        # Check the column types before any parser processes are started
+        csv_converters(fields_in, options["column_types"])
+
+        if file_size > position[0] + 2 * parse_chunk_size:
+            rest = read_csv_parallel(filename, position[0], file_size, options["parsers"], fields_in, options,
+                                     db, table, task_queue, checkpoint, progress_info, exit_event)
+            if rest is None:
+                return
+
+            # Quotes within unquoted fields threw off the split, parse the rest in this
+            #  process, as part of the chunk where that happened
+            (rest_start, unit) = rest
+            unit_queue = checkpoint.unit_queue(task_queue, unit)
+            with open(filename, "r") as rest_in:
+                rest_in.seek(rest_start)
+                position = [rest_start]
+                reader = csv.reader(counted_lines(rest_in, position), delimiter=options["delimiter"])
+                read_csv_rows(reader, filename, position, None, fields_in, options, db, table,
+                              unit_queue, progress_info, exit_event)
+            checkpoint.finish_unit(unit, unit_queue.batches, file_size)
+        elif 0 not in checkpoint.done:
+            unit_queue = checkpoint.unit_queue(task_queue, 0)
+            read_csv_rows(reader, filename, position, reader.line_num + 1, fields_in, options, db, table,
+                          unit_queue, progress_info, exit_event)
+            checkpoint.finish_unit(0, unit_queue.batches, file_size)
+
+def table_reader(options, file_info, task_queue, error_queue, ack_queue, done_units, progress_info, exit_event):
     try:
+        checkpoint = FileCheckpoint(file_info["file"], ack_queue, done_units)
         db = file_info["db"]
         table = file_info["table"]
         primary_key = file_info["info"]["primary_key"]
@@ -459,18 +1202,32 @@ def table_reader(options, file_info, task_queue, error_queue, progress_info, exi
                         db, table,
                         primary_key,
                         options["fields"],
+                        options["parsers"],
+                        checkpoint,
                         progress_info,
                         exit_event)
+        elif file_info["format"] == "jsonl":
+            jsonl_reader(task_queue,
+                         file_info["file"],
+                         db, table,
+                         primary_key,
+                         options["fields"],
+                         options["parsers"],
+                         checkpoint,
+                         progress_info,
+                         exit_event)
         elif file_info["format"] == "csv":
             csv_reader(task_queue,
                        file_info["file"],
                        db, table,
                        primary_key,
                        options,
+                       checkpoint,
                        progress_info,
                        exit_event)
         else:
             raise RuntimeError("Error: Unknown file format specified")
+        checkpoint.finish_file()
     except (r.RqlError, r.RqlDriverError) as ex:
         error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except InterruptedError:
@@ -479,6 +1236,124 @@ def table_reader(options, file_info, task_queue, error_queue, progress_info, exi
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb), file_info["file"]))
 
+# The checkpoint file records the units of each file (see UnitQueue) whose batches
+#  have all been inserted, and the offset each unit's rows end at.  A file is
+#  complete once its reader has finished and all of its units are in.  With
+#  --resume, the units and files recorded are skipped, and as rows are inserted
+#  with upsert, inserting again the batches that were in flight when the import
+#  stopped is harmless.
+class ImportCheckpoint(object):
+    def __init__(self, path, chunk_size, files):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.files = files
+        self.pending = { } # (filename, unit) -> [batches or None until the reader is done with it, batches acked, end]
+        self.finished = set()
+        self.changed = False
+        self.last_save = 0
+        self.failed = False
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "r") as checkpoint_in:
+                data = json.load(checkpoint_in)
+        except (IOError, ValueError) as ex:
+            raise RuntimeError("Error: Could not read the checkpoint at %s: %s" % (path, ex))
+        for file_data in data["files"].values():
+            file_data["done"] = dict((int(unit), end) for (unit, end) in file_data["done"].items())
+        return cls(path, data["chunk_size"], data["files"])
+
+    # Adds a file to the checkpoint, or makes sure it hasn't changed since it was added
+    def add_file(self, filename):
+        stat = os.stat(filename)
+        if filename not in self.files:
+            self.files[filename] = {"size": stat.st_size, "mtime": stat.st_mtime, "complete": False, "done": { }}
+            self.changed = True
+        elif self.files[filename]["size"] != stat.st_size or self.files[filename]["mtime"] != stat.st_mtime:
+            raise RuntimeError("Error: File '%s' has changed since the import was checkpointed, run with --force " \
+                               "rather than --resume to start over" % filename)
+
+    def handle(self, message):
+        filename = message[1]
+        file_data = self.files[filename]
+        if message[0] == "file":
+            self.finished.add(filename)
+        elif message[2] not in file_data["done"]:
+            key = (filename, message[2])
+            pending = self.pending.setdefault(key, [None, 0, None])
+            if message[0] == "unit":
+                pending[0] = message[3]
+                pending[2] = message[4]
+            else:
+                pending[1] += 1
+            if pending[0] is not None and pending[1] >= pending[0]:
+                file_data["done"][message[2]] = pending[2]
+                del self.pending[key]
+                self.changed = True
+
+        if filename in self.finished and not file_data["complete"] and \
+           not any(key[0] == filename for key in self.pending):
+            file_data["complete"] = True
+            self.changed = True
+
+    def drain(self, ack_queue):
+        while not ack_queue.empty():
+            self.handle(ack_queue.get())
+
+    # The file is replaced rather than rewritten, so it is never left half-written.  If
+    #  it can't be written, the import goes on without a checkpoint.
+    def save(self, min_interval=0):
+        if self.failed or not self.changed or time.time() < self.last_save + min_interval:
+            return
+        files = { }
+        for (filename, file_data) in self.files.items():
+            # The offset up to which everything is in, for people reading the file
+            committed = 0
+            unit = 0
+            while unit in file_data["done"]:
+                committed = file_data["done"][unit] or committed
+                unit += 1
+            files[filename] = dict(file_data, done=dict((str(unit), end) for (unit, end) in file_data["done"].items()),
+                                   committed_offset=file_data["size"] if file_data["complete"] else committed)
+        try:
+            with open(self.path + ".tmp", "w") as checkpoint_out:
+                json.dump({"chunk_size": self.chunk_size, "files": files}, checkpoint_out)
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError) as ex:
+            print >> sys.stderr, "\nWarning: Could not write the checkpoint at %s (%s), the import will not be " \
+                                 "resumable" % (self.path, ex.strerror)
+            self.failed = True
+            return
+        self.changed = False
+        self.last_save = time.time()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def open_checkpoint(options, files_info):
+    global parse_chunk_size
+    if options["resume"]:
+        if not os.path.exists(options["checkpoint"]):
+            raise RuntimeError("Error: No checkpoint to resume from at %s" % options["checkpoint"])
+        checkpoint = ImportCheckpoint.load(options["checkpoint"])
+        # Units are chunks, so they have to be the same size as last time
+        parse_chunk_size = checkpoint.chunk_size
+    elif os.path.exists(options["checkpoint"]) and not options["force"]:
+        raise RuntimeError("Error: The checkpoint of an earlier import exists at %s, run with --resume to continue " \
+                           "that import, or with --force to start over" % options["checkpoint"])
+    else:
+        # With --force, a checkpoint left by an earlier import is replaced
+        checkpoint = ImportCheckpoint(options["checkpoint"], parse_chunk_size, { })
+
+    for file_info in files_info:
+        checkpoint.add_file(file_info["file"])
+    checkpoint.save()
+    return checkpoint
+
 def abort_import(signum, frame, parent_pid, exit_event, task_queue, clients, interrupt_event):
     # Only do the abort from the parent process
     if os.getpid() == parent_pid:
@@ -491,14 +1366,14 @@ def abort_import(signum, frame, parent_pid, exit_event, task_queue, clients, int
             #   the queue is full and clients aren't reading
             task_queue.put("exit")
 
-def print_progress(ratio):
+def print_progress(ratio, status=""):
     total_width = 40
     done_width = int(ratio * total_width)
     undone_width = total_width - done_width
-    print "\r[%s%s] %3d%%" % ("=" * done_width, " " * undone_width, int(100 * ratio)),
+    print "\r[%s%s] %3d%%%s" % ("=" * done_width, " " * undone_width, int(100 * ratio), status),
     sys.stdout.flush()
 
-def update_progress(progress_info):
+def update_progress(progress_info, task_queue):
     lowest_completion = 1.0
     for (current, max_count, rows) in progress_info:
         curr_val = current.value
@@ -510,13 +1385,21 @@ def update_progress(progress_info):
         else:
             lowest_completion = min(lowest_completion, float(curr_val) / max_val)
 
-    print_progress(lowest_completion)
+    print_progress(lowest_completion, "  (batches of %d rows, %d of %d queued)  " %
+                                      (batch_size.rows.value, task_queue.depth.value, task_queue.max_batches))
 
 def spawn_import_clients(options, files_info):
+    checkpoint = open_checkpoint(options, files_info)
+    skipped = [file_info for file_info in files_info if checkpoint.files[file_info["file"]]["complete"]]
+    if len(skipped) > 0:
+        print "Skipping %d file%s imported before" % (len(skipped), "" if len(skipped) == 1 else "s")
+        files_info = [file_info for file_info in files_info if file_info not in skipped]
+
     # Spawn one reader process for each db.table, as well as many client processes
-    task_queue = multiprocessing.queues.SimpleQueue()
-    error_queue = multiprocessing.queues.SimpleQueue()
     exit_event = multiprocessing.Event()
+    task_queue = TaskQueue(options["clients"] * queued_batches_per_client, exit_event)
+    error_queue = multiprocessing.queues.SimpleQueue()
+    ack_queue = multiprocessing.queues.SimpleQueue()
     interrupt_event = multiprocessing.Event()
     errors = []
     reader_procs = []
@@ -535,6 +1418,7 @@ def spawn_import_clients(options, files_info):
                                                               options["auth_key"],
                                                               task_queue,
                                                               error_queue,
+                                                              ack_queue,
                                                               options["force"],
                                                               options["durability"])))
             client_procs[-1].start()
@@ -548,6 +1432,8 @@ def spawn_import_clients(options, files_info):
                                                               file_info,
                                                               task_queue,
                                                               error_queue,
+                                                              ack_queue,
+                                                              checkpoint.files[file_info["file"]]["done"],
                                                               progress_info[-1],
                                                               exit_event)))
             reader_procs[-1].start()
@@ -558,8 +1444,14 @@ def spawn_import_clients(options, files_info):
             # If an error has occurred, exit out early
             if not error_queue.empty():
                 exit_event.set()
+            # With no clients left, drop the batches readers are waiting to queue so they can stop
+            if exit_event.is_set() and not any(client.is_alive() for client in client_procs):
+                while not task_queue.empty():
+                    task_queue.get()
             reader_procs = [proc for proc in reader_procs if proc.is_alive()]
-            update_progress(progress_info)
+            update_progress(progress_info, task_queue)
+            checkpoint.drain(ack_queue)
+            checkpoint.save(1.0)
 
         # Wait for all clients to finish
         alive_clients = sum([client.is_alive() for client in client_procs])
@@ -569,10 +1461,13 @@ def spawn_import_clients(options, files_info):
         while len(client_procs) > 0:
             time.sleep(0.1)
             client_procs = [client for client in client_procs if client.is_alive()]
+            checkpoint.drain(ack_queue)
+            checkpoint.save(1.0)
+        checkpoint.drain(ack_queue)
 
         # If we were successful, make sure 100% progress is reported
         if error_queue.empty() and not interrupt_event.is_set():
-            print_progress(1.0)
+            update_progress([ ], task_queue)
 
         # Continue past the progress output line
         def plural(num, text):
@@ -584,6 +1479,14 @@ def spawn_import_clients(options, files_info):
     finally:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+    if all(file_data["complete"] for file_data in checkpoint.files.values()) and error_queue.empty():
+        checkpoint.remove()
+    else:
+        checkpoint.save()
+        if not checkpoint.failed:
+            print >> sys.stderr, "The progress of the import was saved in %s, run the same command with --resume " \
+                                 "to continue it" % checkpoint.path
+
     if interrupt_event.is_set():
         raise RuntimeError("Interrupted")
 
@@ -639,7 +1542,7 @@ def import_directory(options):
                 del dirs[0:len(dirs)]
             for f in files:
                 split_file = f.split(".")
-                if len(split_file) != 2 or split_file[1] not in ["json", "csv", "info"]:
+                if len(split_file) != 2 or split_file[1] not in ["json", "jsonl", "csv", "info"]:
                     files_ignored.append(os.path.join(root, f))
                 elif split_file[1] == "info":
                     pass # Info files are included based on the data files
@@ -660,7 +1563,7 @@ def import_directory(options):
     for file_info in files_info:
         if (file_info["db"], file_info["table"]) in db_tables:
             raise RuntimeError("Error: Duplicate db.table found in directory tree: %s.%s" % (file_info["db"], file_info["table"]))
-        if file_info["format"] not in ["csv", "json"]:
+        if file_info["format"] not in ["csv", "json", "jsonl"]:
             raise RuntimeError("Error: Unrecognized format for file %s" % file_info["file"])
 
         db_tables.add((file_info["db"], file_info["table"]))
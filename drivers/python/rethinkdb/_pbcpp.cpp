@@ -1,9 +1,755 @@
-// This is an empty python module. It gets linked to ql2.pb.o, whose functions get
-// exposed and used by the C++ implementation of the google.protobuf package.
+// The driver's C codec for ql2 messages, used by `rethinkdb.codec`. It encodes
+// Query messages and decodes Response messages straight from and to the
+// protobuf wire format, without going through the google.protobuf classes.
+// Decoded responses have the same attributes as the ql2_pb2 classes for the
+// fields the driver reads.
+//
+// When the C++ protobuf backend is enabled the module is also linked to
+// ql2.pb.o, whose functions get exposed and used by the C++ implementation of
+// the google.protobuf package.
 
-#include <python2.7/Python.h>
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+
+#include <stddef.h>
+#include <stdlib.h>
+#include <string.h>
+
+enum { WIRE_VARINT = 0, WIRE_FIXED64 = 1, WIRE_LENGTH = 2, WIRE_FIXED32 = 5 };
+
+enum { R_NULL = 1, R_BOOL = 2, R_NUM = 3, R_STR = 4, R_ARRAY = 5, R_OBJECT = 6, R_JSON = 7 };
+
+// The same limit as the C++ protobuf parser
+static const int max_depth = 100;
+
+static PyObject *DecodeError;
+static PyObject *empty_str;
+static PyObject *empty_tuple;
+static PyObject *null_datum;
+static PyObject *empty_backtrace;
+
+// Decoded messages
+
+typedef struct {
+    PyObject_HEAD
+    int type;
+    char r_bool;
+    double r_num;
+    PyObject *r_str;
+    PyObject *r_array;
+    PyObject *r_object;
+} DatumObject;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *key;
+    PyObject *val;
+} AssocPairObject;
+
+typedef struct {
+    PyObject_HEAD
+    int type;
+    PyObject *pos;
+    PyObject *opt;
+} FrameObject;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *frames;
+} BacktraceObject;
+
+typedef struct {
+    PyObject_HEAD
+    int type;
+    PyObject *token;
+    PyObject *response;
+    PyObject *backtrace;
+    PyObject *profile;
+    Py_ssize_t size;
+} ResponseObject;
+
+static void Datum_dealloc(DatumObject *self) {
+    Py_XDECREF(self->r_str);
+    Py_XDECREF(self->r_array);
+    Py_XDECREF(self->r_object);
+    PyObject_Del(self);
+}
+
+static void AssocPair_dealloc(AssocPairObject *self) {
+    Py_XDECREF(self->key);
+    Py_XDECREF(self->val);
+    PyObject_Del(self);
+}
+
+static void Frame_dealloc(FrameObject *self) {
+    Py_XDECREF(self->pos);
+    Py_XDECREF(self->opt);
+    PyObject_Del(self);
+}
+
+static void Backtrace_dealloc(BacktraceObject *self) {
+    Py_XDECREF(self->frames);
+    PyObject_Del(self);
+}
+
+static void Response_dealloc(ResponseObject *self) {
+    Py_XDECREF(self->token);
+    Py_XDECREF(self->response);
+    Py_XDECREF(self->backtrace);
+    Py_XDECREF(self->profile);
+    PyObject_Del(self);
+}
+
+// Like the protobuf method, the size of the serialized message
+static PyObject *Response_ByteSize(ResponseObject *self, PyObject *unused) {
+    return PyInt_FromSsize_t(self->size);
+}
+
+static PyMemberDef Datum_members[] = {
+    {(char *)"type", T_INT, offsetof(DatumObject, type), READONLY, NULL},
+    {(char *)"r_bool", T_BOOL, offsetof(DatumObject, r_bool), READONLY, NULL},
+    {(char *)"r_num", T_DOUBLE, offsetof(DatumObject, r_num), READONLY, NULL},
+    {(char *)"r_str", T_OBJECT, offsetof(DatumObject, r_str), READONLY, NULL},
+    {(char *)"r_array", T_OBJECT, offsetof(DatumObject, r_array), READONLY, NULL},
+    {(char *)"r_object", T_OBJECT, offsetof(DatumObject, r_object), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static PyMemberDef AssocPair_members[] = {
+    {(char *)"key", T_OBJECT, offsetof(AssocPairObject, key), READONLY, NULL},
+    {(char *)"val", T_OBJECT, offsetof(AssocPairObject, val), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static PyMemberDef Frame_members[] = {
+    {(char *)"type", T_INT, offsetof(FrameObject, type), READONLY, NULL},
+    {(char *)"pos", T_OBJECT, offsetof(FrameObject, pos), READONLY, NULL},
+    {(char *)"opt", T_OBJECT, offsetof(FrameObject, opt), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static PyMemberDef Backtrace_members[] = {
+    {(char *)"frames", T_OBJECT, offsetof(BacktraceObject, frames), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static PyMemberDef Response_members[] = {
+    {(char *)"type", T_INT, offsetof(ResponseObject, type), READONLY, NULL},
+    {(char *)"token", T_OBJECT, offsetof(ResponseObject, token), READONLY, NULL},
+    {(char *)"response", T_OBJECT, offsetof(ResponseObject, response), READONLY, NULL},
+    {(char *)"backtrace", T_OBJECT, offsetof(ResponseObject, backtrace), READONLY, NULL},
+    {(char *)"profile", T_OBJECT, offsetof(ResponseObject, profile), READONLY, NULL},
+    {NULL, 0, 0, 0, NULL}
+};
+
+static PyMethodDef Response_methods[] = {
+    {"ByteSize", (PyCFunction)Response_ByteSize, METH_NOARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject DatumType = { PyObject_HEAD_INIT(NULL) };
+static PyTypeObject AssocPairType = { PyObject_HEAD_INIT(NULL) };
+static PyTypeObject FrameType = { PyObject_HEAD_INIT(NULL) };
+static PyTypeObject BacktraceType = { PyObject_HEAD_INIT(NULL) };
+static PyTypeObject ResponseType = { PyObject_HEAD_INIT(NULL) };
+
+static int init_type(PyTypeObject *type, const char *name, Py_ssize_t size,
+                     destructor dealloc, PyMemberDef *members, PyMethodDef *methods) {
+    type->tp_name = name;
+    type->tp_basicsize = size;
+    type->tp_dealloc = dealloc;
+    type->tp_flags = Py_TPFLAGS_DEFAULT;
+    type->tp_members = members;
+    type->tp_methods = methods;
+    return PyType_Ready(type);
+}
+
+// Decoding
+
+typedef struct {
+    const unsigned char *pos;
+    const unsigned char *end;
+} reader_t;
+
+static int read_varint(reader_t *reader, unsigned long long *value) {
+    unsigned long long res = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+        if (reader->pos >= reader->end) {
+            PyErr_SetString(DecodeError, "Truncated message.");
+            return -1;
+        }
+        unsigned char byte = *reader->pos++;
+        res |= (unsigned long long)(byte & 0x7f) << shift;
+        if (!(byte & 0x80)) {
+            *value = res;
+            return 0;
+        }
+    }
+    PyErr_SetString(DecodeError, "Varint is too long.");
+    return -1;
+}
+
+static int read_key(reader_t *reader, int *field, int *wire_type) {
+    unsigned long long key;
+    if (read_varint(reader, &key) < 0) {
+        return -1;
+    }
+    *field = (int)(key >> 3);
+    *wire_type = (int)(key & 0x7);
+    return 0;
+}
+
+// Reads a length-delimited field into `sub`
+static int read_length(reader_t *reader, int wire_type, reader_t *sub) {
+    unsigned long long length;
+    if (wire_type != WIRE_LENGTH) {
+        PyErr_SetString(DecodeError, "Unexpected wire type.");
+        return -1;
+    }
+    if (read_varint(reader, &length) < 0) {
+        return -1;
+    }
+    if (length > (unsigned long long)(reader->end - reader->pos)) {
+        PyErr_SetString(DecodeError, "Truncated message.");
+        return -1;
+    }
+    sub->pos = reader->pos;
+    sub->end = reader->pos + length;
+    reader->pos = sub->end;
+    return 0;
+}
+
+static int read_varint_field(reader_t *reader, int wire_type, unsigned long long *value) {
+    if (wire_type != WIRE_VARINT) {
+        PyErr_SetString(DecodeError, "Unexpected wire type.");
+        return -1;
+    }
+    return read_varint(reader, value);
+}
+
+static int skip_field(reader_t *reader, int wire_type) {
+    unsigned long long value;
+    reader_t sub;
+    switch (wire_type) {
+    case WIRE_VARINT:
+        return read_varint(reader, &value);
+    case WIRE_LENGTH:
+        return read_length(reader, wire_type, &sub);
+    case WIRE_FIXED64:
+    case WIRE_FIXED32: {
+        ptrdiff_t size = wire_type == WIRE_FIXED64 ? 8 : 4;
+        if (reader->end - reader->pos < size) {
+            PyErr_SetString(DecodeError, "Truncated message.");
+            return -1;
+        }
+        reader->pos += size;
+        return 0;
+    }
+    default:
+        PyErr_SetString(DecodeError, "Unsupported wire type.");
+        return -1;
+    }
+}
+
+// int64 fields as Python ints, like the protobuf library returns them
+static PyObject *int64_object(unsigned long long value) {
+    long long signed_value = (long long)value;
+    if (signed_value >= LONG_MIN && signed_value <= LONG_MAX) {
+        return PyInt_FromLong((long)signed_value);
+    }
+    return PyLong_FromLongLong(signed_value);
+}
+
+static PyObject *string_object(reader_t *sub) {
+    return PyUnicode_DecodeUTF8((const char *)sub->pos, sub->end - sub->pos, NULL);
+}
+
+// Replaces an optional field, which may appear more than once
+static void set_field(PyObject **field, PyObject *value) {
+    PyObject *old = *field;
+    *field = value;
+    Py_XDECREF(old);
+}
+
+static int append_new(PyObject **list, PyObject *item) {
+    if (item == NULL) {
+        return -1;
+    }
+    if (*list == empty_tuple) {
+        PyObject *new_list = PyList_New(0);
+        if (new_list == NULL) {
+            Py_DECREF(item);
+            return -1;
+        }
+        set_field(list, new_list);
+    }
+    int res = PyList_Append(*list, item);
+    Py_DECREF(item);
+    return res;
+}
+
+static PyObject *decode_datum(reader_t *reader, int depth);
+
+static PyObject *decode_datum_assoc_pair(reader_t *reader, int depth) {
+    AssocPairObject *pair = PyObject_New(AssocPairObject, &AssocPairType);
+    if (pair == NULL) {
+        return NULL;
+    }
+    Py_INCREF(empty_str);
+    pair->key = empty_str;
+    Py_INCREF(null_datum);
+    pair->val = null_datum;
+
+    while (reader->pos < reader->end) {
+        int field, wire_type;
+        reader_t sub;
+        PyObject *value;
+        if (read_key(reader, &field, &wire_type) < 0) {
+            goto error;
+        }
+        switch (field) {
+        case 1:
+            if (read_length(reader, wire_type, &sub) < 0 || (value = string_object(&sub)) == NULL) {
+                goto error;
+            }
+            set_field(&pair->key, value);
+            break;
+        case 2:
+            if (read_length(reader, wire_type, &sub) < 0 || (value = decode_datum(&sub, depth + 1)) == NULL) {
+                goto error;
+            }
+            set_field(&pair->val, value);
+            break;
+        default:
+            if (skip_field(reader, wire_type) < 0) {
+                goto error;
+            }
+        }
+    }
+    return (PyObject *)pair;
+
+error:
+    Py_DECREF(pair);
+    return NULL;
+}
+
+static PyObject *decode_datum(reader_t *reader, int depth) {
+    if (depth > max_depth) {
+        PyErr_SetString(DecodeError, "Datum is nested too deeply.");
+        return NULL;
+    }
+
+    DatumObject *datum = PyObject_New(DatumObject, &DatumType);
+    if (datum == NULL) {
+        return NULL;
+    }
+    datum->type = R_NULL;
+    datum->r_bool = 0;
+    datum->r_num = 0.0;
+    Py_INCREF(empty_str);
+    datum->r_str = empty_str;
+    Py_INCREF(empty_tuple);
+    datum->r_array = empty_tuple;
+    Py_INCREF(empty_tuple);
+    datum->r_object = empty_tuple;
+
+    while (reader->pos < reader->end) {
+        int field, wire_type;
+        unsigned long long value;
+        reader_t sub;
+        PyObject *str;
+        if (read_key(reader, &field, &wire_type) < 0) {
+            goto error;
+        }
+        switch (field) {
+        case 1:
+            if (read_varint_field(reader, wire_type, &value) < 0) {
+                goto error;
+            }
+            datum->type = (int)value;
+            break;
+        case 2:
+            if (read_varint_field(reader, wire_type, &value) < 0) {
+                goto error;
+            }
+            datum->r_bool = value != 0;
+            break;
+        case 3:
+            if (wire_type != WIRE_FIXED64 || reader->end - reader->pos < 8) {
+                PyErr_SetString(DecodeError, "Invalid r_num field.");
+                goto error;
+            }
+            // The wire format is little endian, as are the platforms we build on
+            memcpy(&datum->r_num, reader->pos, 8);
+            reader->pos += 8;
+            break;
+        case 4:
+            if (read_length(reader, wire_type, &sub) < 0 || (str = string_object(&sub)) == NULL) {
+                goto error;
+            }
+            set_field(&datum->r_str, str);
+            break;
+        case 5:
+            if (read_length(reader, wire_type, &sub) < 0 ||
+                append_new(&datum->r_array, decode_datum(&sub, depth + 1)) < 0) {
+                goto error;
+            }
+            break;
+        case 6:
+            if (read_length(reader, wire_type, &sub) < 0 ||
+                append_new(&datum->r_object, decode_datum_assoc_pair(&sub, depth)) < 0) {
+                goto error;
+            }
+            break;
+        default:
+            if (skip_field(reader, wire_type) < 0) {
+                goto error;
+            }
+        }
+    }
+    return (PyObject *)datum;
+
+error:
+    Py_DECREF(datum);
+    return NULL;
+}
+
+static PyObject *decode_frame(reader_t *reader) {
+    FrameObject *frame = PyObject_New(FrameObject, &FrameType);
+    if (frame == NULL) {
+        return NULL;
+    }
+    frame->type = 1;
+    frame->pos = PyInt_FromLong(0);
+    Py_INCREF(empty_str);
+    frame->opt = empty_str;
+    if (frame->pos == NULL) {
+        goto error;
+    }
+
+    while (reader->pos < reader->end) {
+        int field, wire_type;
+        unsigned long long value;
+        reader_t sub;
+        PyObject *obj;
+        if (read_key(reader, &field, &wire_type) < 0) {
+            goto error;
+        }
+        switch (field) {
+        case 1:
+            if (read_varint_field(reader, wire_type, &value) < 0) {
+                goto error;
+            }
+            frame->type = (int)value;
+            break;
+        case 2:
+            if (read_varint_field(reader, wire_type, &value) < 0 || (obj = int64_object(value)) == NULL) {
+                goto error;
+            }
+            set_field(&frame->pos, obj);
+            break;
+        case 3:
+            if (read_length(reader, wire_type, &sub) < 0 || (obj = string_object(&sub)) == NULL) {
+                goto error;
+            }
+            set_field(&frame->opt, obj);
+            break;
+        default:
+            if (skip_field(reader, wire_type) < 0) {
+                goto error;
+            }
+        }
+    }
+    return (PyObject *)frame;
+
+error:
+    Py_DECREF(frame);
+    return NULL;
+}
+
+static PyObject *decode_backtrace(reader_t *reader) {
+    BacktraceObject *backtrace = PyObject_New(BacktraceObject, &BacktraceType);
+    if (backtrace == NULL) {
+        return NULL;
+    }
+    Py_INCREF(empty_tuple);
+    backtrace->frames = empty_tuple;
+
+    while (reader->pos < reader->end) {
+        int field, wire_type;
+        reader_t sub;
+        if (read_key(reader, &field, &wire_type) < 0) {
+            goto error;
+        }
+        if (field == 1) {
+            if (read_length(reader, wire_type, &sub) < 0 ||
+                append_new(&backtrace->frames, decode_frame(&sub)) < 0) {
+                goto error;
+            }
+        } else if (skip_field(reader, wire_type) < 0) {
+            goto error;
+        }
+    }
+    return (PyObject *)backtrace;
+
+error:
+    Py_DECREF(backtrace);
+    return NULL;
+}
+
+static PyObject *decode_response(PyObject *self, PyObject *args) {
+    Py_buffer buffer;
+    if (!PyArg_ParseTuple(args, "s*:decode_response", &buffer)) {
+        return NULL;
+    }
+
+    reader_t reader;
+    reader.pos = (const unsigned char *)buffer.buf;
+    reader.end = reader.pos + buffer.len;
+
+    ResponseObject *response = PyObject_New(ResponseObject, &ResponseType);
+    if (response == NULL) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+    response->type = 1;
+    response->size = buffer.len;
+    response->token = PyInt_FromLong(0);
+    response->response = PyList_New(0);
+    Py_INCREF(empty_backtrace);
+    response->backtrace = empty_backtrace;
+    Py_INCREF(null_datum);
+    response->profile = null_datum;
+    if (response->token == NULL || response->response == NULL) {
+        goto error;
+    }
+
+    while (reader.pos < reader.end) {
+        int field, wire_type;
+        unsigned long long value;
+        reader_t sub;
+        PyObject *obj;
+        if (read_key(&reader, &field, &wire_type) < 0) {
+            goto error;
+        }
+        switch (field) {
+        case 1:
+            if (read_varint_field(&reader, wire_type, &value) < 0) {
+                goto error;
+            }
+            response->type = (int)value;
+            break;
+        case 2:
+            if (read_varint_field(&reader, wire_type, &value) < 0 || (obj = int64_object(value)) == NULL) {
+                goto error;
+            }
+            set_field(&response->token, obj);
+            break;
+        case 3:
+            if (read_length(&reader, wire_type, &sub) < 0 ||
+                append_new(&response->response, decode_datum(&sub, 1)) < 0) {
+                goto error;
+            }
+            break;
+        case 4:
+            if (read_length(&reader, wire_type, &sub) < 0 || (obj = decode_backtrace(&sub)) == NULL) {
+                goto error;
+            }
+            set_field(&response->backtrace, obj);
+            break;
+        case 5:
+            if (read_length(&reader, wire_type, &sub) < 0 || (obj = decode_datum(&sub, 1)) == NULL) {
+                goto error;
+            }
+            set_field(&response->profile, obj);
+            break;
+        default:
+            if (skip_field(&reader, wire_type) < 0) {
+                goto error;
+            }
+        }
+    }
+    PyBuffer_Release(&buffer);
+    return (PyObject *)response;
+
+error:
+    PyBuffer_Release(&buffer);
+    Py_DECREF(response);
+    return NULL;
+}
+
+// Encoding
+
+typedef struct {
+    char *data;
+    size_t size;
+    size_t capacity;
+} writer_t;
+
+static int reserve(writer_t *writer, size_t size) {
+    if (writer->size + size <= writer->capacity) {
+        return 0;
+    }
+    size_t capacity = writer->capacity * 2;
+    if (capacity < writer->size + size) {
+        capacity = writer->size + size;
+    }
+    char *data = (char *)realloc(writer->data, capacity);
+    if (data == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    writer->data = data;
+    writer->capacity = capacity;
+    return 0;
+}
+
+static int write_varint(writer_t *writer, unsigned long long value) {
+    if (reserve(writer, 10) < 0) {
+        return -1;
+    }
+    while (value >= 0x80) {
+        writer->data[writer->size++] = (char)(0x80 | (value & 0x7f));
+        value >>= 7;
+    }
+    writer->data[writer->size++] = (char)value;
+    return 0;
+}
+
+static int write_bytes(writer_t *writer, const char *data, size_t size) {
+    if (reserve(writer, size) < 0) {
+        return -1;
+    }
+    memcpy(writer->data + writer->size, data, size);
+    writer->size += size;
+    return 0;
+}
+
+static int write_length_delimited(writer_t *writer, int field, const char *data, size_t size) {
+    if (write_varint(writer, (field << 3) | WIRE_LENGTH) < 0 || write_varint(writer, size) < 0) {
+        return -1;
+    }
+    return write_bytes(writer, data, size);
+}
+
+static size_t varint_size(unsigned long long value) {
+    size_t size = 1;
+    while (value >= 0x80) {
+        value >>= 7;
+        size++;
+    }
+    return size;
+}
+
+// A global optarg, as a pair of a key (str or unicode) and a serialized term
+static int write_global_optarg(writer_t *writer, PyObject *item) {
+    PyObject *key, *utf8 = NULL;
+    const char *val;
+    Py_ssize_t val_size;
+    int res = -1;
+
+    if (!PyArg_ParseTuple(item, "Os#:global_optargs", &key, &val, &val_size)) {
+        return -1;
+    }
+    if (PyUnicode_Check(key)) {
+        utf8 = PyUnicode_AsUTF8String(key);
+        if (utf8 == NULL) {
+            return -1;
+        }
+        key = utf8;
+    }
+    if (!PyString_Check(key)) {
+        PyErr_SetString(PyExc_TypeError, "global_optargs keys must be strings");
+        goto done;
+    }
+
+    {
+        size_t key_size = PyString_GET_SIZE(key);
+        size_t pair_size = 1 + varint_size(key_size) + key_size + 1 + varint_size(val_size) + val_size;
+        if (write_varint(writer, (6 << 3) | WIRE_LENGTH) < 0 || write_varint(writer, pair_size) < 0 ||
+            write_length_delimited(writer, 1, PyString_AS_STRING(key), key_size) < 0 ||
+            write_length_delimited(writer, 2, val, val_size) < 0) {
+            goto done;
+        }
+    }
+    res = 0;
+
+done:
+    Py_XDECREF(utf8);
+    return res;
+}
+
+// encode_query(type, token, accepts_r_json, term=None, global_optargs=())
+static PyObject *encode_query(PyObject *self, PyObject *args) {
+    int type;
+    unsigned long long token;
+    PyObject *accepts_r_json;
+    PyObject *term = Py_None;
+    PyObject *global_optargs = NULL;
+    if (!PyArg_ParseTuple(args, "iKO|OO:encode_query", &type, &token, &accepts_r_json, &term, &global_optargs)) {
+        return NULL;
+    }
+    int accepts = PyObject_IsTrue(accepts_r_json);
+    if (accepts < 0) {
+        return NULL;
+    }
+
+    writer_t writer;
+    writer.data = NULL;
+    writer.size = 0;
+    writer.capacity = 0;
+    PyObject *res = NULL;
+    PyObject *iter = NULL;
+
+    if (write_varint(&writer, (1 << 3) | WIRE_VARINT) < 0 || write_varint(&writer, type) < 0) {
+        goto done;
+    }
+    if (term != Py_None) {
+        if (!PyString_Check(term)) {
+            PyErr_SetString(PyExc_TypeError, "term must be a serialized term");
+            goto done;
+        }
+        if (write_length_delimited(&writer, 2, PyString_AS_STRING(term), PyString_GET_SIZE(term)) < 0) {
+            goto done;
+        }
+    }
+    if (write_varint(&writer, (3 << 3) | WIRE_VARINT) < 0 || write_varint(&writer, token) < 0 ||
+        write_varint(&writer, (5 << 3) | WIRE_VARINT) < 0 || write_varint(&writer, accepts) < 0) {
+        goto done;
+    }
+
+    if (global_optargs != NULL) {
+        iter = PyObject_GetIter(global_optargs);
+        if (iter == NULL) {
+            goto done;
+        }
+        PyObject *item;
+        while ((item = PyIter_Next(iter)) != NULL) {
+            int item_res = write_global_optarg(&writer, item);
+            Py_DECREF(item);
+            if (item_res < 0) {
+                goto done;
+            }
+        }
+        if (PyErr_Occurred()) {
+            goto done;
+        }
+    }
+
+    res = PyString_FromStringAndSize(writer.data, writer.size);
+
+done:
+    Py_XDECREF(iter);
+    free(writer.data);
+    return res;
+}
 
 static PyMethodDef PbMethods[] = {
+    {"encode_query", encode_query, METH_VARARGS,
+     "Serializes a Query from its type, token, accepts_r_json, term and global optargs."},
+    {"decode_response", decode_response, METH_VARARGS,
+     "Parses a serialized Response."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -12,4 +758,39 @@ PyMODINIT_FUNC init_pbcpp() {
     m = Py_InitModule("rethinkdb._pbcpp", PbMethods);
     if (m == NULL)
         return;
+
+    if (init_type(&DatumType, "rethinkdb._pbcpp.Datum", sizeof(DatumObject),
+                  (destructor)Datum_dealloc, Datum_members, NULL) < 0 ||
+        init_type(&AssocPairType, "rethinkdb._pbcpp.AssocPair", sizeof(AssocPairObject),
+                  (destructor)AssocPair_dealloc, AssocPair_members, NULL) < 0 ||
+        init_type(&FrameType, "rethinkdb._pbcpp.Frame", sizeof(FrameObject),
+                  (destructor)Frame_dealloc, Frame_members, NULL) < 0 ||
+        init_type(&BacktraceType, "rethinkdb._pbcpp.Backtrace", sizeof(BacktraceObject),
+                  (destructor)Backtrace_dealloc, Backtrace_members, NULL) < 0 ||
+        init_type(&ResponseType, "rethinkdb._pbcpp.Response", sizeof(ResponseObject),
+                  (destructor)Response_dealloc, Response_members, Response_methods) < 0)
+        return;
+
+    DecodeError = PyErr_NewException((char *)"rethinkdb._pbcpp.DecodeError", PyExc_ValueError, NULL);
+    empty_str = PyUnicode_FromStringAndSize(NULL, 0);
+    empty_tuple = PyTuple_New(0);
+    if (DecodeError == NULL || empty_str == NULL || empty_tuple == NULL)
+        return;
+
+    // Shared defaults for absent fields, which like the protobuf defaults are
+    // never modified
+    reader_t empty_reader;
+    empty_reader.pos = empty_reader.end = NULL;
+    null_datum = decode_datum(&empty_reader, 0);
+    empty_backtrace = decode_backtrace(&empty_reader);
+    if (null_datum == NULL || empty_backtrace == NULL)
+        return;
+
+    Py_INCREF(DecodeError);
+    PyModule_AddObject(m, "DecodeError", DecodeError);
+#ifdef PBCPP_LINKED_QL2
+    PyModule_AddIntConstant(m, "linked_ql2", 1);
+#else
+    PyModule_AddIntConstant(m, "linked_ql2", 0);
+#endif
 }
@@ -7,9 +7,11 @@ import collections
 import time
 import re
 import json as py_json
-from threading import Lock
+import itertools
+import threading
 from .errors import *
 from . import repl # For the repl connection
+from . import wire
 
 # This is both an external function and one used extensively
 # internally to convert coerce python values to RQL types
@@ -46,44 +48,91 @@ def expr(val, nesting_depth=20):
     else:
         return Datum(val)
 
+# Values that serialize to JSON as they are
+json_scalar_types = (int, long, float, bool, str, unicode, types.NoneType)
+
 # Like expr but attempts to serialize as much of the value as JSON
 # as possible.
 def exprJSON(val, nesting_depth=20):
-    if nesting_depth <= 0:
-        raise RqlDriverError("Nesting depth limit exceeded")
-
     if isinstance(val, RqlQuery):
         return val
-    elif isJSON(val, nesting_depth):
+    term = _json_subtrees(val, nesting_depth)
+    if term is None:
         return Json(py_json.dumps(val))
-    elif isinstance(val, dict):
-        copy = val.copy()
-        for k,v in copy.items():
-            copy[k] = exprJSON(v, nesting_depth)
-        return MakeObj(copy)
-    elif isinstance(val, list):
-        copy = []
-        for v in val:
-            copy.append(exprJSON(v, nesting_depth))
-        return MakeArray(*copy)
-    else:
-        # Default to datum serialization
-        return expr(val, nesting_depth - 1)
+    return term
+
+# Walks `val` once, without recursion. Returns None if all of it can be sent
+# as JSON, or otherwise a term in which each largest JSON subtree is a single
+# `Json` and everything else went through `expr`.
+def _json_subtrees(val, nesting_depth):
+    # Each frame holds a container, an iterator over its (key, child) pairs,
+    # the terms of its children that aren't JSON (None while the container
+    # still is JSON) and its key in the parent. The bottom frame holds `val`.
+    stack = [[None, iter([(None, val)]), None, None]]
+    while True:
+        frame = stack[-1]
+        for (key, child) in frame[1]:
+            if len(stack) > nesting_depth:
+                raise RqlDriverError("Nesting depth limit exceeded")
+
+            if isinstance(child, dict):
+                terms = None
+                if not all(isinstance(k, types.StringTypes) for k in child):
+                    terms = { }
+                stack.append([child, child.iteritems(), terms, key])
+                break
+            elif isinstance(child, list):
+                stack.append([child, enumerate(child), None, key])
+                break
+            elif isinstance(child, json_scalar_types):
+                continue
 
-def isJSON(val, nesting_depth=20):
-    if nesting_depth <= 0:
-        raise RqlDriverError("Nesting depth limit exceeded")
+            if frame[2] is None:
+                frame[2] = { }
+            if isinstance(child, RqlQuery):
+                frame[2][key] = child
+            else:
+                frame[2][key] = expr(child, nesting_depth - 1)
+        else:
+            (node, items, terms, key) = stack.pop()
+            if len(stack) == 0:
+                return None if terms is None else terms[None]
+            if terms is not None:
+                parent = stack[-1]
+                if parent[2] is None:
+                    parent[2] = { }
+                parent[2][key] = _json_subtree_term(node, terms)
+
+def _json_subtree_term(node, terms):
+    if isinstance(node, dict):
+        obj = { }
+        for (k, v) in node.iteritems():
+            term = terms.get(k)
+            obj[k] = term if term is not None else Json(py_json.dumps(v))
+        return MakeObj(obj)
+    return MakeArray(*[terms[i] if i in terms else Json(py_json.dumps(v)) for (i, v) in enumerate(node)])
 
-    if isinstance(val, RqlQuery):
-        return False
-    elif isinstance(val, dict):
-        return all([isinstance(k, types.StringTypes) and isJSON(v, nesting_depth - 1) for k,v in val.items()])
-    elif isinstance(val, list):
-        return all([isJSON(v, nesting_depth - 1) for v in val])
-    elif isinstance(val, (int, float, str, unicode, bool)):
-        return True
-    else:
-        return False
+def isJSON(val, nesting_depth=20):
+    # A stack of iterators over the values still to be checked
+    stack = [iter([val])]
+    while len(stack) > 0:
+        for v in stack[-1]:
+            if len(stack) > nesting_depth:
+                raise RqlDriverError("Nesting depth limit exceeded")
+
+            if isinstance(v, dict):
+                if not all(isinstance(k, types.StringTypes) for k in v):
+                    return False
+                stack.append(v.itervalues())
+                break
+            elif isinstance(v, list):
+                stack.append(iter(v))
+                break
+            elif not isinstance(v, json_scalar_types):
+                return False
+        else:
+            stack.pop()
+    return True
 
 class RqlQuery(object):
 
@@ -126,6 +175,17 @@ class RqlQuery(object):
             pair.key = k
             self.optargs[k].build(pair.val)
 
+    # Serialize this query straight to the bytes that `build` followed by
+    # `SerializeToString` would give, without any protobuf objects
+    def serialize(self):
+        buffers = [wire.term_type_field(self.tt)]
+        for arg in self.args:
+            buffers.append(wire.length_delimited(wire.TERM_ARGS, arg.serialize()))
+        for k in self.optargs.keys():
+            pair = wire.assoc_pair(k, self.optargs[k].serialize())
+            buffers.append(wire.length_delimited(wire.TERM_OPTARGS, pair))
+        return b''.join(buffers)
+
     # The following are all operators and methods that operate on
     # Rql queries to build up more complex operations
 
@@ -600,15 +660,35 @@ class RqlTzinfo(datetime.tzinfo):
     def dst(self, dt):
         return datetime.timedelta(0)
 
+    # Used by `datetime.fromtimestamp`. The default implementation calls back
+    # into `utcoffset` and `dst` for every conversion.
+    def fromutc(self, dt):
+        return dt + self.delta
+
+# RqlTzinfo objects are never modified, so times with the same offset share one
+rql_tzinfos = { }
+
+def rql_tzinfo(offsetstr):
+    tzinfo = rql_tzinfos.get(offsetstr)
+    if tzinfo is None:
+        tzinfo = RqlTzinfo(offsetstr)
+        rql_tzinfos[offsetstr] = tzinfo
+    return tzinfo
+
 def reql_type_time_to_datetime(obj):
     if not 'epoch_time' in obj:
         raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
 
     if 'timezone' in obj:
-        return datetime.datetime.fromtimestamp(obj['epoch_time'], RqlTzinfo(obj['timezone']))
+        return datetime.datetime.fromtimestamp(obj['epoch_time'], rql_tzinfo(obj['timezone']))
     else:
         return datetime.datetime.utcfromtimestamp(obj['epoch_time'])
 
+def reql_type_time_to_epoch(obj):
+    if not 'epoch_time' in obj:
+        raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
+    return obj['epoch_time']
+
 # Python only allows immutable built-in types to be hashed, such as for keys in a dict
 # This means we can't use lists or dicts as keys in grouped data objects, so we convert
 # them to tuples and frozensets, respectively.
@@ -625,7 +705,20 @@ def reql_type_grouped_data_to_object(obj):
     if not 'data' in obj:
         raise RqlDriverError('pseudo-type GROUPED_DATA object %s does not have the expected field "data".' % py_json.dumps(obj))
 
-    return dict([(recursively_make_hashable(k),v) for (k,v) in obj['data']])
+    # Most groups are keyed by strings or numbers, which are hashable as they
+    # are. Only if some key isn't are the keys converted one by one.
+    try:
+        return dict(obj['data'])
+    except TypeError:
+        return dict([(recursively_make_hashable(k) if isinstance(k, (list, dict)) else k, v)
+                     for (k, v) in obj['data']])
+
+# For group_format 'pairs', which keeps the server's order and leaves keys as
+# they are
+def reql_type_grouped_data_to_pairs(obj):
+    if not 'data' in obj:
+        raise RqlDriverError('pseudo-type GROUPED_DATA object %s does not have the expected field "data".' % py_json.dumps(obj))
+    return [(k, v) for (k, v) in obj['data']]
 
 # This class handles the conversion of RQL terminal types in both directions
 # Going to the server though it does not support R_ARRAY or R_OBJECT as those
@@ -658,6 +751,9 @@ class Datum(RqlQuery):
         else:
             raise RqlDriverError("Cannot build a query from a %s" % type(self.data).__name__)
 
+    def serialize(self):
+        return wire.datum_term(self.data)
+
     def compose(self, args, optargs):
         return repr(self.data)
 
@@ -670,12 +766,16 @@ class Datum(RqlQuery):
                 if time_format is None or time_format == 'native':
                     # Convert to native python datetime object
                     return reql_type_time_to_datetime(obj)
+                elif time_format == 'epoch':
+                    return reql_type_time_to_epoch(obj)
                 elif time_format != 'raw':
                     raise RqlDriverError("Unknown time_format run option \"%s\"." % time_format)
             elif reql_type == 'GROUPED_DATA':
                 group_format = format_opts.get('group_format')
                 if group_format is None or group_format == 'native':
                     return reql_type_grouped_data_to_object(obj)
+                elif group_format == 'pairs':
+                    return reql_type_grouped_data_to_pairs(obj)
                 elif group_format != 'raw':
                     raise RqlDriverError("Unknown group_format run option \"%s\"." % group_format)
             else:
@@ -694,12 +794,57 @@ class Datum(RqlQuery):
                 obj[i] = Datum._recursively_convert_pseudotypes(obj[i], format_opts)
         return obj
 
+    # Returns a function that decodes R_JSON strings according to the given
+    # format options. With the default `loads` pseudo-types are converted by an
+    # object hook as the string is parsed. A replacement `loads` (such as one
+    # from a faster JSON library) only has to take the string, and its result
+    # is walked afterwards. Strings that can't contain a pseudo-type, and all
+    # strings when both formats are 'raw', skip the conversion entirely.
+    @staticmethod
+    def json_decoder(format_opts, loads=None):
+        if format_opts.get('time_format') == 'raw' and format_opts.get('group_format') == 'raw':
+            return loads or py_json.loads
+
+        if loads is None:
+            def object_hook(obj):
+                if '$reql_type$' in obj:
+                    return Datum._convert_pseudotype(obj, format_opts)
+                return obj
+
+            def decode(s):
+                if '$reql_type$' not in s:
+                    return py_json.loads(s)
+                return py_json.loads(s, object_hook=object_hook)
+        else:
+            def decode(s):
+                obj = loads(s)
+                if '$reql_type$' not in s:
+                    return obj
+                return Datum._recursively_convert_pseudotypes(obj, format_opts)
+        return decode
+
+    # Decodes the rows of a cursor batch. Rows sent as JSON are joined into a
+    # single array and parsed with one call, rather than one call per row.
+    @staticmethod
+    def deconstruct_batch(datums, format_opts={}):
+        r_json = p.Datum.R_JSON
+        for datum in datums:
+            if datum.type != r_json:
+                return [Datum.deconstruct(datum, format_opts) for datum in datums]
+
+        decode = format_opts.get('json_decoder')
+        if decode is None:
+            decode = Datum.json_decoder(format_opts)
+        return decode('[' + ','.join([datum.r_str for datum in datums]) + ']')
+
     @staticmethod
     def deconstruct(datum, format_opts={}):
         d_type = datum.type
         if d_type == p.Datum.R_JSON:
-            obj = py_json.loads(datum.r_str)
-            return Datum._recursively_convert_pseudotypes(obj, format_opts)
+            decode = format_opts.get('json_decoder')
+            if decode is None:
+                decode = Datum.json_decoder(format_opts)
+            return decode(datum.r_str)
         elif d_type == p.Datum.R_OBJECT:
             obj = { }
             for pair in datum.r_object:
@@ -709,8 +854,7 @@ class Datum(RqlQuery):
             # be an object or something else. We need a second layer of type switching, this
             # time on an obfuscated field "$reql_type$" rather than the datum type field we
             # already switched on.
-            Datum._convert_pseudotype(obj, format_opts)
-            return obj
+            return Datum._convert_pseudotype(obj, format_opts)
         elif d_type == p.Datum.R_ARRAY:
             array = datum.r_array
             return [Datum.deconstruct(e, format_opts) for e in array]
@@ -961,6 +1105,13 @@ class Table(RqlQuery):
         return Insert(self, exprJSON(records), upsert=upsert,
                       durability=durability, return_vals=return_vals)
 
+    # Unlike `insert` this runs straight away, see `bulk.bulk_insert`
+    def bulk_insert(self, rows, c=None, batch_rows=200, batch_bytes=500000, concurrency=4,
+                    upsert=(), durability=()):
+        from .bulk import bulk_insert
+        return bulk_insert(self, rows, c, batch_rows, batch_bytes, concurrency,
+                           upsert=upsert, durability=durability)
+
     def get(self, key):
         return Get(self, key)
 
@@ -1331,17 +1482,37 @@ def func_wrap(val):
 
 class Func(RqlQuery):
     tt = p.Term.FUNC
-    lock = Lock()
-    nextVarId = 1
+
+    # Calling `next` on a count is atomic, so threads don't need a lock to
+    # get unique variable ids
+    var_ids = itertools.count(1)
+
+    # Terms of functions that have already been traced, see `set_func_cache`.
+    # Entries are kept in order of use, least recently used first.
+    cache = None
+    cache_size = 0
+    cache_lock = threading.Lock()
 
     def __init__(self, lmbd):
+        key = None
+        cache = Func.cache
+        if cache is not None:
+            key = Func._cache_key(lmbd)
+            if key is not None:
+                with Func.cache_lock:
+                    # Reinserting a hit moves it to the end
+                    cached = cache.pop(key, None)
+                    if cached is not None:
+                        cache[key] = cached
+                if cached is not None:
+                    (self.vrs, self.args) = cached
+                    self.optargs = {}
+                    return
+
         vrs = []
         vrids = []
         for i in range(lmbd.func_code.co_argcount):
-            Func.lock.acquire()
-            var_id = Func.nextVarId
-            Func.nextVarId += 1
-            Func.lock.release()
+            var_id = next(Func.var_ids)
             vrs.append(Var(var_id))
             vrids.append(var_id)
 
@@ -1349,9 +1520,50 @@ class Func(RqlQuery):
         self.args = [MakeArray(*vrids), expr(lmbd(*vrs))]
         self.optargs = {}
 
+        if key is not None:
+            with Func.cache_lock:
+                if key not in cache:
+                    while cache and len(cache) >= Func.cache_size:
+                        cache.popitem(last=False)
+                cache[key] = (self.vrs, self.args)
+
+    # Only plain functions that close over (and default to) primitive values
+    # can be cached, keyed on their code and those values. Types are part of
+    # the key since `1`, `1.0` and `True` are equal but give different terms.
+    @staticmethod
+    def _cache_key(lmbd):
+        if not isinstance(lmbd, types.FunctionType):
+            return None
+        values = []
+        for cell in lmbd.func_closure or ():
+            try:
+                values.append(cell.cell_contents)
+            except ValueError:
+                return None
+        values.extend(lmbd.func_defaults or ())
+        for val in values:
+            if type(val) not in func_cache_types:
+                return None
+        return (lmbd.func_code, tuple((type(val), val) for val in values))
+
     def compose(self, args, optargs):
             return T('lambda ', T(*[v.compose([v.args[0].compose(None, None)], []) for v in self.vrs], intsp=', '), ': ', args[1])
 
+func_cache_types = frozenset([types.NoneType, bool, int, long, float, str, unicode])
+
+# Cache the terms of the `size` most recently used traced functions (0 to
+# disable, which is the default). A function whose code and closure values have
+# been seen before then reuses the term tree instead of being called again. Only
+# enable this if the functions in your queries don't depend on global variables
+# or other state that changes between calls, since that isn't part of the key.
+def set_func_cache(size):
+    if size > 0:
+        Func.cache = collections.OrderedDict()
+        Func.cache_size = size
+    else:
+        Func.cache = None
+        Func.cache_size = 0
+
 class Asc(RqlTopLevelQuery):
     tt = p.Term.ASC
     st = 'asc'
@@ -1363,3 +1575,41 @@ class Desc(RqlTopLevelQuery):
 class Literal(RqlTopLevelQuery):
     tt = p.Term.LITERAL
     st = 'literal'
+
+# A query built once from a function of its parameters, see `r.prepare`.
+# The function's term tree is serialized when the query is prepared, and each
+# call only has to serialize the values bound to the parameters:
+#
+#     get_user = r.prepare(lambda key: r.table('users').get(key))
+#     get_user('bob').run(conn)
+class PreparedQuery(object):
+    def __init__(self, lmbd):
+        self.func = Func(lmbd)
+        self.arity = len(self.func.vrs)
+
+        # The start of a FUNCALL term: its type, then the function as its first argument
+        self.prefix = wire.term_type_field(p.Term.FUNCALL) + \
+                      wire.length_delimited(wire.TERM_ARGS, self.func.serialize())
+
+    def __call__(self, *args):
+        if len(args) != self.arity:
+            raise RqlDriverError("Prepared query expects %d arguments, got %d." % (self.arity, len(args)))
+        return BoundQuery(self, *args)
+
+# A prepared query together with values for its parameters. It is equivalent
+# to `r.do(*args, func)`, and is printed that way in errors.
+class BoundQuery(FunCall):
+    def __init__(self, prepared, *args):
+        FunCall.__init__(self, prepared.func, *args)
+        self.prepared = prepared
+
+    def compose(self, args, optargs):
+        if len(args) == 1:
+            return T('r.do(', args[0], ')')
+        return FunCall.compose(self, args, optargs)
+
+    def serialize(self):
+        buffers = [self.prepared.prefix]
+        for arg in self.args[1:]:
+            buffers.append(wire.length_delimited(wire.TERM_ARGS, arg.serialize()))
+        return b''.join(buffers)
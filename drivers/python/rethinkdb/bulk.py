@@ -0,0 +1,137 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['RowBatcher', 'bulk_insert']
+
+import itertools
+import json as py_json
+from collections import deque
+
+from rethinkdb import repl
+from rethinkdb.errors import *
+from rethinkdb.ast import Insert, Json, MakeArray, exprJSON
+from rethinkdb.pool import ConnectionPool
+
+# Groups encoded rows into batches of at most `batch_rows` rows, closing a
+# batch once its encoded rows add up to more than `batch_bytes`.
+class RowBatcher(object):
+    def __init__(self, batch_rows=200, batch_bytes=500000, encode=py_json.dumps, sizeof=len):
+        if batch_rows < 1:
+            raise RqlDriverError("batch_rows must be at least 1.")
+        self.batch_rows = batch_rows
+        self.batch_bytes = batch_bytes
+        self.encode = encode
+        self.sizeof = sizeof
+        self.rows = [ ]
+        self.size = 0
+
+    # Returns the finished batch if this row completed one, or None
+    def add(self, row):
+        encoded = self.encode(row)
+        self.rows.append(encoded)
+        self.size += self.sizeof(encoded)
+        if len(self.rows) >= self.batch_rows or self.size > self.batch_bytes:
+            return self.flush()
+        return None
+
+    # Returns the rows added since the last batch, which may be none
+    def flush(self):
+        batch = self.rows
+        self.rows = [ ]
+        self.size = 0
+        return batch
+
+# Rows that are plain JSON are sent as JSON text, anything else (such as rows
+# containing times or ReQL terms) falls back to `exprJSON`. Trying `dumps`
+# first saves walking every row twice, note that it turns numeric, boolean and
+# null object keys into strings where `exprJSON` would reject them.
+def _encode_row(row):
+    try:
+        return py_json.dumps(row)
+    except (TypeError, ValueError):
+        return exprJSON(row)
+
+# Terms are sized by their wire encoding, which is close to what they add to
+# the insert query
+def _sizeof_row(encoded):
+    if isinstance(encoded, basestring):
+        return len(encoded)
+    return len(encoded.serialize())
+
+def _batch_term(batch):
+    if all(isinstance(row, basestring) for row in batch):
+        return Json("[" + ",".join(batch) + "]")
+    return MakeArray(*[Json(row) if isinstance(row, basestring) else row for row in batch])
+
+def _merge_results(total, res):
+    for (k, v) in res.iteritems():
+        if k == 'first_error':
+            total.setdefault(k, v)
+        elif k == 'generated_keys':
+            total.setdefault(k, []).extend(v)
+        elif isinstance(v, (int, long, float)) and not isinstance(v, bool):
+            total[k] = total.get(k, 0) + v
+
+# Inserts the rows of any iterable into `table` in batches, keeping up to
+# `concurrency` batches in flight. With a `ConnectionPool` the batches are
+# spread over up to that many pooled connections, otherwise they are
+# pipelined on the one connection. Returns the insert results of all batches merged.
+def bulk_insert(table, rows, c=None, batch_rows=200, batch_bytes=500000, concurrency=4, **insert_opts):
+    if not c:
+        if repl.default_connection:
+            c = repl.default_connection
+        else:
+            raise RqlDriverError("bulk_insert must be given a connection or pool to run on.")
+    if concurrency < 1:
+        raise RqlDriverError("bulk_insert concurrency must be at least 1.")
+
+    if not isinstance(c, ConnectionPool):
+        return _run_batches(table, rows, [c], batch_rows, batch_bytes, concurrency, insert_opts)
+
+    conns = [ ]
+    try:
+        for i in xrange(min(concurrency, c.max_size)):
+            conns.append(c.checkout())
+        total = _run_batches(table, rows, conns, batch_rows, batch_bytes, concurrency, insert_opts)
+    except RqlDriverError:
+        for conn in conns:
+            c.checkin(conn, broken=True)
+        raise
+    except:
+        for conn in conns:
+            c.checkin(conn)
+        raise
+    for conn in conns:
+        c.checkin(conn)
+    return total
+
+def _run_batches(table, rows, conns, batch_rows, batch_bytes, concurrency, insert_opts):
+    total = {'inserted': 0, 'errors': 0}
+    in_flight = deque()
+    batcher = RowBatcher(batch_rows, batch_bytes, _encode_row, _sizeof_row)
+    next_conn = itertools.cycle(conns).next
+
+    def send(batch):
+        if len(in_flight) >= concurrency:
+            _merge_results(total, in_flight.popleft().result())
+        query = Insert(table, _batch_term(batch), **insert_opts)
+        in_flight.extend(next_conn().pipeline([query]))
+
+    try:
+        for row in rows:
+            batch = batcher.add(row)
+            if batch is not None:
+                send(batch)
+        batch = batcher.flush()
+        if len(batch) > 0:
+            send(batch)
+
+        while len(in_flight) > 0:
+            _merge_results(total, in_flight.popleft().result())
+    finally:
+        # Don't leave responses behind on the connections if a batch failed
+        for future in in_flight:
+            try:
+                future.result()
+            except Exception:
+                pass
+    return total
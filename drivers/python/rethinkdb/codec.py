@@ -0,0 +1,245 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Encodes queries and decodes responses for `net.Connection`. The C codec in
+# `_pbcpp` is used if it was built and passes a self-test against the pure
+# Python codec (`wire.encode_query` and the protobuf library's parser), which
+# is used otherwise. `implementation` says which one is in use, and
+# `self_test_error` why the C codec isn't. Running this module prints both,
+# and benchmarks the two codecs against each other:
+#
+#     python -m rethinkdb.codec
+
+__all__ = ['encode_query', 'decode_response', 'implementation', 'self_test_error',
+           'self_test', 'benchmark']
+
+import time
+import json as py_json
+
+from rethinkdb import ql2_pb2 as p
+from rethinkdb import wire
+
+try:
+    from rethinkdb import _pbcpp
+except ImportError:
+    _pbcpp = None
+
+def python_decode_response(data):
+    response = p.Response()
+    response.ParseFromString(data)
+    return response
+
+python_encode_query = wire.encode_query
+
+# Comparable forms of decoded messages
+
+def _datum_fields(datum):
+    if datum.type == p.Datum.R_BOOL:
+        value = datum.r_bool
+    elif datum.type == p.Datum.R_NUM:
+        value = datum.r_num
+    elif datum.type == p.Datum.R_STR or datum.type == p.Datum.R_JSON:
+        value = datum.r_str
+    elif datum.type == p.Datum.R_ARRAY:
+        value = [_datum_fields(d) for d in datum.r_array]
+    elif datum.type == p.Datum.R_OBJECT:
+        value = [(pair.key, _datum_fields(pair.val)) for pair in datum.r_object]
+    else:
+        value = None
+    return (datum.type, value)
+
+def _response_fields(response):
+    return (response.type, response.token, [_datum_fields(d) for d in response.response],
+            [(f.type, f.pos, f.opt) for f in response.backtrace.frames],
+            _datum_fields(response.profile), response.ByteSize())
+
+def _sample_queries():
+    from rethinkdb.ast import DB, expr
+    term = DB('test').table('foo').insert({'id': 1, u'n\xe4me': u'\u2603', 'tags': ['a', None, True]})
+    optargs = [('db', DB('test')), (u'durability', expr('soft')), ('use_outdated', expr(False))]
+
+    queries = [ ]
+    for (query_type, token, accepts_r_json, term, optargs) in \
+            [(p.Query.START, 1, True, term, optargs),
+             (p.Query.START, 2 ** 40, False, expr([1.5, 'x' * 300]), [ ]),
+             (p.Query.CONTINUE, 3, True, None, [ ]),
+             (p.Query.STOP, 4, False, None, [ ]),
+             (p.Query.NOREPLY_WAIT, 5, True, None, [ ])]:
+        expected = p.Query()
+        expected.type = query_type
+        expected.token = token
+        expected.accepts_r_json = accepts_r_json
+        if term is not None:
+            term.build(expected.query)
+        for (key, val) in optargs:
+            pair = expected.global_optargs.add()
+            pair.key = key
+            val.build(pair.val)
+        args = (query_type, token, accepts_r_json, term.serialize() if term is not None else None,
+                [(key, val.serialize()) for (key, val) in optargs])
+        queries.append((args, expected.SerializeToString()))
+    return queries
+
+def _sample_responses():
+    def datum(d, value):
+        if value is None:
+            d.type = p.Datum.R_NULL
+        elif isinstance(value, bool):
+            d.type = p.Datum.R_BOOL
+            d.r_bool = value
+        elif isinstance(value, float):
+            d.type = p.Datum.R_NUM
+            d.r_num = value
+        elif isinstance(value, basestring):
+            d.type = p.Datum.R_STR
+            d.r_str = value
+        elif isinstance(value, list):
+            d.type = p.Datum.R_ARRAY
+            for item in value:
+                datum(d.r_array.add(), item)
+        else:
+            d.type = p.Datum.R_OBJECT
+            for (k, v) in sorted(value.items()):
+                pair = d.r_object.add()
+                pair.key = k
+                datum(pair.val, v)
+
+    responses = [ ]
+
+    batch = p.Response()
+    batch.type = p.Response.SUCCESS_PARTIAL
+    batch.token = 7
+    for i in xrange(3):
+        d = batch.response.add()
+        d.type = p.Datum.R_JSON
+        d.r_str = py_json.dumps({'id': i, 'name': u'r\xf6w %d' % i})
+    responses.append(batch)
+
+    atom = p.Response()
+    atom.type = p.Response.SUCCESS_ATOM
+    atom.token = 2 ** 40
+    datum(atom.response.add(), {'a': [1.0, -2.5, 1e300, None, True, False],
+                                'b': {'c': u'\u2603', 'd': ''}, 'e': [[[]]]})
+    datum(atom.profile, [{'description': 'Evaluating datum.', 'duration(ms)': 0.005}])
+    responses.append(atom)
+
+    error = p.Response()
+    error.type = p.Response.RUNTIME_ERROR
+    error.token = 9
+    datum(error.response.add(), "No attribute `x` in object.")
+    frame = error.backtrace.frames.add()
+    frame.type = p.Frame.POS
+    frame.pos = 1
+    frame = error.backtrace.frames.add()
+    frame.type = p.Frame.OPT
+    frame.opt = 'default'
+    responses.append(error)
+
+    empty = p.Response()
+    empty.type = p.Response.WAIT_COMPLETE
+    empty.token = 3
+    responses.append(empty)
+
+    return [response.SerializeToString() for response in responses]
+
+# Checks a codec module against the protobuf library, returns a description
+# of the first difference found or None
+def self_test(module):
+    try:
+        for (args, expected) in _sample_queries():
+            res = module.encode_query(*args)
+            if res != expected:
+                return "encode_query%r gave %r rather than %r" % (args[:3], res, expected)
+
+        for data in _sample_responses():
+            expected = _response_fields(python_decode_response(data))
+            res = _response_fields(module.decode_response(data))
+            if res != expected:
+                return "decode_response gave %r rather than %r" % (res, expected)
+            res = _response_fields(module.decode_response(memoryview(data)))
+            if res != expected:
+                return "decode_response of a memoryview gave %r rather than %r" % (res, expected)
+    except Exception as e:
+        return "%s: %s" % (e.__class__.__name__, e)
+    return None
+
+if _pbcpp is None:
+    self_test_error = "rethinkdb._pbcpp is not installed"
+elif not hasattr(_pbcpp, 'decode_response'):
+    self_test_error = "rethinkdb._pbcpp was built without the codec"
+else:
+    self_test_error = self_test(_pbcpp)
+
+if self_test_error is None:
+    implementation = 'c'
+    encode_query = _pbcpp.encode_query
+    decode_response = _pbcpp.decode_response
+else:
+    implementation = 'python'
+    encode_query = python_encode_query
+    decode_response = python_decode_response
+
+# Times both codecs on a typical insert query, a batch of `rows` JSON rows and
+# an atom of nested datums. Returns the seconds per call for each, keyed by
+# codec and then by case.
+def benchmark(rows=100, iterations=2000):
+    from rethinkdb.ast import DB
+
+    term = DB('test').table('foo').insert([{'id': i, 'name': 'row %d' % i} for i in xrange(rows)])
+    query_args = (p.Query.START, 12345, True, term.serialize(), [('db', DB('test').serialize())])
+
+    batch = p.Response()
+    batch.type = p.Response.SUCCESS_PARTIAL
+    batch.token = 12345
+    for i in xrange(rows):
+        d = batch.response.add()
+        d.type = p.Datum.R_JSON
+        d.r_str = py_json.dumps({'id': i, 'name': 'row %d' % i, 'tags': ['a', 'b']})
+    batch_data = batch.SerializeToString()
+
+    atom = p.Response()
+    atom.type = p.Response.SUCCESS_ATOM
+    atom.token = 12345
+    array = atom.response.add()
+    array.type = p.Datum.R_ARRAY
+    for i in xrange(rows):
+        obj = array.r_array.add()
+        obj.type = p.Datum.R_OBJECT
+        for (key, num) in [('id', i), ('value', i * 0.5)]:
+            pair = obj.r_object.add()
+            pair.key = key
+            pair.val.type = p.Datum.R_NUM
+            pair.val.r_num = num
+    atom_data = atom.SerializeToString()
+
+    codecs = [('python', python_encode_query, python_decode_response)]
+    if self_test_error is None:
+        codecs.append(('c', _pbcpp.encode_query, _pbcpp.decode_response))
+
+    res = { }
+    for (name, encode, decode) in codecs:
+        timings = { }
+        for (case, call) in [('encode_query', lambda: encode(*query_args)),
+                             ('decode_batch', lambda: decode(batch_data)),
+                             ('decode_atom', lambda: decode(atom_data))]:
+            start = time.time()
+            for i in xrange(iterations):
+                call()
+            timings[case] = (time.time() - start) / iterations
+        res[name] = timings
+    return res
+
+def main():
+    from rethinkdb.net import protobuf_implementation
+    print("codec: %s" % implementation)
+    print("protobuf backend: %s" % protobuf_implementation)
+    print("self-test: %s" % ("passed" if self_test_error is None else self_test_error))
+
+    res = benchmark()
+    for case in ['encode_query', 'decode_batch', 'decode_atom']:
+        line = "%-14s python %8.1fus" % (case, res['python'][case] * 1e6)
+        if 'c' in res:
+            line += "   c %8.1fus   %5.1fx" % (res['c'][case] * 1e6, res['python'][case] / res['c'][case])
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['Columns', 'ColumnBuilder', 'ColumnSetBuilder']
+
+import array
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum
+
+# Results of queries run with `result_format='columnar'`. Rather than a dict
+# per row, the rows are turned into one typed buffer per field as each batch
+# is decoded:
+#
+#     cursor = r.table('trades').run(conn, result_format='columnar',
+#                                    columns=['price', 'size', 'time'])
+#     columns = cursor.to_columns()
+#     columns['price'].mean()
+#
+# Numbers are stored as float64 or int64, booleans as bools and anything else
+# (strings, objects, arrays, or a mix of types) as Python objects. Times are
+# stored as seconds since the epoch, without building a datetime for each
+# row. Rows that lack a field, or have it set to null, are marked in that
+# column's mask. With NumPy installed the columns and masks are NumPy arrays,
+# otherwise they are `array.array`s (and lists for objects).
+
+NoneType = type(None)
+
+# Python 2's `array` has no 'q' type code, 'l' is 64 bits on most platforms
+int64_typecode = 'l' if array.array('l').itemsize == 8 else None
+int64_min = -2 ** 63
+int64_max = 2 ** 63 - 1
+
+kind_typecodes = {'int': int64_typecode or 'd', 'float': 'd', 'bool': 'b'}
+kind_fill = {'int': 0, 'float': 0.0, 'bool': False, 'object': None}
+if numpy is not None:
+    kind_dtypes = {'int': numpy.int64 if int64_typecode else numpy.float64,
+                   'float': numpy.float64, 'bool': numpy.bool_}
+
+value_kinds = {int: 'int', long: 'int', float: 'float', bool: 'bool'}
+
+def _time_to_epoch(value):
+    if isinstance(value, dict) and value.get('$reql_type$') == 'TIME':
+        return value['epoch_time']
+    return value
+
+# The kind of a column that has held values of kind `kind` and now gets
+# values of the given types
+def _column_kind(kind, value_types):
+    kinds = set(value_kinds.get(t, 'object') for t in value_types)
+    if kind is not None:
+        kinds.add(kind)
+    if len(kinds) == 1:
+        return kinds.pop()
+    elif kinds == set(['int', 'float']):
+        return 'float'
+    return 'object'
+
+# The values of a single field. Values are added a batch at a time, and the
+# column's kind is widened (int to float, anything to object) as needed.
+class ColumnBuilder(object):
+    def __init__(self, format_opts={}, count=0):
+        self.format_opts = format_opts
+        self.kind = None   # Only missing values so far
+        self.values = None
+        self.mask = array.array('b', [1]) * count
+
+    def __len__(self):
+        return len(self.mask)
+
+    def extend(self, values):
+        value_types = set(map(type, values))
+        if dict in value_types:
+            values = map(_time_to_epoch, values)
+            value_types = set(map(type, values))
+
+        # Longs that don't fit in 64 bits can only be kept as objects
+        if long in value_types and any(isinstance(value, long) and not int64_min <= value <= int64_max
+                                       for value in values):
+            value_types.add(object)
+
+        missing = NoneType in value_types
+        value_types.discard(NoneType)
+        if len(value_types) > 0:
+            kind = _column_kind(self.kind, value_types)
+            if kind != self.kind:
+                self._convert(kind)
+
+        if self.kind is None:
+            self.mask.extend(array.array('b', [1]) * len(values))
+            return
+
+        if missing:
+            fill = kind_fill[self.kind]
+            self.mask.extend(array.array('b', [value is None for value in values]))
+            values = [fill if value is None else value for value in values]
+        else:
+            self.mask.extend(array.array('b', [0]) * len(values))
+
+        if self.kind == 'object' and (dict in value_types or list in value_types):
+            convert = Datum._recursively_convert_pseudotypes
+            format_opts = self.format_opts
+            values = [convert(value, format_opts) for value in values]
+        self.values.extend(values)
+
+    def _convert(self, kind):
+        count = len(self.mask)
+        if self.kind is None:
+            old = [kind_fill[kind]] * count
+        elif kind == 'object':
+            # Booleans are stored as bytes, and have to be turned back into bools
+            unbox = bool if self.kind == 'bool' else lambda value: value
+            old = [None if masked else unbox(value) for (value, masked) in zip(self.values, self.mask)]
+        else:
+            old = self.values
+
+        if kind == 'object':
+            self.values = list(old)
+        else:
+            self.values = array.array(kind_typecodes[kind], old)
+        self.kind = kind
+
+    # Returns the values and mask, as NumPy arrays if NumPy is installed
+    def finish(self):
+        count = len(self.mask)
+        kind = self.kind or 'object'
+        values = self.values if self.values is not None else [None] * count
+        if numpy is None:
+            return (values, self.mask)
+
+        if kind == 'object':
+            res = numpy.empty(count, dtype=object)
+            for (i, value) in enumerate(values):
+                res[i] = value
+        else:
+            res = numpy.frombuffer(values, dtype=kind_dtypes[kind])
+        return (res, numpy.frombuffer(self.mask, dtype=numpy.bool_))
+
+# Builds the columns of a whole result. Without `names` a column is made for
+# every field seen, and fields first seen part way through are marked missing
+# in the rows before.
+class ColumnSetBuilder(object):
+    def __init__(self, names=None, format_opts={}):
+        self.format_opts = format_opts
+        self.names = list(names) if names is not None else None
+        self.discover = names is None
+        self.columns = { }
+        self.count = 0
+        if not self.discover:
+            for name in self.names:
+                self.columns[name] = ColumnBuilder(format_opts)
+        else:
+            self.names = [ ]
+
+    def add_rows(self, rows):
+        for row in rows:
+            if not isinstance(row, dict):
+                raise RqlDriverError("Columnar results need every row to be an object, got %s." %
+                                     type(row).__name__)
+
+        if self.discover:
+            columns = self.columns
+            for row in rows:
+                for name in row:
+                    if name not in columns:
+                        columns[name] = ColumnBuilder(self.format_opts, self.count)
+                        self.names.append(name)
+
+        for name in self.names:
+            self.columns[name].extend([row.get(name) for row in rows])
+        self.count += len(rows)
+
+    def finish(self):
+        values = { }
+        masks = { }
+        for name in self.names:
+            (values[name], masks[name]) = self.columns[name].finish()
+        return Columns(self.names, values, masks, self.count)
+
+# A mapping of field names to column arrays, in the order the fields were
+# asked for (or first seen). `count` is the number of rows.
+class Columns(collections.Mapping):
+    def __init__(self, names, values, masks, count):
+        self.names = names
+        self.values = values
+        self.masks = masks
+        self.count = count
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "<Columns %s of %d rows>" % (self.names, self.count)
+
+    # True for each row that lacked the field or had it set to null
+    def mask(self, name):
+        return self.masks[name]
+
+    # The column as a NumPy masked array
+    def masked(self, name):
+        if numpy is None:
+            raise RqlDriverError("Masked columns require NumPy.")
+        return numpy.ma.masked_array(self.values[name], mask=self.masks[name])
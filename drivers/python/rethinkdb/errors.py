@@ -1,10 +1,21 @@
+import re
+
 from . import ql2_pb2 as p
 
+# The query of an error is only printed when the error is, since code that
+# catches and counts errors (such as bulk loaders) never needs it
 class RqlError(Exception):
     def __init__(self, message, term, frames):
         self.message = message
+        self.term = term
         self.frames = [frame.pos if frame.type == p.Frame.POS else frame.opt for frame in frames]
-        self.query_printer = QueryPrinter(term, self.frames)
+        self._query_printer = None
+
+    @property
+    def query_printer(self):
+        if self._query_printer is None:
+            self._query_printer = QueryPrinter(self.term, self.frames, max_array_items=20, max_string_length=200)
+        return self._query_printer
 
     def __str__(self):
         return self.__class__.__name__+": "+self.message+" in:\n"+self.query_printer.print_query()+'\n'+self.query_printer.print_carrots()
@@ -29,40 +40,120 @@ class RqlDriverError(Exception):
     def __str__(self):
         return self.message
 
+# Prints a query, and carrots under the term that `frames` lead to. Each
+# subtree is composed once, and the carrots line is built from the lengths of
+# the composed subtrees rather than by composing them again. With
+# `max_array_items`, literal arrays longer than that are printed with only
+# their first elements, and the element the frames lead into. With
+# `max_string_length`, longer string literals (such as the documents of a bulk
+# insert sent as `r.json`) are cut short, followed by their length.
 class QueryPrinter(object):
-    def __init__(self, root, frames=[]):
+    def __init__(self, root, frames=[], max_array_items=None, max_string_length=None):
         self.root = root
         self.frames = frames
+        self.max_array_items = max_array_items
+        self.max_string_length = max_string_length
+        self.composed = { }
+        self.composed_path = None
 
     def print_query(self):
-        return ''.join(self.compose_term(self.root))
+        return self._compose_path()[0]
 
     def print_carrots(self):
-        return ''.join(self.compose_carrots(self.root, self.frames))
+        return self._compose_path()[1]
+
+    def _compose_path(self):
+        if self.composed_path is None:
+            self.composed_path = self.compose_carrots(self.root, self.frames)
+        return self.composed_path
+
+    # The indexes of the arguments to print, with None where some are elided
+    def arg_indexes(self, term, frame=None):
+        count = len(term.args)
+        if self.max_array_items is None or count <= self.max_array_items or term.tt != p.Term.MAKE_ARRAY:
+            return range(count)
+
+        indexes = range(self.max_array_items)
+        if isinstance(frame, (int, long)) and frame >= self.max_array_items:
+            if frame > self.max_array_items:
+                indexes.append(None)
+            indexes.append(frame)
+        if indexes[-1] != count - 1:
+            indexes.append(None)
+        return indexes
+
+    def is_long_string(self, term):
+        data = getattr(term, 'data', None)
+        return self.max_string_length is not None and isinstance(data, basestring) and \
+               len(data) > self.max_string_length
 
     def compose_term(self, term):
-        args = [self.compose_term(a) for a in term.args]
-        optargs = {}
-        for name in term.optargs.keys():
-            optargs[name] = self.compose_term(term.optargs[name])
-        return term.compose(args, optargs)
-
+        res = self.composed.get(id(term))
+        if res is None:
+            if self.is_long_string(term):
+                res = repr(term.data[:self.max_string_length]) + '...<%d bytes>' % len(term.data)
+            else:
+                args = [self.compose_term(term.args[i]) if i is not None else '...'
+                        for i in self.arg_indexes(term)]
+                optargs = {}
+                for name in term.optargs.keys():
+                    optargs[name] = self.compose_term(term.optargs[name])
+                res = join(term.compose(args, optargs))
+            self.composed[id(term)] = res
+        return res
+
+    # Returns the composed term and its carrots line
     def compose_carrots(self, term, frames):
         # This term is the cause of the error
         if len(frames) == 0:
-            return ['^' for i in self.compose_term(term)]
+            res = self.compose_term(term)
+            return (res, '^' * len(res))
 
         cur_frame = frames[0]
-        args = [self.compose_carrots(arg, frames[1:]) if cur_frame == i else self.compose_term(arg) for i,arg in enumerate(term.args)]
+        args = []
+        carrot_args = []
+        for i in self.arg_indexes(term, cur_frame):
+            if i is None:
+                (arg, carrots) = ('...', '   ')
+            elif cur_frame == i:
+                (arg, carrots) = self.compose_carrots(term.args[i], frames[1:])
+            else:
+                arg = self.compose_term(term.args[i])
+                carrots = ' ' * len(arg)
+            args.append(arg)
+            carrot_args.append(carrots)
 
         optargs = {}
+        carrot_optargs = {}
         for name in term.optargs.keys():
             if cur_frame == name:
-                optargs[name] = self.compose_carrots(term.optargs[name], frames[1:])
+                (optargs[name], carrot_optargs[name]) = self.compose_carrots(term.optargs[name], frames[1:])
             else:
                 optargs[name] = self.compose_term(term.optargs[name])
-
-        return [' ' if i != '^' else '^' for i in term.compose(args, optargs)]
+                carrot_optargs[name] = ' ' * len(optargs[name])
+
+        res = join(term.compose(args, optargs))
+        carrots = non_carrots.sub(' ', join(term.compose(carrot_args, carrot_optargs)))
+        return (res, carrots)
+
+non_carrots = re.compile('[^^]')
+
+# Joins what `compose` returns: a string or a (nested) `T`
+def join(composed):
+    if isinstance(composed, basestring):
+        return composed
+    parts = []
+    composed.flatten(parts)
+    return ''.join(parts)
+
+def _flatten(token, parts):
+    if isinstance(token, basestring):
+        parts.append(token)
+    elif isinstance(token, T):
+        token.flatten(parts)
+    else:
+        for sub in token:
+            _flatten(sub, parts)
 
 # This 'enhanced' tuple recursively iterates over it's elements allowing us to
 # construct nested heirarchies that insert subsequences into tree. It's used
@@ -74,6 +165,14 @@ class T(object):
         self.seq = seq
         self.intsp = opts.pop('intsp', '')
 
+    # Appends the strings this is made of to `parts`, which is much faster
+    # than iterating over it
+    def flatten(self, parts):
+        for (i, token) in enumerate(self.seq):
+            if i > 0:
+                _flatten(self.intsp, parts)
+            _flatten(token, parts)
+
     def __iter__(self):
         itr = iter(self.seq)
         for sub in next(itr):
@@ -0,0 +1,111 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['DatumSequence', 'DatumObject', 'lazy_deconstruct']
+
+import collections
+
+from rethinkdb import ql2_pb2 as p
+from rethinkdb.ast import Datum
+
+# Results of queries run with `lazy=True`. The server is asked for protobuf
+# datums rather than JSON, and arrays and objects are returned as read-only
+# views over them that only decode the elements and fields that are used:
+#
+#     users = r.table('users').coerce_to('array').run(conn, lazy=True)
+#     names = [user['name'] for user in users]
+#     pairs = users.pluck('id', 'name')
+#
+# Objects that are pseudo-types (such as times) are decoded as usual.
+
+def lazy_deconstruct(datum, format_opts={}):
+    d_type = datum.type
+    if d_type == p.Datum.R_ARRAY:
+        return DatumSequence(datum.r_array, format_opts)
+    elif d_type == p.Datum.R_OBJECT:
+        for pair in datum.r_object:
+            if pair.key == '$reql_type$':
+                return Datum.deconstruct(datum, format_opts)
+        return DatumObject(datum, format_opts)
+    return Datum.deconstruct(datum, format_opts)
+
+class DatumSequence(collections.Sequence):
+    def __init__(self, datums, format_opts={}):
+        self.datums = datums
+        self.format_opts = format_opts
+
+    def __len__(self):
+        return len(self.datums)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DatumSequence(self.datums[index], self.format_opts)
+        return lazy_deconstruct(self.datums[index], self.format_opts)
+
+    def __iter__(self):
+        format_opts = self.format_opts
+        for datum in self.datums:
+            yield lazy_deconstruct(datum, format_opts)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Sequence) or isinstance(other, basestring):
+            return False
+        return len(self) == len(other) and all(a == b for (a, b) in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<DatumSequence of %d elements>" % len(self)
+
+    # Returns a dict of the given fields for each element, decoding nothing
+    # else. Elements that aren't objects are skipped.
+    def pluck(self, *fields):
+        res = []
+        for value in self:
+            if isinstance(value, DatumObject):
+                res.append(value.pluck(*fields))
+            elif isinstance(value, dict):
+                res.append(dict((k, value[k]) for k in fields if k in value))
+        return res
+
+    # Decodes all of the elements, as a non-lazy query would have
+    def to_list(self):
+        format_opts = self.format_opts
+        return [Datum.deconstruct(datum, format_opts) for datum in self.datums]
+
+class DatumObject(collections.Mapping):
+    def __init__(self, datum, format_opts={}):
+        self.datum = datum
+        self.format_opts = format_opts
+        self.index = None
+
+    def _pairs(self):
+        if self.index is None:
+            self.index = dict((pair.key, pair.val) for pair in self.datum.r_object)
+        return self.index
+
+    def __len__(self):
+        return len(self.datum.r_object)
+
+    def __getitem__(self, key):
+        return lazy_deconstruct(self._pairs()[key], self.format_opts)
+
+    def __contains__(self, key):
+        return key in self._pairs()
+
+    def __iter__(self):
+        for pair in self.datum.r_object:
+            yield pair.key
+
+    def __repr__(self):
+        return "<DatumObject with keys %s>" % list(self)
+
+    # Returns the given fields, fully decoded, as a dict
+    def pluck(self, *fields):
+        pairs = self._pairs()
+        format_opts = self.format_opts
+        return dict((k, Datum.deconstruct(pairs[k], format_opts)) for k in fields if k in pairs)
+
+    # Decodes the whole object, as a non-lazy query would have
+    def to_dict(self):
+        return Datum.deconstruct(self.datum, self.format_opts)
@@ -1,10 +1,12 @@
 # Copyright 2010-2012 RethinkDB, all rights reserved.
 
-__all__ = ['connect', 'Connection', 'Cursor', 'protobuf_implementation']
+__all__ = ['connect', 'Connection', 'Cursor', 'ColumnarCursor', 'QueryFuture', 'protobuf_implementation',
+           'codec_implementation']
 
 import errno
 import socket
 import struct
+import time
 from os import environ
 
 try:
@@ -18,7 +20,92 @@ from rethinkdb import ql2_pb2 as p
 from rethinkdb import repl # For the repl connection
 from rethinkdb.errors import *
 from rethinkdb.ast import Datum, DB, expr
-
+from rethinkdb.lazy import DatumSequence, lazy_deconstruct
+from rethinkdb.columnar import ColumnSetBuilder
+from rethinkdb import codec
+
+# Which codec queries and responses go through, 'c' or 'python' (see `codec.py`)
+codec_implementation = codec.implementation
+
+# The fields of a ql2 Query that the driver sets. Queries are serialized by
+# `codec.encode_query` rather than built as protobuf messages, so the global
+# optargs of START queries are pairs of keys and serialized terms.
+class Query(object):
+    def __init__(self, type, token, accepts_r_json=True, global_optargs=()):
+        self.type = type
+        self.token = token
+        self.accepts_r_json = accepts_r_json
+        self.global_optargs = global_optargs
+
+# Reads length-prefixed frames off a socket into a single reusable buffer with
+# `recv_into`, rather than one `recv` per small piece and repeated string
+# concatenation. Frames are returned as zero-copy views into the buffer which
+# stay valid until the next read. The buffer grows to fit large frames, and
+# goes back to `initial_size` once drained if it grew past `max_idle_size`.
+class FrameReader(object):
+    def __init__(self, recv_into, initial_size=64 * 1024, max_idle_size=1024 * 1024):
+        self.recv_into = recv_into
+        self.initial_size = initial_size
+        self.max_idle_size = max_idle_size
+        self.buf = bytearray(initial_size)
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        self._fill(4)
+        (frame_len,) = struct.unpack_from("<L", self.buf, self.start)
+        self._fill(4 + frame_len)
+
+        frame = buffer(self.buf, self.start + 4, frame_len)
+        self._consume(4 + frame_len)
+        return frame
+
+    def read_until(self, terminator):
+        pos = self.start
+        while True:
+            index = self.buf.find(terminator, pos, self.end)
+            if index != -1:
+                data = bytes(self.buf[self.start:index])
+                self._consume(index + len(terminator) - self.start)
+                return data
+            pos = self.end
+            self._fill(self.end - self.start + 1)
+
+    def _consume(self, length):
+        self.start += length
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            # Replaced rather than resized, a frame just returned may still
+            # be a view into the old buffer
+            if len(self.buf) > self.max_idle_size:
+                self.buf = bytearray(self.initial_size)
+
+    # Make sure at least `length` bytes are available from `self.start`
+    def _fill(self, length):
+        while self.end - self.start < length:
+            if self.start + length > len(self.buf):
+                pending = self.end - self.start
+                if length > len(self.buf):
+                    new_buf = bytearray(max(length, 2 * len(self.buf)))
+                    new_buf[0:pending] = self.buf[self.start:self.end]
+                    self.buf = new_buf
+                else:
+                    self.buf[0:pending] = self.buf[self.start:self.end]
+                self.start = 0
+                self.end = pending
+
+            received = self.recv_into(memoryview(self.buf)[self.end:])
+            if received == 0:
+                if self.start == self.end:
+                    raise RqlDriverError("Connection is closed.")
+                raise RqlDriverError("Connection is broken.")
+            self.end += received
+
+# Cursors keep up to `prefetch` CONTINUE requests ahead of the batch being
+# consumed (one by default), and stop prefetching while more than
+# `max_buffered_bytes` of responses are buffered. Both are taken from the
+# options passed to `run`, and are not sent to the server.
 class Cursor(object):
     def __init__(self, conn, query, term, format_opts, opts):
         self.conn = conn
@@ -30,47 +117,194 @@ class Cursor(object):
         self.outstanding_requests = 0
         self.end_flag = False
 
+        self.prefetch = opts.get('prefetch', 1)
+        self.max_buffered_bytes = opts.get('max_buffered_bytes')
+        self.buffered_sizes = [ ]
+        self.buffered_bytes = 0
+
     def _extend(self, response):
+        # Responses to requests still outstanding when the stream ended (or
+        # was stopped) carry nothing we need
+        if self.end_flag:
+            return
         self.end_flag = response.type != p.Response.SUCCESS_PARTIAL
         self.responses.append(response)
-
-        if len(self.responses) == 1 and not self.end_flag:
+        if self.end_flag and self.conn.observer is not None:
+            self.conn.observer.query_end(self.conn, self.query.token,
+                                         response.type == p.Response.SUCCESS_SEQUENCE)
+        if self.max_buffered_bytes is not None:
+            size = response.ByteSize()
+            self.buffered_sizes.append(size)
+            self.buffered_bytes += size
+
+        self._prefetch()
+
+    def _prefetch(self):
+        while not self.end_flag and \
+              self.outstanding_requests + len(self.responses) <= self.prefetch and \
+              (self.max_buffered_bytes is None or self.buffered_bytes < self.max_buffered_bytes):
             self.conn._async_continue_cursor(self)
 
-    def __iter__(self):
-        format_opts = self.format_opts
-        deconstruct = Datum.deconstruct
-        while True:
-            if len(self.responses) == 0 and not self.end_flag:
-                self.conn._continue_cursor(self)
-            if len(self.responses) == 1 and not self.end_flag:
-                self.conn._async_continue_cursor(self)
-
-            if len(self.responses) == 0 and self.end_flag:
-                break
+    # Waits for the next response to be buffered and checks it, returns False
+    # once the cursor is exhausted
+    def _wait_for_response(self):
+        while len(self.responses) == 0:
+            if self.end_flag:
+                return False
+            self.conn._continue_cursor(self)
+
+        response = self.responses[0]
+        self.conn._check_error_response(response, self.term)
+        if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+            raise RqlDriverError("Unexpected response type received for cursor")
+        return True
+
+    def _pop_response(self):
+        del self.responses[0]
+        if len(self.buffered_sizes) > 0:
+            self.buffered_bytes -= self.buffered_sizes.pop(0)
+        self._prefetch()
+
+    def _decode_rows(self, response):
+        if self.opts.get('lazy'):
+            return DatumSequence(response.response, self.format_opts)
+        return Datum.deconstruct_batch(response.response, self.format_opts)
+
+    def _decode_response(self, response):
+        observer = self.conn.observer
+        if observer is None:
+            return self._decode_rows(response)
+
+        start = time.time()
+        rows = self._decode_rows(response)
+        observer.decoded(self.conn, self.query.token, self.term.__class__.__name__,
+                         len(rows), time.time() - start)
+        return rows
 
-            self.conn._check_error_response(self.responses[0], self.term)
-            if self.responses[0].type != p.Response.SUCCESS_PARTIAL and self.responses[0].type != p.Response.SUCCESS_SEQUENCE:
-                raise RqlDriverError("Unexpected response type received for cursor")
-
-            for datum in self.responses[0].response:
-                yield deconstruct(datum, format_opts)
-            del self.responses[0]
+    def __iter__(self):
+        while self._wait_for_response():
+            for row in self._decode_response(self.responses[0]):
+                yield row
+            self._pop_response()
+
+    # Returns the rows of the next response as a list (or a `DatumSequence`
+    # for lazy queries), or None once the cursor is exhausted. Batches are as
+    # large as the server makes them.
+    def next_batch(self):
+        if not self._wait_for_response():
+            return None
+        batch = self._decode_response(self.responses[0])
+        self._pop_response()
+        return batch
 
     def close(self):
         if not self.end_flag:
             self.end_flag = True
+            if self.conn.observer is not None:
+                self.conn.observer.query_end(self.conn, self.query.token, True)
             self.conn._end_cursor(self)
 
+# The cursor of a query run with `result_format='columnar'` (see
+# `columnar.py`). Each batch is decoded with times left raw and turned into
+# columns, so iterating gives a `Columns` per batch, and `to_columns` reads
+# the rest of the cursor into a single `Columns`.
+class ColumnarCursor(Cursor):
+    def __init__(self, conn, query, term, format_opts, opts):
+        Cursor.__init__(self, conn, query, term, format_opts, opts)
+        self.columns = opts.get('columns')
+        self.raw_opts = {'time_format': 'raw', 'group_format': 'raw'}
+        self.raw_opts['json_decoder'] = Datum.json_decoder(self.raw_opts, conn.json_loads)
+
+    def _decode_rows(self, response):
+        return Datum.deconstruct_batch(response.response, self.raw_opts)
+
+    def __iter__(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            yield batch
+
+    def next_batch(self):
+        rows = Cursor.next_batch(self)
+        if rows is None:
+            return None
+        builder = ColumnSetBuilder(self.columns, self.format_opts)
+        builder.add_rows(rows)
+        return builder.finish()
+
+    def to_columns(self):
+        builder = ColumnSetBuilder(self.columns, self.format_opts)
+        while self._wait_for_response():
+            builder.add_rows(self._decode_response(self.responses[0]))
+            self._pop_response()
+        return builder.finish()
+
+# The result of a query sent through `Connection.pipeline`. The response is
+# filled in by whichever read on the connection happens to receive it, so
+# futures may be resolved in any order.
+class QueryFuture(object):
+    def __init__(self, conn, query, term, opts):
+        self.conn = conn
+        self.query = query
+        self.term = term
+        self.opts = opts
+        self.response = None
+        self.processed = False
+        self.value = None
+        self.error = None
+
+    def _set_response(self, response):
+        self.response = response
+
+    def done(self):
+        return self.response is not None
+
+    def result(self):
+        if self.opts.get('noreply'):
+            return None
+        if self.response is None:
+            if self.conn.future_cache.get(self.query.token) is not self:
+                raise RqlDriverError("Connection is closed.")
+            self.response = self.conn._read_response(self.query.token)
+            del self.conn.future_cache[self.query.token]
+
+        # The response is only processed once, so that a cursor isn't opened
+        # twice on the same token
+        if not self.processed:
+            self.processed = True
+            try:
+                self.value = self.conn._process_response(self.response, self.query, self.term, self.opts)
+            except Exception as err:
+                self.error = err
+        if self.error is not None:
+            raise self.error
+        return self.value
+
 class Connection(object):
-    def __init__(self, host, port, db, auth_key, timeout):
+    # Options understood by the driver itself rather than the server
+    _client_opt_args = ['prefetch', 'max_buffered_bytes', 'lazy', 'result_format', 'columns']
+
+    _cursor_class = Cursor
+    _columnar_cursor_class = ColumnarCursor
+
+    def __init__(self, host, port, db, auth_key, timeout, json_loads=None, observer=None):
+        self._init_state(host, port, db, auth_key, timeout, json_loads, observer)
+        self.reconnect(noreply_wait=False)
+
+    # Everything but opening the connection, shared with `AsyncConnection`
+    def _init_state(self, host, port, db, auth_key, timeout, json_loads, observer):
         self.socket = None
+        self.frame_reader = None
         self.host = host
         self.next_token = 1
         self.db = db
         self.auth_key = auth_key
         self.timeout = timeout
+        self.json_loads = json_loads
+        self.observer = observer
         self.cursor_cache = { }
+        self.future_cache = { }
 
         # Try to convert the port to an integer
         try:
@@ -78,8 +312,6 @@ class Connection(object):
         except ValueError as err:
           raise RqlDriverError("Could not convert port %s to an integer." % port)
 
-        self.reconnect(noreply_wait=False)
-
     def __enter__(self):
         return self
 
@@ -97,16 +329,13 @@ class Connection(object):
         except Exception as err:
             raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
 
-        self._sock_sendall(struct.pack("<L", p.VersionDummy.V0_2))
-        self._sock_sendall(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
+        self.frame_reader = FrameReader(self._sock_recv_into)
+
+        self._sock_sendall(struct.pack("<L", p.VersionDummy.V0_2) +
+                           struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
 
         # Read out the response from the server, which will be a null-terminated string
-        response = b""
-        while True:
-            char = self._sock_recv(1)
-            if char == b"\0":
-                break
-            response += char
+        response = self.frame_reader.read_until(b"\0")
 
         if response != b"SUCCESS":
             self.close(noreply_wait=False)
@@ -127,16 +356,18 @@ class Connection(object):
                 pass
             self.socket.close()
             self.socket = None
+            self.frame_reader = None
         self.cursor_cache = { }
+        self.future_cache = { }
+        if self.observer is not None:
+            self.observer.connection_closed(self)
 
     def noreply_wait(self):
         token = self.next_token
         self.next_token += 1
 
         # Construct query
-        query = p.Query()
-        query.type = p.Query.NOREPLY_WAIT
-        query.token = token
+        query = Query(p.Query.NOREPLY_WAIT, token)
 
         # Send the request
         return self._send_query(query, 'noreply_wait')
@@ -148,10 +379,10 @@ class Connection(object):
         repl.default_connection = self
         return self
 
-    def _sock_recv(self, length):
+    def _sock_recv_into(self, buf):
         while True:
             try:
-                return self.socket.recv(length)
+                return self.socket.recv_into(buf)
             except IOError as e:
                 if e.errno != errno.EINTR:
                     raise
@@ -165,13 +396,62 @@ class Connection(object):
                     raise
 
     def _start(self, term, **global_opt_args):
+        query = self._build_start(term, global_opt_args)
+        return self._send_query(query, term, global_opt_args)
+
+    # Send several queries back-to-back without waiting for any of them to
+    # complete. Returns a list of `QueryFuture`s in the same order as `terms`.
+    def pipeline(self, terms, **global_opt_args):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        futures = []
+        buffers = []
+        for term in terms:
+            opts = dict(global_opt_args)
+            term = expr(term)
+            query = self._build_start(term, opts)
+            buffers.append(self._serialize_query(query, term))
+            futures.append(QueryFuture(self, query, term, opts))
+
+        # Register the futures before anything is sent so that responses
+        # can be dispatched as soon as they start arriving
+        for future in futures:
+            if not future.opts.get('noreply'):
+                self.future_cache[future.query.token] = future
+
+        self._sock_sendall(b''.join(buffers))
+
+        if self.observer is not None:
+            for (future, buf) in zip(futures, buffers):
+                self._observe_sent(future.query, future.opts, len(buf))
+        return futures
+
+    def _build_start(self, term, global_opt_args):
+        result_format = global_opt_args.get('result_format', 'native')
+        if result_format == 'columnar':
+            if self._columnar_cursor_class is None:
+                raise RqlDriverError("Columnar results are not supported on this connection.")
+            if global_opt_args.get('lazy'):
+                raise RqlDriverError("The lazy and result_format='columnar' run options can't be combined.")
+        elif result_format != 'native':
+            raise RqlDriverError("Unknown result_format run option \"%s\"." % result_format)
+
+        # Checked here so that nothing is sent for a query that can't be read
+        prefetch = global_opt_args.get('prefetch', 1)
+        if not isinstance(prefetch, (int, long)) or prefetch < 1:
+            raise RqlDriverError("Cursor prefetch must be a positive integer.")
+        max_buffered_bytes = global_opt_args.get('max_buffered_bytes')
+        if max_buffered_bytes is not None and \
+           (not isinstance(max_buffered_bytes, (int, long)) or max_buffered_bytes < 1):
+            raise RqlDriverError("Cursor max_buffered_bytes must be a positive integer.")
+
         token = self.next_token
         self.next_token += 1
 
-        # Construct query
-        query = p.Query()
-        query.type = p.Query.START
-        query.token = token
+        if self.observer is not None:
+            self.observer.query_start(self, token, term.__class__.__name__)
 
         # Set global opt args
 
@@ -183,14 +463,12 @@ class Connection(object):
             if self.db:
                global_opt_args['db'] = DB(self.db)
 
-        for k,v in global_opt_args.items():
-            pair = query.global_optargs.add()
-            pair.key = k
-            expr(v).build(pair.val)
+        optargs = [(k, expr(v).serialize()) for (k, v) in global_opt_args.items()
+                   if k not in self._client_opt_args]
 
-        # Compile query to protobuf
-        term.build(query.query)
-        return self._send_query(query, term, global_opt_args)
+        # Construct query, the term itself is serialized by `_serialize_query`.
+        # Lazy results are decoded from protobuf datums as they are used.
+        return Query(p.Query.START, token, not global_opt_args.get('lazy', False), optargs)
 
     def _handle_cursor_response(self, response):
         cursor = self.cursor_cache[response.token]
@@ -201,46 +479,28 @@ class Connection(object):
             del self.cursor_cache[response.token]
 
     def _continue_cursor(self, cursor):
-        self._async_continue_cursor(cursor)
+        if cursor.outstanding_requests == 0:
+            self._async_continue_cursor(cursor)
         self._handle_cursor_response(self._read_response(cursor.query.token))
 
     def _async_continue_cursor(self, cursor):
         self.cursor_cache[cursor.query.token].outstanding_requests += 1
 
-        query = p.Query()
-        query.type = p.Query.CONTINUE
-        query.token = cursor.query.token
+        query = Query(p.Query.CONTINUE, cursor.query.token, cursor.query.accepts_r_json)
         self._send_query(query, cursor.term, cursor.opts, async=True)
 
     def _end_cursor(self, cursor):
         self.cursor_cache[cursor.query.token].outstanding_requests += 1
 
-        query = p.Query()
-        query.type = p.Query.STOP
-        query.token = cursor.query.token
-        self._send_query(cursor.query, cursor.term, async=True)
+        query = Query(p.Query.STOP, cursor.query.token, cursor.query.accepts_r_json)
+        self._send_query(query, cursor.term, async=True)
         self._handle_cursor_response(self._read_response(cursor.query.token))
 
     def _read_response(self, token):
         # We may get an async continue result, in which case we save it and read the next response
         while True:
-            response_buf = b''
             try:
-                response_header = b''
-                while len(response_header) < 4:
-                    chunk = self._sock_recv(4)
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is closed.")
-                    response_header += chunk
-
-                # The first 4 bytes give the expected length of this response
-                (response_len,) = struct.unpack("<L", response_header)
-
-                while len(response_buf) < response_len:
-                    chunk = self._sock_recv(response_len - len(response_buf))
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is broken.")
-                    response_buf += chunk
+                response_buf = self.frame_reader.read_frame()
             except KeyboardInterrupt as err:
                 # When interrupted while waiting for a response cancel the outstanding
                 # requests by resetting this connection
@@ -248,14 +508,17 @@ class Connection(object):
                 raise err
 
             # Construct response
-            response = p.Response()
-            response.ParseFromString(response_buf)
+            response = codec.decode_response(response_buf)
+            if self.observer is not None:
+                self._observe_response(response, len(response_buf))
 
             # Check that this is the response we were expecting
             if response.token == token:
                 return response
             elif response.token in self.cursor_cache:
                 self._handle_cursor_response(response)
+            elif response.token in self.future_cache:
+                self.future_cache.pop(response.token)._set_response(response)
             else:
                 # This response is corrupted or not intended for us.
                 raise RqlDriverError("Unexpected response received.")
@@ -277,17 +540,22 @@ class Connection(object):
             frames = backtrace.frames or []
             raise RqlClientError(message, term, frames)
 
+    def _serialize_query(self, query, term=None):
+        term_protobuf = term.serialize() if query.type == p.Query.START else None
+        query_protobuf = codec.encode_query(query.type, query.token, query.accepts_r_json,
+                                            term_protobuf, query.global_optargs)
+        return struct.pack("<L", len(query_protobuf)) + query_protobuf
+
     def _send_query(self, query, term, opts={}, async=False):
         # Error if this connection has closed
         if not self.socket:
             raise RqlDriverError("Connection is closed.")
 
-        query.accepts_r_json = True
-
         # Send protobuf
-        query_protobuf = query.SerializeToString()
-        query_header = struct.pack("<L", len(query_protobuf))
-        self._sock_sendall(query_header + query_protobuf)
+        query_buf = self._serialize_query(query, term)
+        self._sock_sendall(query_buf)
+        if self.observer is not None:
+            self._observe_sent(query, opts, len(query_buf))
 
         if 'noreply' in opts and opts['noreply']:
             return None
@@ -296,18 +564,53 @@ class Connection(object):
 
         # Get response
         response = self._read_response(query.token)
+        return self._process_response(response, query, term, opts)
 
-        self._check_error_response(response, term)
+    def _observe_sent(self, query, opts, size):
+        if query.type == p.Query.START:
+            self.observer.query_sent(self, query.token, size)
+            if opts.get('noreply'):
+                self.observer.query_end(self, query.token, True)
+
+    def _observe_response(self, response, size):
+        if response.token in self.cursor_cache:
+            self.observer.batch_received(self, response.token, size)
+        else:
+            self.observer.first_response(self, response.token, size)
+
+    # Arrays returned by columnar queries become `Columns`, any other value is
+    # returned as usual
+    def _deconstruct_columnar(self, datum, format_opts, columns):
+        raw_opts = {'time_format': 'raw', 'group_format': 'raw'}
+        raw_opts['json_decoder'] = Datum.json_decoder(raw_opts, self.json_loads)
+        value = Datum.deconstruct(datum, raw_opts)
+        if not isinstance(value, list):
+            return Datum._recursively_convert_pseudotypes(value, format_opts)
+        builder = ColumnSetBuilder(columns, format_opts)
+        builder.add_rows(value)
+        return builder.finish()
+
+    def _process_response(self, response, query, term, opts):
+        try:
+            self._check_error_response(response, term)
+        except RqlError:
+            if self.observer is not None:
+                self.observer.query_end(self, query.token, False)
+            raise
 
         format_opts = {}
         if 'time_format' in opts:
             format_opts['time_format'] = opts['time_format']
         if 'group_format' in opts:
             format_opts['group_format'] = opts['group_format']
+        format_opts['json_decoder'] = Datum.json_decoder(format_opts, self.json_loads)
 
         # Sequence responses
         if response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE:
-            value = Cursor(self, query, term, format_opts, opts)
+            if opts.get('result_format') == 'columnar':
+                value = self._columnar_cursor_class(self, query, term, format_opts, opts)
+            else:
+                value = self._cursor_class(self, query, term, format_opts, opts)
             self.cursor_cache[query.token] = value
             value._extend(response)
 
@@ -315,7 +618,20 @@ class Connection(object):
         elif response.type == p.Response.SUCCESS_ATOM:
             if len(response.response) < 1:
                 value = None
-            value = Datum.deconstruct(response.response[0], format_opts)
+            if opts.get('result_format') == 'columnar':
+                deconstruct = lambda datum, format_opts: \
+                    self._deconstruct_columnar(datum, format_opts, opts.get('columns'))
+            elif opts.get('lazy'):
+                deconstruct = lazy_deconstruct
+            else:
+                deconstruct = Datum.deconstruct
+            if self.observer is None:
+                value = deconstruct(response.response[0], format_opts)
+            else:
+                start = time.time()
+                value = deconstruct(response.response[0], format_opts)
+                self.observer.decoded(self, query.token, term.__class__.__name__, 1, time.time() - start)
+                self.observer.query_end(self, query.token, True)
 
         # Noreply_wait response
         elif response.type == p.Response.WAIT_COMPLETE:
@@ -334,5 +650,5 @@ class Connection(object):
             # response.profile does not exist
             return value
 
-def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20):
-    return Connection(host, port, db, auth_key, timeout)
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, json_loads=None, observer=None):
+    return Connection(host, port, db, auth_key, timeout, json_loads, observer)
@@ -0,0 +1,267 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# An event loop flavour of `net.Connection` and `net.Cursor`, built on asyncio
+# streams. Python 2 has no native asyncio, so this uses the `trollius` backport
+# and its `From`/`Return` coroutine syntax:
+#
+#     conn = yield From(r_async.connect(port=28015))
+#     count = yield From(r.table('foo').count().run(conn))
+#     cursor = yield From(r.table('foo').run(conn))
+#     while (yield From(cursor.fetch_next())):
+#         row = cursor.next()
+#
+# All queries on a connection share one socket, and their responses are
+# dispatched by token, so a single connection can have any number of queries
+# in flight at once.
+
+__all__ = ['connect', 'AsyncConnection', 'AsyncCursor']
+
+import struct
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    raise ImportError("The asyncio RethinkDB driver requires the `trollius` package.  " +
+                      "Please install it via `pip install trollius`.")
+
+from rethinkdb import ql2_pb2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.net import Connection, Cursor, Query
+from rethinkdb import codec
+
+class AsyncCursor(Cursor):
+    def __init__(self, conn, query, term, format_opts, opts):
+        Cursor.__init__(self, conn, query, term, format_opts, opts)
+        self.rows = [ ]
+        self.waiter = None
+
+    def _extend(self, response):
+        Cursor._extend(self, response)
+        self._wake()
+
+    def _wake(self, exception=None):
+        if self.waiter is not None and not self.waiter.done():
+            if exception is None:
+                self.waiter.set_result(None)
+            else:
+                self.waiter.set_exception(exception)
+
+    def __iter__(self):
+        raise RqlDriverError("Cannot iterate over an AsyncCursor.\n" +
+                             "Use `fetch_next` and `next` instead.")
+
+    # Returns True once a row is available from `next`, or False when the
+    # cursor has been exhausted.
+    @asyncio.coroutine
+    def fetch_next(self):
+        while len(self.rows) == 0:
+            if len(self.responses) > 0:
+                response = self.responses[0]
+                self.conn._check_error_response(response, self.term)
+                if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+                    raise RqlDriverError("Unexpected response type received for cursor")
+                self.rows = list(self._decode_response(response))
+                self.rows.reverse()
+                self._pop_response()
+            elif self.end_flag:
+                raise Return(False)
+            else:
+                if self.outstanding_requests == 0:
+                    self.conn._async_continue_cursor(self)
+                self.waiter = asyncio.Future(loop=self.conn._loop)
+                yield From(self.waiter)
+        raise Return(True)
+
+    def next(self):
+        if len(self.rows) == 0:
+            raise RqlDriverError("No row available, call `fetch_next` first.")
+        return self.rows.pop()
+
+    @asyncio.coroutine
+    def close(self):
+        if not self.end_flag:
+            self.end_flag = True
+            self.conn._end_cursor(self)
+            while self.query.token in self.conn.cursor_cache:
+                self.waiter = asyncio.Future(loop=self.conn._loop)
+                yield From(self.waiter)
+
+class AsyncConnection(Connection):
+    _cursor_class = AsyncCursor
+    _columnar_cursor_class = None
+
+    # Unlike `Connection`, constructing this does not open the connection,
+    # use the `connect` coroutine below instead.
+    def __init__(self, host, port, db, auth_key, timeout, json_loads=None, observer=None, loop=None):
+        self._init_state(host, port, db, auth_key, timeout, json_loads, observer)
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+
+    def __exit__(self, type, value, traceback):
+        self._close_now()
+
+    @asyncio.coroutine
+    def reconnect(self, noreply_wait=True):
+        yield From(self.close(noreply_wait))
+
+        try:
+            self._reader, self._writer = yield From(asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, loop=self._loop),
+                self.timeout, loop=self._loop))
+        except Exception as err:
+            raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
+
+        self._writer.write(struct.pack("<L", p.VersionDummy.V0_2))
+        self._writer.write(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
+
+        # Read out the response from the server, which will be a null-terminated
+        # string. Trollius has no `readuntil`, so it is read a byte at a time there.
+        if hasattr(self._reader, 'readuntil'):
+            response = yield From(self._reader.readuntil(b"\0"))
+            response = response[:-1]
+        else:
+            response = b""
+            while True:
+                char = yield From(self._reader.readexactly(1))
+                if char == b"\0":
+                    break
+                response += char
+
+        if response != b"SUCCESS":
+            self._close_now()
+            raise RqlDriverError("Server dropped connection with message: \"%s\"" % response.strip())
+
+        # Connection is now initialized, start dispatching responses
+        self.socket = self._writer.get_extra_info('socket')
+        self._reader_task = asyncio.ensure_future(self._read_responses(), loop=self._loop)
+
+    @asyncio.coroutine
+    def close(self, noreply_wait=True):
+        if self._writer is not None and noreply_wait:
+            yield From(self.noreply_wait())
+        self._close_now()
+
+    def _close_now(self, error=None):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+        self.socket = None
+
+        if error is None:
+            error = RqlDriverError("Connection is closed.")
+        for future in self.future_cache.values():
+            if not future.done():
+                future.set_exception(error)
+        for cursor in self.cursor_cache.values():
+            cursor.end_flag = True
+            cursor._wake(error)
+        self.cursor_cache = { }
+        self.future_cache = { }
+        if self.observer is not None:
+            self.observer.connection_closed(self)
+
+    @asyncio.coroutine
+    def noreply_wait(self):
+        token = self.next_token
+        self.next_token += 1
+
+        # Construct query
+        query = Query(p.Query.NOREPLY_WAIT, token)
+
+        # Send the request
+        response = yield From(self._send_query(query, 'noreply_wait'))
+        raise Return(self._process_response(response, query, 'noreply_wait', {}))
+
+    @asyncio.coroutine
+    def _start(self, term, **global_opt_args):
+        query = self._build_start(term, global_opt_args)
+        future = self._send_query(query, term, global_opt_args)
+        if future is None:
+            raise Return(None)
+        response = yield From(future)
+        raise Return(self._process_response(response, query, term, global_opt_args))
+
+    def pipeline(self, terms, **global_opt_args):
+        raise RqlDriverError("AsyncConnection does not need pipelining, queries run concurrently.")
+
+    def _continue_cursor(self, cursor):
+        raise RqlDriverError("Cannot block on an AsyncCursor, use `fetch_next` instead.")
+
+    def _end_cursor(self, cursor):
+        self.cursor_cache[cursor.query.token].outstanding_requests += 1
+
+        query = Query(p.Query.STOP, cursor.query.token, cursor.query.accepts_r_json)
+        self._send_query(query, cursor.term, async=True)
+
+    # Writes the query without blocking. Returns a future for the response
+    # unless no response is expected.
+    def _send_query(self, query, term, opts={}, async=False):
+        # Error if this connection has closed
+        if self._writer is None:
+            raise RqlDriverError("Connection is closed.")
+
+        query_buf = self._serialize_query(query, term)
+        self._writer.write(query_buf)
+        if self.observer is not None:
+            self._observe_sent(query, opts, len(query_buf))
+
+        if 'noreply' in opts and opts['noreply']:
+            return None
+        elif async:
+            return None
+
+        future = asyncio.Future(loop=self._loop)
+        self.future_cache[query.token] = future
+        return future
+
+    @asyncio.coroutine
+    def _read_responses(self):
+        try:
+            while True:
+                response_header = yield From(self._reader.readexactly(4))
+                (response_len,) = struct.unpack("<L", response_header)
+                response_buf = yield From(self._reader.readexactly(response_len))
+
+                # Construct response
+                response = codec.decode_response(response_buf)
+                if self.observer is not None:
+                    self._observe_response(response, len(response_buf))
+
+                if response.token in self.future_cache:
+                    future = self.future_cache.pop(response.token)
+                    if not future.cancelled():
+                        future.set_result(response)
+                elif response.token in self.cursor_cache:
+                    cursor = self.cursor_cache[response.token]
+                    self._handle_cursor_response(response)
+                    if response.token not in self.cursor_cache:
+                        cursor._wake()
+                else:
+                    # This response is corrupted or not intended for us.
+                    raise RqlDriverError("Unexpected response received.")
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self._reader_task = None
+            self._close_now()
+        except Exception as err:
+            self._reader_task = None
+            if not isinstance(err, RqlDriverError):
+                err = RqlDriverError("Connection is broken: %s" % err)
+            self._close_now(err)
+
+@asyncio.coroutine
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, json_loads=None, observer=None,
+            loop=None):
+    conn = AsyncConnection(host, port, db, auth_key, timeout, json_loads, observer, loop)
+    yield From(conn.reconnect(noreply_wait=False))
+    raise Return(conn)
@@ -0,0 +1,210 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['QueryObserver', 'HistogramObserver', 'Histogram']
+
+import time
+import threading
+
+# Receives events about the queries run on a connection, see `connect`'s
+# `observer` argument. Every callback is given the connection and the query's
+# token, which together identify a query. Callbacks are made from whichever
+# thread is using the connection, and should be quick.
+class QueryObserver(object):
+    # A query is about to be built. `term_type` is the class name of the
+    # outermost term, such as 'Insert' or 'Table'.
+    def query_start(self, conn, token, term_type):
+        pass
+
+    # The query has been written to the socket, `size` is its serialized size
+    def query_sent(self, conn, token, size):
+        pass
+
+    # The first response to a query has been received
+    def first_response(self, conn, token, size):
+        pass
+
+    # Another batch of a cursor has been received
+    def batch_received(self, conn, token, size):
+        pass
+
+    # `rows` rows of a response have been decoded in `decode_time` seconds.
+    # Cursor batches may be decoded after their query has ended.
+    def decoded(self, conn, token, term_type, rows, decode_time):
+        pass
+
+    # The query is complete: its result was decoded, it failed, the last
+    # batch of its cursor arrived or its cursor was closed. Queries run with
+    # `noreply` end as soon as they are sent.
+    def query_end(self, conn, token, success):
+        pass
+
+    # The connection was closed, queries still in flight on it won't end
+    def connection_closed(self, conn):
+        pass
+
+# A histogram of non-negative values in the style of HdrHistogram. Values are
+# counted in buckets that are exact below `2 * sub_buckets` and otherwise
+# within a relative error of `1 / sub_buckets`, so a histogram stays small
+# however widely the values are spread.
+class Histogram(object):
+    def __init__(self, unit=1e-6, sub_buckets=32):
+        self.unit = unit
+        self.sub_buckets = sub_buckets
+        self.sub_bucket_bits = sub_buckets.bit_length() - 1
+        if 1 << self.sub_bucket_bits != sub_buckets:
+            raise ValueError("sub_buckets must be a power of two")
+        self.counts = { }
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        index = self._index(int(value / self.unit))
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+    def _index(self, units):
+        shift = units.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return units
+        return (shift + 1) * self.sub_buckets + (units >> shift) - self.sub_buckets
+
+    # The largest value counted in the bucket at `index`
+    def _bucket_value(self, index):
+        if index < 2 * self.sub_buckets:
+            units = index
+        else:
+            shift = index // self.sub_buckets - 1
+            units = ((index % self.sub_buckets + self.sub_buckets + 1) << shift) - 1
+        return units * self.unit
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        wanted = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        for (index, n) in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        res = {"count": self.count, "min": self.min, "max": self.max,
+               "mean": self.total / self.count if self.count > 0 else None}
+        for percent in percentiles:
+            res["p%s" % percent] = self.percentile(percent)
+        return res
+
+# Keeps latency histograms and byte counts per outermost term type, and can
+# be shared by several connections (such as those of a `ConnectionPool`).
+#
+#     observer = HistogramObserver()
+#     conn = r.connect(observer=observer)
+#     ...
+#     observer.snapshot()['Insert']['latency']['p99']
+#
+# For each term type it records the time from the start of a query to its
+# end (`latency`), from the query being sent to its first response arriving
+# (`server`), and the time spent decoding results (`decode`).
+class HistogramObserver(QueryObserver):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = { }  # (conn, token) -> [term type, start time, sent time]
+        self.stats = { }
+
+    def _stats(self, term_type):
+        stats = self.stats.get(term_type)
+        if stats is None:
+            stats = {"latency": Histogram(), "server": Histogram(), "decode": Histogram(),
+                     "queries": 0, "errors": 0, "in_flight": 0, "rows": 0,
+                     "sent_bytes": 0, "received_bytes": 0, "batches": 0}
+            self.stats[term_type] = stats
+        return stats
+
+    def query_start(self, conn, token, term_type):
+        with self.lock:
+            self.pending[(conn, token)] = [term_type, time.time(), None]
+            self._stats(term_type)["in_flight"] += 1
+
+    def query_sent(self, conn, token, size):
+        with self.lock:
+            query = self.pending.get((conn, token))
+            if query is not None:
+                query[2] = time.time()
+                self.stats[query[0]]["sent_bytes"] += size
+
+    def first_response(self, conn, token, size):
+        with self.lock:
+            query = self.pending.get((conn, token))
+            if query is not None:
+                stats = self.stats[query[0]]
+                stats["received_bytes"] += size
+                if query[2] is not None:
+                    stats["server"].record(time.time() - query[2])
+
+    def batch_received(self, conn, token, size):
+        with self.lock:
+            query = self.pending.get((conn, token))
+            if query is not None:
+                stats = self.stats[query[0]]
+                stats["received_bytes"] += size
+                stats["batches"] += 1
+
+    def decoded(self, conn, token, term_type, rows, decode_time):
+        with self.lock:
+            stats = self._stats(term_type)
+            stats["rows"] += rows
+            stats["decode"].record(decode_time)
+
+    def query_end(self, conn, token, success):
+        with self.lock:
+            query = self.pending.pop((conn, token), None)
+            if query is None:
+                return
+            stats = self.stats[query[0]]
+            stats["queries"] += 1
+            stats["in_flight"] -= 1
+            if not success:
+                stats["errors"] += 1
+            stats["latency"].record(time.time() - query[1])
+
+    def connection_closed(self, conn):
+        with self.lock:
+            for key in [key for key in self.pending if key[0] is conn]:
+                self.stats[self.pending.pop(key)[0]]["in_flight"] -= 1
+
+    # Returns the statistics for each term type as plain dicts
+    def snapshot(self):
+        with self.lock:
+            res = { }
+            for (term_type, stats) in self.stats.iteritems():
+                res[term_type] = dict((k, v.summary() if isinstance(v, Histogram) else v)
+                                      for (k, v) in stats.iteritems())
+            return res
+
+    def reset(self):
+        with self.lock:
+            for stats in self.stats.itervalues():
+                for k in stats.keys():
+                    if isinstance(stats[k], Histogram):
+                        stats[k] = Histogram()
+                    elif k != "in_flight":
+                        stats[k] = 0
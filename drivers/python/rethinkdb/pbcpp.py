@@ -6,6 +6,10 @@ from os import environ
 # the C++ backend
 import rethinkdb._pbcpp
 
+# It is also built without the C++ backend, for its codec (see `codec.py`)
+if not getattr(rethinkdb._pbcpp, 'linked_ql2', True):
+    raise ImportError("rethinkdb._pbcpp was built without the C++ protobuf backend")
+
 # The google.protobuf package will activate the C++ backend only if this
 # variable is set to 'cpp'
 environ['PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION'] = 'cpp'
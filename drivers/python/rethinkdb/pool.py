@@ -0,0 +1,277 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['ConnectionPool']
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from rethinkdb.errors import *
+from rethinkdb.net import Connection
+
+# A thread safe pool of `Connection`s spread over one or more servers. Each
+# checked out connection is used by a single thread until it is checked back
+# in, so the usual `Connection` caveats about thread safety don't apply.
+#
+#     pool = ConnectionPool([('host1', 28015), 'host2:28015'], max_size=16)
+#     with pool.connection() as conn:
+#         r.table('foo').get(1).run(conn)
+class ConnectionPool(object):
+    def __init__(self, hosts=[('localhost', 28015)], max_size=8, db=None, auth_key="", timeout=20,
+                 max_idle_time=300, health_check_interval=30, balance='round_robin', json_loads=None,
+                 observer=None):
+        if len(hosts) == 0:
+            raise RqlDriverError("ConnectionPool requires at least one host.")
+        if max_size < 1:
+            raise RqlDriverError("ConnectionPool max_size must be at least 1.")
+        if balance not in ['round_robin', 'least_loaded']:
+            raise RqlDriverError("Unknown balance option \"%s\"." % balance)
+
+        self.hosts = [self._parse_host(host) for host in hosts]
+        self.max_size = max_size
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.json_loads = json_loads
+        self.observer = observer
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.balance = balance
+
+        self.lock = threading.Condition()
+        self.closed = False
+        self.idle = deque()     # (conn, last_used) pairs, most recently used on the right
+        self.host_of = { }      # conn -> index into self.hosts
+        self.host_open = [0] * len(self.hosts)
+        self.host_in_use = [0] * len(self.hosts)
+        self.size = 0
+        self.in_use = 0
+        self.next_host = 0
+
+        # Statistics, see `stats`
+        self.created_time = time.time()
+        self.last_change = self.created_time
+        self.busy_time = 0.0
+        self.checkouts = 0
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _parse_host(host):
+        if isinstance(host, tuple) or isinstance(host, list):
+            return (host[0], int(host[1]))
+        host_port = host.split(":")
+        if len(host_port) == 1:
+            return (host_port[0], 28015)
+        elif len(host_port) == 2:
+            return (host_port[0], int(host_port[1]))
+        raise RqlDriverError("Invalid 'host:port' format: %s" % host)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        except RqlDriverError:
+            self.checkin(conn, broken=True)
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    # Get a connection for the exclusive use of the calling thread, waiting up
+    # to `timeout` seconds (or forever if None) if the pool is exhausted.
+    def checkout(self, timeout=None):
+        start = time.time()
+        entry = None
+        host = None
+        waited = False
+        expired = []
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise RqlDriverError("ConnectionPool is closed.")
+                expired.extend(self._take_expired(time.time()))
+                if len(self.idle) > 0:
+                    entry = self._take_idle()
+                    break
+                elif self.size < self.max_size:
+                    host = self._pick_host()
+                    self.size += 1
+                    self.host_open[host] += 1
+                    break
+
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise RqlDriverError("Timed out waiting for a connection from the pool.")
+                waited = True
+                self.lock.wait(remaining)
+
+            wait_time = time.time() - start
+            self._account_busy(1)
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        self._close_all(expired)
+
+        try:
+            if entry is None:
+                conn = Connection(self.hosts[host][0], self.hosts[host][1], self.db, self.auth_key, self.timeout,
+                                  self.json_loads, self.observer)
+                with self.lock:
+                    self.host_of[conn] = host
+                    self.host_in_use[host] += 1
+                return conn
+            else:
+                (conn, last_used) = entry
+                self._check_health(conn, last_used)
+                return conn
+        except:
+            with self.lock:
+                if entry is None:
+                    self.host_open[host] -= 1
+                else:
+                    self.host_in_use[self.host_of[entry[0]]] -= 1
+                    self._forget(entry[0])
+                self.size -= 1
+                self._account_busy(-1)
+                self.lock.notify()
+            raise
+
+    # Return a connection to the pool. Connections that failed while checked
+    # out should be returned with `broken=True` so they are reconnected before
+    # they are handed out again.
+    def checkin(self, conn, broken=False):
+        if broken and conn.socket is not None:
+            conn.close(noreply_wait=False)
+
+        discard = False
+        with self.lock:
+            if conn not in self.host_of:
+                raise RqlDriverError("Connection does not belong to this pool.")
+            self.host_in_use[self.host_of[conn]] -= 1
+            self._account_busy(-1)
+            if self.closed:
+                self._forget(conn)
+                self.size -= 1
+                discard = True
+            else:
+                self.idle.append((conn, time.time()))
+            expired = self._take_expired(time.time())
+            self.lock.notify()
+
+        if discard:
+            expired.append(conn)
+        self._close_all(expired)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = [conn for (conn, last_used) in self.idle]
+            for conn in idle:
+                self._forget(conn)
+            self.size -= len(idle)
+            self.idle.clear()
+            self.lock.notify_all()
+        self._close_all(idle)
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            self._account_busy(0)
+            elapsed = now - self.created_time
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "utilisation": float(self.in_use) / self.max_size,
+                "average_utilisation": self.busy_time / (elapsed * self.max_size) if elapsed > 0 else 0.0,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "total_wait_time": self.total_wait_time,
+                "max_wait_time": self.max_wait_time,
+                "average_wait_time": self.total_wait_time / self.checkouts if self.checkouts > 0 else 0.0,
+                "reconnects": self.reconnects,
+                "evictions": self.evictions,
+                "hosts": [{"host": host, "port": port, "open": self.host_open[i], "in_use": self.host_in_use[i]}
+                          for (i, (host, port)) in enumerate(self.hosts)]
+            }
+
+    # The following helpers must be called with the lock held
+
+    def _pick_host(self):
+        if self.balance == 'least_loaded':
+            return min(range(len(self.hosts)), key=lambda i: (self.host_open[i], self.host_in_use[i]))
+        host = self.next_host
+        self.next_host = (self.next_host + 1) % len(self.hosts)
+        return host
+
+    def _take_idle(self):
+        if self.balance == 'least_loaded':
+            index = min(range(len(self.idle)), key=lambda i: self.host_in_use[self.host_of[self.idle[i][0]]])
+            entry = self.idle[index]
+            del self.idle[index]
+        else:
+            entry = self.idle.pop()
+        self.host_in_use[self.host_of[entry[0]]] += 1
+        return entry
+
+    # Idle connections are kept in least-recently-used order, so the expired
+    # ones are all at the left
+    def _take_expired(self, now):
+        expired = []
+        while len(self.idle) > 0 and now - self.idle[0][1] > self.max_idle_time:
+            (conn, last_used) = self.idle.popleft()
+            self._forget(conn)
+            self.size -= 1
+            self.evictions += 1
+            expired.append(conn)
+        return expired
+
+    def _forget(self, conn):
+        self.host_open[self.host_of.pop(conn)] -= 1
+
+    def _account_busy(self, delta):
+        now = time.time()
+        self.busy_time += self.in_use * (now - self.last_change)
+        self.last_change = now
+        self.in_use += delta
+
+    # The following helpers are called without the lock
+
+    def _check_health(self, conn, last_used):
+        if conn.socket is not None and time.time() - last_used > self.health_check_interval:
+            try:
+                conn.noreply_wait()
+            except (RqlDriverError, IOError):
+                conn.close(noreply_wait=False)
+
+        if conn.socket is None:
+            conn.reconnect(noreply_wait=False)
+            with self.lock:
+                self.reconnects += 1
+
+    def _close_all(self, conns):
+        for conn in conns:
+            try:
+                conn.close(noreply_wait=False)
+            except Exception:
+                pass
@@ -18,6 +18,9 @@ def do(arg0, *args):
     args = [arg0]+[x for x in args]
     return FunCall(func_wrap(args[-1]), *args[:-1])
 
+def prepare(func):
+    return PreparedQuery(func)
+
 row = ImplicitVar()
 
 def table(tbl_name, use_outdated=False):
@@ -0,0 +1,132 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Writes ql2 messages straight to protobuf wire format without building
+# message objects. The output is byte for byte what `SerializeToString` gives
+# for the same message, since that also writes fields in field number order.
+
+import struct
+import types
+import numbers
+
+from . import ql2_pb2 as p
+from .errors import *
+
+def encode_varint(value):
+    if value < 0x80:
+        return chr(value)
+    bits = value & 0x7f
+    value >>= 7
+    buffers = []
+    while value:
+        buffers.append(chr(0x80 | bits))
+        bits = value & 0x7f
+        value >>= 7
+    buffers.append(chr(bits))
+    return b''.join(buffers)
+
+# Keys of the fields we write, `(field number << 3) | wire type`
+QUERY_TYPE = b'\x08'
+QUERY_QUERY = b'\x12'
+QUERY_TOKEN = b'\x18'
+QUERY_ACCEPTS_R_JSON = b'\x28'
+QUERY_GLOBAL_OPTARGS = b'\x32'
+TERM_TYPE = b'\x08'
+TERM_DATUM = b'\x12'
+TERM_ARGS = b'\x1a'
+TERM_OPTARGS = b'\x22'
+ASSOC_PAIR_KEY = b'\x0a'
+ASSOC_PAIR_VAL = b'\x12'
+DATUM_TYPE = b'\x08'
+DATUM_R_BOOL = b'\x10'
+DATUM_R_NUM = b'\x19'
+DATUM_R_STR = b'\x22'
+
+def length_delimited(key, data):
+    size = len(data)
+    if size < 0x80:
+        return key + chr(size) + data
+    return key + encode_varint(size) + data
+
+term_type_fields = { }
+
+def term_type_field(term_type):
+    field = term_type_fields.get(term_type)
+    if field is None:
+        field = TERM_TYPE + encode_varint(term_type)
+        term_type_fields[term_type] = field
+    return field
+
+def assoc_pair(key, val_bytes):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return length_delimited(ASSOC_PAIR_KEY, key) + length_delimited(ASSOC_PAIR_VAL, val_bytes)
+
+# Serializes a Query from its type and token, whether it accepts R_JSON, its
+# serialized term (START queries only) and its global optargs as pairs of
+# keys and serialized terms. This is the pure Python version of the C codec's
+# `encode_query`, see `codec.py`.
+def encode_query(query_type, token, accepts_r_json, term=None, global_optargs=()):
+    parts = [QUERY_TYPE + encode_varint(query_type)]
+    if term is not None:
+        parts.append(length_delimited(QUERY_QUERY, term))
+    parts.append(QUERY_TOKEN + encode_varint(token))
+    parts.append(QUERY_ACCEPTS_R_JSON + (b'\x01' if accepts_r_json else b'\x00'))
+    for (key, val) in global_optargs:
+        parts.append(length_delimited(QUERY_GLOBAL_OPTARGS, assoc_pair(key, val)))
+    return b''.join(parts)
+
+# Serialized DATUM terms, picked by the exact type of the value
+
+def _datum_term(datum_bytes):
+    return term_type_field(p.Term.DATUM) + length_delimited(TERM_DATUM, datum_bytes)
+
+null_term = _datum_term(DATUM_TYPE + encode_varint(p.Datum.R_NULL))
+true_term = _datum_term(DATUM_TYPE + encode_varint(p.Datum.R_BOOL) + DATUM_R_BOOL + b'\x01')
+false_term = _datum_term(DATUM_TYPE + encode_varint(p.Datum.R_BOOL) + DATUM_R_BOOL + b'\x00')
+num_term_prefix = _datum_term(DATUM_TYPE + encode_varint(p.Datum.R_NUM) + DATUM_R_NUM + b'\0' * 8)[:-8]
+str_datum_prefix = DATUM_TYPE + encode_varint(p.Datum.R_STR) + DATUM_R_STR
+pack_double = struct.Struct('<d').pack
+
+def _null_term(val):
+    return null_term
+
+def _bool_term(val):
+    return true_term if val else false_term
+
+def _num_term(val):
+    return num_term_prefix + pack_double(val)
+
+def _str_term(val):
+    return _datum_term(str_datum_prefix + encode_varint(len(val)) + val)
+
+def _unicode_term(val):
+    return _str_term(val.encode('utf-8'))
+
+datum_term_serializers = {
+    types.NoneType: _null_term,
+    bool: _bool_term,
+    int: _num_term,
+    long: _num_term,
+    float: _num_term,
+    str: _str_term,
+    unicode: _unicode_term
+}
+
+def datum_term(val):
+    serializer = datum_term_serializers.get(type(val))
+    if serializer is not None:
+        return serializer(val)
+
+    # Subclasses of the above, with the same checks as `Datum.build`
+    if val == None:
+        return null_term
+    elif isinstance(val, bool):
+        return _bool_term(val)
+    elif isinstance(val, numbers.Real):
+        return _num_term(val)
+    elif isinstance(val, unicode):
+        return _unicode_term(val)
+    elif isinstance(val, str):
+        return _str_term(str(val))
+    else:
+        raise RqlDriverError("Cannot build a query from a %s" % type(val).__name__)
@@ -9,19 +9,30 @@ class build_ext_genproto(build_ext):
     # This class replaces the build_ext command with one that
     # first generates the ql2.pb.{cpp,h} files if the correct
     # environment variable is set.
+    #
+    # The extension also holds the driver's C codec, so it is
+    # built either way. If it can't be built the driver falls
+    # back to its pure Python codec.
 
     def build_extension(self, ext):
         if os.environ.get('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION') == 'cpp':
             print("Calling protoc to generate ql2.pb.cc and ql2.pb.h")
             check_call(['protoc', 'ql2.proto', '--cpp_out=.'])
             ext.sources = ['./ql2.pb.cc'] + ext.sources
+            ext.libraries = ['protobuf']
+            ext.define_macros = [('PBCPP_LINKED_QL2', '1')]
             build_ext.build_extension(self, ext)
-        else:
-            print("* * * * * * * * * * * * * * * * *")
-            print("* WARNING: The faster C++ protobuf backend is not enabled.")
-            print("* WARNING: To enable it, run `export PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp' and reinstall the rethinkdb package.")
-            print("* WARNING: See http://rethinkdb.com/docs/driver-performance/ for more information.")
-            print("* * * * * * * * * * * * * * * * *")
+            return
+
+        print("* * * * * * * * * * * * * * * * *")
+        print("* WARNING: The faster C++ protobuf backend is not enabled.")
+        print("* WARNING: To enable it, run `export PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp' and reinstall the rethinkdb package.")
+        print("* WARNING: See http://rethinkdb.com/docs/driver-performance/ for more information.")
+        print("* * * * * * * * * * * * * * * * *")
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            print("* WARNING: Could not build the C codec (%s), the pure Python one will be used." % e)
 
 setup(name="rethinkdb"
       ,version = "1.12.0-0"
@@ -31,6 +42,7 @@ setup(name="rethinkdb"
       ,maintainer_email = "bugs@rethinkdb.com"
       ,packages = ['rethinkdb']
       ,install_requires = ['protobuf']
+      ,extras_require = {'asyncio': ['trollius']}
       ,entry_points = {'console_scripts': [
           'rethinkdb-import = rethinkdb._import:main',
           'rethinkdb-dump = rethinkdb._dump:main',
@@ -40,5 +52,4 @@ setup(name="rethinkdb"
       ,ext_modules = [Extension(
           'rethinkdb/_pbcpp',
           sources=['./rethinkdb/_pbcpp.cpp'],
-          include_dirs=['./'],
-          libraries=['protobuf'])])
+          include_dirs=['./'])])
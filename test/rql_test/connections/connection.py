@@ -7,6 +7,7 @@ import socket
 import threading
 import SocketServer
 import datetime
+import json as py_json
 from sys import argv
 from subprocess import Popen
 from time import sleep, time
@@ -20,6 +21,20 @@ path.insert(0, "../../drivers/python")
 # need to test for it
 from rethinkdb import *
 import rethinkdb as r
+from rethinkdb import ql2_pb2 as p
+from rethinkdb import codec
+from rethinkdb.errors import QueryPrinter
+from rethinkdb.columnar import ColumnBuilder
+from rethinkdb.bulk import RowBatcher, _encode_row, _sizeof_row
+from rethinkdb.net import FrameReader
+import struct
+
+try:
+    import trollius
+    from trollius import From, Return
+    from rethinkdb import net_asyncio
+except ImportError:
+    trollius = None
 
 server_build_dir = argv[1]
 use_default_port = bool(int(argv[2]))
@@ -64,6 +79,175 @@ class TestNoConnection(unittest.TestCase):
             RqlDriverError, "Could not connect to 0.0.0.0:28015.",
             r.connect, host="0.0.0.0", port=28015, auth_key="hunter2")
 
+class TestSerialization(unittest.TestCase):
+    # The direct serializer must give exactly what the protobuf library does
+    def test_serialize(self):
+        time1 = datetime.datetime(2014, 1, 1, tzinfo=r.make_timezone('+01:00'))
+        queries = [r.expr(None), r.expr(True), r.expr(False), r.expr(-2.5), r.expr(2**60),
+                   r.expr('abc'), r.expr(u'h\xe9llo' * 100),
+                   r.expr({'a':[1, 2, {'b':None}], u'\xfc':'x' * 300}),
+                   r.table('t').filter(lambda x: x['a'] > 5).map(r.row['b']).limit(10),
+                   r.table('t', use_outdated=True).insert([{'id':i, 'time':time1} for i in xrange(0, 50)], upsert=True),
+                   r.db('d').table('t').get_all(1, 2, index='x'),
+                   r.prepare(lambda a, b: r.expr(a) + b)(1, [2, 3])]
+        for query in queries:
+            term = p.Term()
+            query.build(term)
+            self.assertEqual(query.serialize(), term.SerializeToString())
+
+class TestCodec(unittest.TestCase):
+    # Both codecs must agree with the protobuf library, the C one only
+    # being tested where it was built
+    def test_codec(self):
+        self.assertIsNone(codec.self_test(codec))
+        if codec._pbcpp is not None:
+            self.assertEqual(codec.implementation, 'c', codec.self_test_error)
+            self.assertEqual(r.codec_implementation, 'c')
+
+        query = p.Query()
+        query.type = p.Query.START
+        query.token = 5
+        query.accepts_r_json = True
+        r.table('t').build(query.query)
+        pair = query.global_optargs.add()
+        pair.key = 'db'
+        r.db('d').build(pair.val)
+        self.assertEqual(codec.encode_query(p.Query.START, 5, True, r.table('t').serialize(),
+                                            [('db', r.db('d').serialize())]),
+                         query.SerializeToString())
+
+        response = p.Response()
+        response.type = p.Response.SUCCESS_ATOM
+        response.token = 5
+        response.response.add().type = p.Datum.R_NULL
+        decoded = codec.decode_response(response.SerializeToString())
+        self.assertEqual((decoded.type, decoded.token, len(decoded.response)), (p.Response.SUCCESS_ATOM, 5, 1))
+
+class TestFrameReader(unittest.TestCase):
+    def runTest(self):
+        frames = ['a' * 10, 'b' * 5000, 'c' * 10]
+        data = [''.join(struct.pack("<L", len(frame)) + frame for frame in frames)]
+        def recv_into(view):
+            received = min(len(view), len(data[0]), 100)
+            view[0:received] = data[0][:received]
+            data[0] = data[0][received:]
+            return received
+
+        reader = FrameReader(recv_into, initial_size=16, max_idle_size=1024)
+        self.assertEqual(str(reader.read_frame()), frames[0])
+
+        # The buffer grows for a large frame, and shrinks back once it is drained
+        big = reader.read_frame()
+        self.assertEqual(len(reader.buf), 16)
+        self.assertEqual(str(big), frames[1])
+        self.assertEqual(str(reader.read_frame()), frames[2])
+        self.assertRaisesRegexp(r.RqlDriverError, "Connection is closed.", reader.read_frame)
+
+class TestQueryPrinter(unittest.TestCase):
+    def test_lazy_error(self):
+        query = r.table('t').insert([{'id':i} for i in xrange(0, 1000)])
+        err = RqlRuntimeError('boom', query, [])
+        self.assertIsNone(err._query_printer)
+        self.assertTrue(str(err).startswith('boom in:\n'))
+        self.assertIsNotNone(err._query_printer)
+
+    def test_carrots(self):
+        query = r.expr(1) + 2 == 3
+        printer = QueryPrinter(query, [0, 1])
+        self.assertEqual(printer.print_query(), '((r.expr(1) + r.expr(2)) == r.expr(3))')
+        self.assertEqual(printer.print_carrots(), '                     ^                ')
+
+    def test_elide_arrays(self):
+        query = r.expr([r.expr(i) + 1 for i in xrange(0, 100)])
+        printer = QueryPrinter(query, [50, 0], max_array_items=2)
+        self.assertEqual(printer.print_query(), '[(r.expr(0) + r.expr(1)), (r.expr(1) + r.expr(1)), ..., (r.expr(50) + r.expr(1)), ...]')
+        carrot = printer.print_query().index('50')
+        self.assertEqual(printer.print_carrots(), ' ' * carrot + '^^' + ' ' * (len(printer.print_query()) - carrot - 2))
+        self.assertEqual(len(str(query)), len(QueryPrinter(query).print_query()))
+
+    def test_elide_strings(self):
+        rows = [{'id':i, 'name':'user%d' % i} for i in xrange(0, 5000)]
+
+        # Catch the error of the insert bulk_insert builds, as if the server had sent one
+        class FailedInsert:
+            def __init__(self, query):
+                self.query = query
+            def result(self):
+                raise RqlRuntimeError('boom', self.query, [])
+        class FailingConnection:
+            def pipeline(self, queries):
+                return [FailedInsert(query) for query in queries]
+
+        self.assertRaises(RqlRuntimeError, r.table('t').bulk_insert, rows, FailingConnection(),
+                          batch_rows=5000, batch_bytes=10000000)
+        try:
+            r.table('t').bulk_insert(rows, FailingConnection(), batch_rows=5000, batch_bytes=10000000)
+        except RqlRuntimeError as ex:
+            bulk_query = ex.term
+
+        for query in [bulk_query, r.table('t').insert(r.exprJSON(rows))]:
+            message = str(RqlRuntimeError('boom', query, []))
+            self.assertLess(len(message), 1000)
+            self.assertRegexpMatches(message, r"\.\.\.<\d{6} bytes>")
+        self.assertEqual(len(str(bulk_query)), len(QueryPrinter(bulk_query).print_query()))
+
+class TestFuncCache(unittest.TestCase):
+    def tearDown(self):
+        r.set_func_cache(0)
+
+    def test_func_cache(self):
+        query = lambda n: r.table('t').filter(lambda row: row['a'] > n)
+        self.assertIsNot(query(5).args[1], query(5).args[1])
+
+        r.set_func_cache(10)
+        self.assertIs(query(5).args[1].args[1], query(5).args[1].args[1])
+        self.assertIsNot(query(5).args[1].args[1], query(6).args[1].args[1])
+        self.assertIsNot(query(1).args[1].args[1], query(True).args[1].args[1])
+        self.assertEqual(query(5).serialize(), query(5).serialize())
+
+    def test_evicts_least_recently_used(self):
+        query = lambda n: r.table('t').filter(lambda row: row['a'] > n)
+        r.set_func_cache(2)
+        func1 = query(1).args[1].args[1]
+        func2 = query(2).args[1].args[1]
+        self.assertIs(query(1).args[1].args[1], func1)
+        query(3)
+        self.assertIs(query(1).args[1].args[1], func1)
+        self.assertIsNot(query(2).args[1].args[1], func2)
+
+class TestColumnBuilder(unittest.TestCase):
+    def test_widen_bool(self):
+        builder = ColumnBuilder()
+        builder.extend([True, False])
+        builder.extend(['x', None])
+        (values, mask) = builder.finish()
+        self.assertEqual(builder.kind, 'object')
+        self.assertEqual([type(value) for value in values], [bool, bool, str, type(None)])
+        self.assertEqual(list(values), [True, False, 'x', None])
+        self.assertEqual(list(mask), [0, 0, 0, 1])
+
+    def test_long(self):
+        builder = ColumnBuilder()
+        builder.extend([1, 2L, 2 ** 62])
+        self.assertEqual(builder.kind, 'int')
+        builder.extend([2 ** 64])
+        self.assertEqual(builder.kind, 'object')
+        self.assertEqual(list(builder.finish()[0]), [1, 2, 2 ** 62, 2 ** 64])
+
+class TestRowBatcher(unittest.TestCase):
+    def runTest(self):
+        # Rows that are terms count towards batch_bytes as well
+        batcher = RowBatcher(batch_rows=100, batch_bytes=2500, encode=_encode_row, sizeof=_sizeof_row)
+        row = {'value':'x' * 1000, 'time':r.epoch_time(1375115782.24)}
+        self.assertGreater(_sizeof_row(_encode_row(row)), 1000)
+        self.assertEqual(batcher.add(row), None)
+        self.assertEqual(batcher.add(row), None)
+        self.assertEqual(len(batcher.add(row)), 3)
+
+        self.assertEqual(py_json.loads(_encode_row({'id':1, 'tags':['a', None]})), {'id':1, 'tags':['a', None]})
+        self.assertTrue(isinstance(_encode_row(row), r.RqlQuery))
+        self.assertTrue(isinstance(_encode_row({'id':1, 'nested':[{'q':r.expr(1)}]}), r.RqlQuery))
+
 class TestConnectionDefaultPort(unittest.TestCase):
 
     def setUp(self):
@@ -314,6 +498,63 @@ class TestConnection(TestWithConnection):
             "Could not convert port abc to an integer.",
             lambda: r.connect(port='abc'))
 
+class TestPipelining(TestWithConnection):
+    def test_pipeline(self):
+        c = r.connect(port=self.port)
+        futures = c.pipeline([r.expr(i) for i in xrange(100)])
+        self.assertEqual([f.result() for f in reversed(futures)], range(99, -1, -1))
+
+    def test_pipeline_interleaved(self):
+        c = r.connect(port=self.port)
+        futures = c.pipeline([r.js('while(true);', timeout=0.2), r.expr(2)])
+
+        # Blocking queries still work while pipelined queries are outstanding
+        self.assertEqual(r.expr(1).run(c), 1)
+        self.assertEqual(futures[1].result(), 2)
+        self.assertRaises(r.RqlRuntimeError, futures[0].result)
+
+    def test_pipeline_result_twice(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 3000)]).run(c)
+
+        futures = c.pipeline([r.table('t1'), r.error('fail')])
+        cursor = futures[0].result()
+        self.assertIs(futures[0].result(), cursor)
+        self.assertEqual(sorted(row['id'] for row in cursor), range(0, 3000))
+        self.assertRaises(r.RqlRuntimeError, futures[1].result)
+        self.assertRaises(r.RqlRuntimeError, futures[1].result)
+
+    def test_pipeline_closed(self):
+        c = r.connect(port=self.port)
+        futures = c.pipeline([r.expr(1)])
+        c.close(noreply_wait=False)
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection is closed.",
+            futures[0].result)
+
+class TestConnectionPool(TestWithConnection):
+    def test_pool(self):
+        pool = r.ConnectionPool([('localhost', self.port)], max_size=2)
+        conns = [pool.checkout(), pool.checkout()]
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Timed out waiting for a connection from the pool.",
+            pool.checkout, timeout=0.1)
+
+        # A broken connection is reconnected before it is handed out again
+        conns[0].close(noreply_wait=False)
+        for c in conns:
+            pool.checkin(c)
+        for i in xrange(4):
+            with pool.connection() as c:
+                self.assertEqual(r.expr(i).run(c), i)
+
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['checkouts'], 6)
+        pool.close()
+
 class TestShutdown(TestWithConnection):
     def test_shutdown(self):
         c = r.connect(port=self.port)
@@ -373,6 +614,42 @@ class TestBatching(TestWithConnection):
         self.assertGreaterEqual(len(cursor.responses), 1)
         self.assertGreaterEqual(len(cursor.responses[0].response), 1)
 
+class TestPrefetch(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        r.db('test').table_create('t1').run(c)
+        t1 = r.table('t1')
+        t1.insert([{'id':i} for i in xrange(0, 3000)]).run(c)
+
+        cursor = t1.run(c, prefetch=3)
+        self.assertEqual(cursor.outstanding_requests, 3)
+        self.assertEqual(sorted(row['id'] for row in cursor), range(0, 3000))
+
+        # Nothing past the first response is requested while over budget
+        cursor = t1.run(c, prefetch=3, max_buffered_bytes=1)
+        self.assertEqual(cursor.outstanding_requests, 0)
+
+        ids = [ ]
+        batch = cursor.next_batch()
+        while batch is not None:
+            self.assertGreater(len(batch), 0)
+            ids.extend(row['id'] for row in batch)
+            batch = cursor.next_batch()
+        self.assertEqual(sorted(ids), range(0, 3000))
+        self.assertEqual(cursor.next_batch(), None)
+
+        # Bad options are rejected before the query is sent
+        token = c.next_token
+        self.assertRaisesRegexp(
+            RqlDriverError, "Cursor prefetch must be a positive integer.",
+            t1.run, c, prefetch=0)
+        self.assertRaisesRegexp(
+            RqlDriverError, "Cursor max_buffered_bytes must be a positive integer.",
+            t1.run, c, max_buffered_bytes=0)
+        self.assertEqual(c.next_token, token)
+        self.assertEqual(t1.count().run(c), 3000)
+
 class TestGroupWithTimeKey(TestWithConnection):
     def runTest(self):
         c = r.connect(port=self.port)
@@ -397,20 +674,307 @@ class TestGroupWithTimeKey(TestWithConnection):
         groups = r.table('times').group('time').coerce_to('array').run(c)
         self.assertEqual(groups, {dt1:[expected_row1],dt2:[expected_row2]})
 
+class TestJsonLoads(TestWithConnection):
+    def runTest(self):
+        decoded = [ ]
+        def loads(s):
+            decoded.append(s)
+            return py_json.loads(s)
+        c = r.connect(port=self.port, json_loads=loads)
+
+        t = r.epoch_time(1375115782.24).in_timezone('+00:00')
+        row = r.expr({'id':1, 'time':t}).run(c)
+        self.assertEqual(row['time'], t.run(c))
+        self.assertEqual(r.expr({'id':1, 'time':t}).run(c, time_format='raw')['time']['$reql_type$'], 'TIME')
+        self.assertEqual(len(decoded), 3)
+
+
+class TestPrepare(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        r.db('test').table_create('prepared').run(c)
+        t = r.table('prepared')
+        t.insert([{'id':i, 'name':'user%d' % i} for i in xrange(0, 10)]).run(c)
+
+        get_name = r.prepare(lambda key: t.get(key)['name'])
+        self.assertEqual([get_name(i).run(c) for i in xrange(0, 10)], ['user%d' % i for i in xrange(0, 10)])
+        self.assertEqual([f.result() for f in c.pipeline([get_name(1), get_name(2)])], ['user1', 'user2'])
+
+        between = r.prepare(lambda lo, hi: t.between(lo, hi).count())
+        self.assertEqual(between(2, 5).run(c), 3)
+
+        self.assertRaisesRegexp(
+            RqlDriverError, "Prepared query expects 2 arguments, got 1.",
+            between, 1)
+        self.assertRaises(r.RqlRuntimeError, get_name(100).run, c)
+class TestAsyncConnection(TestWithConnection):
+    def setUp(self):
+        if trollius is None:
+            self.skipTest("trollius is not installed")
+        TestWithConnection.setUp(self)
+        self.loop = trollius.new_event_loop()
+
+    def tearDown(self):
+        if trollius is not None:
+            self.loop.close()
+            TestWithConnection.tearDown(self)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(trollius.coroutine(coroutine)())
+
+    def connect(self):
+        return net_asyncio.connect(port=self.port, loop=self.loop)
+
+    def test_run(self):
+        def run():
+            c = yield From(self.connect())
+            res = yield From(trollius.gather(*[r.expr(i).run(c) for i in xrange(0, 10)], loop=self.loop))
+            self.assertEqual(res, range(0, 10))
+            try:
+                yield From(r.error('fail').run(c))
+                self.fail("Expected the query to fail")
+            except RqlRuntimeError as err:
+                self.assertEqual(err.message, 'fail')
+            raise Return(c)
+        c = self.run_async(run)
+
+        # Queries on one connection already run concurrently
+        self.assertRaisesRegexp(r.RqlDriverError, "AsyncConnection does not need pipelining",
+                                c.pipeline, [r.expr(1)])
+
+    def test_cursor(self):
+        if server_build_dir.find('debug') != -1:
+            batch_size = 5
+        else:
+            batch_size = 1000
+
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, batch_size * 3)]).run(c)
+
+        def fetch_all():
+            c = yield From(self.connect())
+            cursor = yield From(r.table('t1').run(c))
+            self.assertRaisesRegexp(r.RqlDriverError, "Cannot iterate over an AsyncCursor.", iter, cursor)
+            ids = [ ]
+            while (yield From(cursor.fetch_next())):
+                ids.append(cursor.next()['id'])
+            self.assertFalse((yield From(cursor.fetch_next())))
+            self.assertRaisesRegexp(r.RqlDriverError, "No row available, call `fetch_next` first.",
+                                    cursor.next)
+            raise Return(ids)
+        self.assertEqual(sorted(self.run_async(fetch_all)), range(0, batch_size * 3))
+
+        def close_early():
+            c = yield From(self.connect())
+            cursor = yield From(r.table('t1').run(c))
+            self.assertTrue((yield From(cursor.fetch_next())))
+            cursor.next()
+            yield From(cursor.close())
+            self.assertTrue(cursor.end_flag)
+            self.assertEqual(c.cursor_cache, { })
+
+            # The connection is still usable once the cursor is closed
+            res = yield From(r.expr(1).run(c))
+            raise Return(res)
+        self.assertEqual(self.run_async(close_early), 1)
+
+    def test_noreply_wait_waits(self):
+        def run():
+            c = yield From(self.connect())
+            t = time()
+            yield From(r.js('while(true);', timeout=0.5).run(c, noreply=True))
+            yield From(c.noreply_wait())
+            raise Return(time() - t)
+        self.assertGreaterEqual(self.run_async(run), 0.5)
+
+    def test_close(self):
+        def run():
+            c = yield From(self.connect())
+            t = time()
+            yield From(r.js('while(true);', timeout=0.5).run(c, noreply=True))
+            yield From(c.close())
+            duration = time() - t
+            try:
+                yield From(r.expr(1).run(c))
+                self.fail("Expected the connection to be closed")
+            except RqlDriverError as err:
+                self.assertEqual(str(err), "Connection is closed.")
+            raise Return(duration)
+        self.assertGreaterEqual(self.run_async(run), 0.5)
+
+        def close_now():
+            c = yield From(self.connect())
+            t = time()
+            yield From(r.js('while(true);', timeout=0.5).run(c, noreply=True))
+            yield From(c.close(noreply_wait=False))
+            raise Return(time() - t)
+        self.assertLess(self.run_async(close_now), 0.5)
+
+
+class TestBulkInsert(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        r.db('test').table_create('bulk').run(c)
+        t = r.table('bulk')
+
+        res = t.bulk_insert(({'id':i, 'value':'x' * (i % 100)} for i in xrange(0, 5000)),
+                            c, batch_rows=300, batch_bytes=10000, concurrency=3)
+        self.assertEqual(res['inserted'], 5000)
+        self.assertEqual(res['errors'], 0)
+        self.assertEqual(t.count().run(c), 5000)
+
+        # Rows that aren't plain JSON, failed rows and generated keys
+        time1 = r.epoch_time(1375115782.24).in_timezone('+00:00')
+        res = t.bulk_insert([{'id':0}, {'id':5000, 'time':time1}, {'value':1}], c, batch_rows=2)
+        self.assertEqual(res['inserted'], 2)
+        self.assertEqual(res['errors'], 1)
+        self.assertIn('first_error', res)
+        self.assertEqual(len(res['generated_keys']), 1)
+        self.assertEqual(t.get(5000)['time'].run(c), time1.run(c))
+
+        pool = r.ConnectionPool([('localhost', self.port)], max_size=2)
+        res = t.bulk_insert([{'id':i} for i in xrange(6000, 7000)], pool, batch_rows=100, upsert=True)
+        self.assertEqual(res['inserted'], 1000)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        pool.close()
+
+class TestObserver(TestWithConnection):
+    def runTest(self):
+        observer = r.HistogramObserver()
+        c = r.connect(port=self.port, observer=observer)
+
+        r.db('test').table_create('observed').run(c)
+        t = r.table('observed')
+        t.insert([{'id':i} for i in xrange(0, 3000)]).run(c)
+        for i in xrange(0, 10):
+            t.get(i).run(c)
+        self.assertEqual(len(list(t.run(c))), 3000)
+        self.assertRaises(r.RqlRuntimeError, r.error('fail').run, c)
+
+        stats = observer.snapshot()
+        self.assertEqual(stats['Get']['queries'], 10)
+        self.assertEqual(stats['Get']['latency']['count'], 10)
+        self.assertEqual(stats['Get']['rows'], 10)
+        self.assertEqual(stats['Table']['rows'], 3000)
+        self.assertGreater(stats['Table']['received_bytes'], 0)
+        self.assertGreater(stats['Insert']['sent_bytes'], 0)
+        self.assertEqual(stats['UserError']['errors'], 1)
+        for term_type in stats:
+            self.assertEqual(stats[term_type]['in_flight'], 0)
+            self.assertLessEqual(stats[term_type]['latency']['p50'], stats[term_type]['latency']['max'])
+
+class TestLazy(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        time1 = r.epoch_time(1375115782.24).in_timezone('+00:00')
+        docs = [{'id':i, 'name':'user%d' % i, 'tags':['a', 'b'], 'nested':{'n':i}} for i in xrange(0, 100)]
+        r.db('test').table_create('lazy').run(c)
+        r.table('lazy').insert(docs).run(c)
+        r.table('lazy').get(0).update({'time':time1}).run(c)
+
+        rows = r.table('lazy').order_by('id').coerce_to('array').run(c, lazy=True)
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[5]['name'], 'user5')
+        self.assertEqual(rows[5]['nested']['n'], 5)
+        self.assertEqual(list(rows[5]['tags']), ['a', 'b'])
+        self.assertEqual(rows[0]['time'], time1.run(c))
+        self.assertEqual(rows.pluck('id')[:2], [{'id':0}, {'id':1}])
+        self.assertEqual(rows[1:].to_list(), docs[1:])
+
+        cursor = r.table('lazy').run(c, lazy=True)
+        self.assertEqual(sorted(row['id'] for row in cursor), range(0, 100))
+
+class TestColumnar(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        docs = [{'id':i, 'price':i * 0.5, 'size':i, 'side':'buy' if i % 2 else 'sell'} for i in xrange(0, 100)]
+        docs[3]['when'] = r.epoch_time(1375115782.5)
+        del docs[4]['size']
+        r.db('test').table_create('columnar').run(c)
+        r.table('columnar').insert(docs).run(c)
+
+        cursor = r.table('columnar').order_by(index='id').run(c, result_format='columnar',
+                                                              columns=['id', 'size', 'side', 'when'])
+        columns = cursor.to_columns()
+        self.assertEqual(columns.count, 100)
+        self.assertEqual(list(columns), ['id', 'size', 'side', 'when'])
+        self.assertEqual(list(columns['id']), range(0, 100))
+        self.assertEqual(list(columns['side'][:2]), ['sell', 'buy'])
+        self.assertEqual(columns['when'][3], 1375115782.5)
+        self.assertEqual(sum(columns.mask('when')), 99)
+        self.assertTrue(columns.mask('size')[4])
+
+        columns = r.table('columnar').coerce_to('array').run(c, result_format='columnar')
+        self.assertEqual(sorted(columns['price']), [i * 0.5 for i in xrange(0, 100)])
+
+        self.assertRaisesRegexp(r.RqlDriverError, "Unknown result_format run option \"rows\".",
+                                r.expr(1).run, c, result_format='rows')
+
+class TestTimeFormat(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        times = r.expr([r.epoch_time(1375115782.24 + i).in_timezone('-07:00') for i in xrange(0, 3)])
+        native = times.run(c)
+        self.assertEqual(native[0].isoformat(), '2013-07-29T09:36:22.240000-07:00')
+        self.assertTrue(native[0].tzinfo is native[2].tzinfo)
+        self.assertEqual(times.run(c, time_format='epoch'), [1375115782.24, 1375115783.24, 1375115784.24])
+        self.assertEqual(times.run(c, time_format='raw')[0]['timezone'], '-07:00')
+
+        r.db('test').table_create('times').run(c)
+        r.table('times').insert([{'id':i, 'time':r.epoch_time(i)} for i in xrange(0, 200)]).run(c)
+        self.assertEqual(sorted(row['time'] for row in r.table('times').run(c, time_format='epoch')),
+                         range(0, 200))
+
+class TestGroupFormat(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port)
+
+        rows = r.expr([{'k':'a', 'v':1}, {'k':'b', 'v':2}, {'k':'a', 'v':3}, {'k':[1, 2], 'v':4}])
+        grouped = rows.group('k').sum('v')
+        self.assertEqual(grouped.run(c), {'a':4, 'b':2, (1, 2):4})
+        self.assertEqual(grouped.run(c, group_format='pairs'), [([1, 2], 4), ('a', 4), ('b', 2)])
+        self.assertRaisesRegexp(r.RqlDriverError, "Unknown group_format run option \"iter\".",
+                                grouped.run, c, group_format='iter')
 
 if __name__ == '__main__':
     print "Running py connection tests"
     suite = unittest.TestSuite()
     loader = unittest.TestLoader()
     suite.addTest(loader.loadTestsFromTestCase(TestNoConnection))
+    # Expects the first variable ids, so runs before the tests that build lambdas
+    suite.addTest(TestPrinting())
+    suite.addTest(loader.loadTestsFromTestCase(TestSerialization))
+    suite.addTest(loader.loadTestsFromTestCase(TestCodec))
+    suite.addTest(TestFrameReader())
+    suite.addTest(loader.loadTestsFromTestCase(TestQueryPrinter))
+    suite.addTest(loader.loadTestsFromTestCase(TestFuncCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestColumnBuilder))
+    suite.addTest(TestRowBatcher())
     suite.addTest(loader.loadTestsFromTestCase(TestConnectionDefaultPort))
     suite.addTest(loader.loadTestsFromTestCase(TestTimeout))
     suite.addTest(loader.loadTestsFromTestCase(TestAuthConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestConnection))
+    suite.addTest(loader.loadTestsFromTestCase(TestPipelining))
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionPool))
     suite.addTest(loader.loadTestsFromTestCase(TestShutdown))
-    suite.addTest(TestPrinting())
     suite.addTest(TestBatching())
+    suite.addTest(TestPrefetch())
     suite.addTest(TestGroupWithTimeKey())
+    suite.addTest(TestJsonLoads())
+    suite.addTest(TestPrepare())
+    suite.addTest(TestBulkInsert())
+    suite.addTest(TestObserver())
+    suite.addTest(TestLazy())
+    suite.addTest(TestColumnar())
+    suite.addTest(TestTimeFormat())
+    suite.addTest(TestGroupFormat())
+    suite.addTest(loader.loadTestsFromTestCase(TestAsyncConnection))
 
     res = unittest.TextTestRunner(verbosity=2).run(suite)
 
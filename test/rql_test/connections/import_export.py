@@ -0,0 +1,633 @@
+###
+# Tests the file handling of `rethinkdb import` and `rethinkdb export`, none of
+# which needs a server
+###
+
+import os
+import sys
+import csv
+import json
+import Queue
+import ctypes
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import multiprocessing.queues
+import unittest
+from sys import path, exit
+path.insert(0, "../../drivers/python")
+
+from rethinkdb import _import, _export
+
+# Runs one of the import readers on a file, with the batches it puts on the task
+# queue taken off by a thread, as the clients would. Returns the tasks, the
+# messages for the checkpoint and the progress values.
+def run_reader(read, filename, done=None):
+    exit_event = multiprocessing.Event()
+    task_queue = _import.TaskQueue(100000, exit_event)
+    acks = _import.ParsedBatches()
+    checkpoint = _import.FileCheckpoint(filename, acks, done or { })
+    progress_info = tuple(multiprocessing.Value(ctypes.c_longlong, 0) for i in xrange(3))
+
+    tasks = [ ]
+    def collect():
+        while True:
+            task = task_queue.get()
+            if task == "exit":
+                break
+            tasks.append(task)
+    collector = threading.Thread(target=collect)
+    collector.start()
+    try:
+        read(task_queue, checkpoint, progress_info, exit_event)
+    finally:
+        task_queue.put("exit")
+        collector.join()
+    return (tasks, acks, [value.value for value in progress_info])
+
+def task_rows(tasks):
+    return [json.loads(row) for task in tasks for row in task[2]]
+
+# Runs one of the export writers on the given rows, raising any error it hit
+def write_rows(writer, filename, fields, rows):
+    task_queue = Queue.Queue()
+    error_queue = Queue.Queue()
+    for row in rows:
+        task_queue.put([row])
+    task_queue.put(("exit", "event"))
+    writer(filename, fields, task_queue, error_queue)
+    if not error_queue.empty():
+        raise error_queue.get()[1]
+
+class ImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunk_size = _import.parse_chunk_size
+
+    def tearDown(self):
+        _import.parse_chunk_size = self.chunk_size
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as out:
+            out.write(data)
+        return filename
+
+    # Each unit the reader finished was read as the number of batches it says
+    def assertUnitsMatch(self, tasks, acks):
+        for message in acks:
+            self.assertEqual(message[0], "unit")
+            self.assertEqual(len([task for task in tasks if task[3][1] == message[2]]), message[3])
+        self.assertEqual(sorted(set(task[3][1] for task in tasks)),
+                         sorted(set(message[2] for message in acks if message[3] > 0)))
+
+class TestJsonImport(ImportTestCase):
+    # Strings full of the characters the chunk scanner looks for
+    def tricky_rows(self):
+        rows = [ ]
+        for i in xrange(0, 300):
+            rows.append({'id':i,
+                         'quotes':'a"b\\"c\\' * (i % 3),
+                         'brackets':'[{,}]"],[' if i % 2 else '}',
+                         'nested':[i, {'x':[",", "]", {}]}, [[[]]]],
+                         'text':u'\u00e9\n\t' * (i % 4)})
+        return rows
+
+    def tricky_json(self, rows):
+        pieces = [ ]
+        for (i, row) in enumerate(rows):
+            if i % 2:
+                pieces.append(json.dumps(row, ensure_ascii=False).encode('utf-8'))
+            else:
+                pieces.append(json.dumps(row, indent=i % 3))
+        return " \n[" + ",\n  ".join(pieces) + "\n ] \n"
+
+    def read_json(self, filename, parsers=2):
+        read = lambda task_queue, checkpoint, progress_info, exit_event: \
+            _import.json_reader(task_queue, filename, 'db', 'table', 'id', None, parsers,
+                                checkpoint, progress_info, exit_event)
+        return run_reader(read, filename)
+
+    def test_chunks_match_serial(self):
+        rows = self.tricky_rows()
+        filename = self.write_file("rows.json", self.tricky_json(rows))
+
+        _import.parse_chunk_size = 1024 * 1024 * 1024
+        (tasks, acks, progress) = self.read_json(filename)
+        serial = task_rows(tasks)
+        self.assertEqual(serial, json.load(open(filename)))
+        self.assertEqual(progress[2], len(rows))
+
+        # Chunk boundaries fall inside strings, escapes and nested values
+        for chunk_size in [5, 61, 1000]:
+            _import.parse_chunk_size = chunk_size
+            (tasks, acks, progress) = self.read_json(filename)
+            self.assertEqual(sorted(task_rows(tasks), key=lambda row: row['id']), serial)
+            self.assertEqual(progress[2], len(rows))
+            self.assertUnitsMatch(tasks, acks)
+
+    def test_empty_and_single(self):
+        _import.parse_chunk_size = 5
+        (tasks, acks, progress) = self.read_json(self.write_file("empty.json", "[ \n ]\n"))
+        self.assertEqual(tasks, [ ])
+        (tasks, acks, progress) = self.read_json(self.write_file("single.json", '{"id": "[,"}'))
+        self.assertEqual(task_rows(tasks), [{'id':'[,'}])
+
+    def test_bad_json(self):
+        _import.parse_chunk_size = 5
+        filename = self.write_file("extra.json", "[" + ",".join('{"id": %d}' % i for i in xrange(0, 20)) + "] x")
+        self.assertRaisesRegexp(RuntimeError, "extra characters found after end of data", self.read_json, filename)
+        filename = self.write_file("unclosed.json", "[" + ",".join('{"id": %d}' % i for i in xrange(0, 20)))
+        self.assertRaises((RuntimeError, ValueError), self.read_json, filename)
+
+    def test_find_separator(self):
+        data = '"a,\\"b" , [1,2], {"c":","}, 3'
+        self.assertEqual(_import.find_json_separator(data, 0, len(data), False, 1), 8)
+        self.assertEqual(_import.find_json_separator(data, 9, len(data), False, 1), 15)
+        self.assertEqual(_import.find_json_separator('x\\",y", 5', 0, 9, True, 1), 6)
+        self.assertEqual(_import.find_json_separator('1] , 2', 0, 6, False, 1), None)
+        self.assertEqual(_import.find_json_separator('"a,b', 0, 4, False, 1), None)
+
+    def test_chunk_delta(self):
+        filename = self.write_file("delta.json", '{"a": "\\"[", "b": [1, {')
+        size = os.path.getsize(filename)
+        self.assertEqual(_import.json_chunk_delta(filename, 0, size), (False, 3, 1))
+
+        # Starting inside the string "\"[", the rest closes it and opens two values
+        self.assertEqual(_import.json_chunk_delta(filename, 9, size), (True, 1, 2))
+
+class TestCsvImport(ImportTestCase):
+    def options(self, **kwargs):
+        options = {"delimiter":",", "no_header":False, "custom_header":None, "column_types":None,
+                   "parsers":2, "fields":None}
+        options.update(kwargs)
+        return options
+
+    def read_csv(self, filename, options):
+        read = lambda task_queue, checkpoint, progress_info, exit_event: \
+            _import.csv_reader(task_queue, filename, 'db', 'table', 'id', options,
+                               checkpoint, progress_info, exit_event)
+        return run_reader(read, filename)
+
+    # The rows as the csv module reads them, one at a time
+    def serial_rows(self, filename):
+        reader = csv.reader(open(filename))
+        header = reader.next()
+        return [dict((name, value) for (name, value) in zip(header, row) if len(value) > 0)
+                for row in reader]
+
+    def write_csv(self, name, rows):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as out:
+            csv.writer(out).writerows(rows)
+        return filename
+
+    def assertMatchesSerial(self, filename, chunk_sizes):
+        serial = self.serial_rows(filename)
+        for chunk_size in chunk_sizes:
+            _import.parse_chunk_size = chunk_size
+            (tasks, acks, progress) = self.read_csv(filename, self.options())
+            self.assertEqual(sorted(task_rows(tasks), key=lambda row: int(row['id'])), serial)
+            self.assertEqual(progress[2], len(serial))
+            self.assertEqual(progress[0], os.path.getsize(filename))
+            self.assertUnitsMatch(tasks, acks)
+
+    def test_chunks_match_serial(self):
+        # Quoted delimiters, escaped quotes, newlines within fields and empty fields
+        rows = [["id", "a", "b"]]
+        for i in xrange(0, 300):
+            rows.append([str(i), 'x,"y"' * (i % 3), "line\n\n,\"" if i % 2 else ""])
+        filename = self.write_csv("rows.csv", rows)
+        self.assertMatchesSerial(filename, [1024 * 1024 * 1024, 7, 64, 500])
+
+    def test_unbalanced_quotes(self):
+        # A quote within an unquoted field throws off the quote count of later chunks,
+        #  the rest of the file is then read in one go
+        lines = ["id,a\n"] + ["%d,screen\n" % i for i in xrange(0, 100)]
+        lines[20] = '19,5" screen\n'
+        lines[40] = '39,"a\nb"\n'
+        filename = self.write_file("quotes.csv", "".join(lines))
+        self.assertMatchesSerial(filename, [16, 100])
+
+    def test_column_types(self):
+        filename = self.write_file("types.csv", 'id,n,f,b,j,s\n1,-2,1.5e3,TRUE,"{""a"": [1]}",007\n2,0,,false,null,x\n')
+        options = self.options(column_types={None:"auto", "f":"float", "b":"bool", "j":"json", "s":"string"})
+        (tasks, acks, progress) = self.read_csv(filename, options)
+        self.assertEqual(task_rows(tasks), [{'id':1, 'n':-2, 'f':1500.0, 'b':True, 'j':{'a':[1]}, 's':'007'},
+                                            {'id':2, 'n':0, 'b':False, 'j':None, 's':'x'}])
+
+        options = self.options(column_types={"n":"int"})
+        (tasks, acks, progress) = self.read_csv(filename, options)
+        self.assertEqual(task_rows(tasks)[0], {'id':'1', 'n':-2, 'f':'1.5e3', 'b':'TRUE', 'j':'{"a": [1]}', 's':'007'})
+
+        options = self.options(column_types={"b":"int"})
+        self.assertRaisesRegexp(RuntimeError, "line 2 has an invalid value for field 'b': TRUE",
+                                self.read_csv, filename, options)
+        options = self.options(column_types={"c":"int"})
+        self.assertRaisesRegexp(RuntimeError, "Field 'c' given in --column-types is not a CSV field",
+                                self.read_csv, filename, options)
+
+    def test_converters(self):
+        self.assertEqual([_import.csv_auto(value) for value in ["12", "-0.5", "1e2", "01", "-", "true", "True"]],
+                         [12, -0.5, 100.0, "01", "-", True, "True"])
+        self.assertEqual([_import.csv_number(value) for value in ["12", "1.0"]], [12, 1.0])
+        self.assertRaises(ValueError, _import.csv_number, "01")
+        self.assertRaisesRegexp(RuntimeError, "offset 40 has an inconsistent number of columns",
+                                _import.csv_row_object, ["a", "b"], [None, None], ["1"], "f.csv", None, 40)
+
+    def test_parse_column_types(self):
+        filename = self.write_file("types.csv", "id\n1\n")
+        argv = sys.argv
+        try:
+            sys.argv = ["import", "-f", filename, "--table", "db.table",
+                        "--column-types", "auto,a:b:int,c:json"]
+            self.assertEqual(_import.parse_options()["column_types"], {None:"auto", "a:b":"int", "c":"json"})
+            sys.argv[-1] = "a:integer"
+            self.assertRaisesRegexp(RuntimeError, "Unknown column type 'integer'", _import.parse_options)
+            sys.argv[2] = os.path.join(self.directory, "types.json")
+            self.write_file("types.json", "[ ]")
+            sys.argv[-1] = "auto"
+            self.assertRaisesRegexp(RuntimeError, "only valid for CSV file formats", _import.parse_options)
+        finally:
+            sys.argv = argv
+
+class TestJsonlImport(ImportTestCase):
+    def read_jsonl(self, filename, parsers, fields=None):
+        read = lambda task_queue, checkpoint, progress_info, exit_event: \
+            _import.jsonl_reader(task_queue, filename, 'db', 'table', 'id', fields, parsers,
+                                 checkpoint, progress_info, exit_event)
+        return run_reader(read, filename)
+
+    def test_round_trip(self):
+        rows = [{'id':i, 'a':{'b':[i, "\n"]}, 'c':u'\u00e9' * (i % 3)} for i in xrange(0, 200)]
+        filename = os.path.join(self.directory, "rows.jsonl")
+        write_rows(_export.jsonl_writer, filename, None, [dict(row) for row in rows])
+        self.assertEqual([json.loads(line) for line in open(filename)], rows)
+
+        for (parsers, chunk_size) in [(1, 50), (2, 50), (2, 1000), (2, 1024 * 1024)]:
+            _import.parse_chunk_size = chunk_size
+            (tasks, acks, progress) = self.read_jsonl(filename, parsers)
+            self.assertEqual(sorted(task_rows(tasks), key=lambda row: row['id']), rows)
+            self.assertEqual(progress, [os.path.getsize(filename)] * 2 + [len(rows)])
+            self.assertUnitsMatch(tasks, acks)
+
+    def test_blank_lines(self):
+        filename = self.write_file("blank.jsonl", '\n{"id": 1}\n  \n\r\n{"id": 2,\t"a": 3}  \n\n{"id": 3}')
+        _import.parse_chunk_size = 4
+        for parsers in [1, 2]:
+            (tasks, acks, progress) = self.read_jsonl(filename, parsers)
+            self.assertEqual(sorted(task_rows(tasks), key=lambda row: row['id']), [{'id':1}, {'id':2, 'a':3}, {'id':3}])
+            (tasks, acks, progress) = self.read_jsonl(filename, parsers, fields=['a'])
+            self.assertEqual(sorted(task_rows(tasks), key=len), [{ }, { }, {'a':3}])
+        (tasks, acks, progress) = self.read_jsonl(self.write_file("empty.jsonl", ""), 2)
+        self.assertEqual((tasks, acks, progress), ([ ], [ ], [0, 0, 0]))
+
+    def test_invalid_line(self):
+        filename = self.write_file("invalid.jsonl", "".join('{"id": %d}\n' % i for i in xrange(0, 50)) + '{"id": 50\n')
+        _import.parse_chunk_size = 20
+        for parsers in [1, 2]:
+            self.assertRaisesRegexp(RuntimeError, "has invalid JSON at offset 540",
+                                    self.read_jsonl, filename, parsers)
+        filename = self.write_file("array.jsonl", '{"id": 1}\n[{"id": 2}]\n')
+        self.assertRaisesRegexp(RuntimeError, "expected an object", self.read_jsonl, filename, 1)
+
+    def test_writer_fields(self):
+        filename = os.path.join(self.directory, "fields.jsonl")
+        write_rows(_export.jsonl_writer, filename, ['id', 'b'], [{'id':1, 'a':2, 'b':3}, {'a':4}])
+        self.assertEqual(open(filename).read(), '{"b": 3, "id": 1}\n{}\n')
+
+class TestCheckpoint(ImportTestCase):
+    def readers(self):
+        rows = [{'id':i, 'a':'x' * (i % 7)} for i in xrange(0, 200)]
+        json_file = self.write_file("rows.json", json.dumps(rows, indent=1))
+        jsonl_file = self.write_file("rows.jsonl", "".join(json.dumps(row) + "\n" for row in rows))
+        csv_file = self.write_file("rows.csv", "id,a\n" + "".join("%d,%s\n" % (row['id'], row['a']) for row in rows))
+        options = {"delimiter":",", "no_header":False, "custom_header":None, "column_types":{"id":"int"},
+                   "parsers":2, "fields":None}
+        return [(json_file, lambda task_queue, checkpoint, progress_info, exit_event:
+                    _import.json_reader(task_queue, json_file, 'db', 'table', 'id', None, 2,
+                                        checkpoint, progress_info, exit_event)),
+                (jsonl_file, lambda task_queue, checkpoint, progress_info, exit_event:
+                    _import.jsonl_reader(task_queue, jsonl_file, 'db', 'table', 'id', None, 2,
+                                         checkpoint, progress_info, exit_event)),
+                (csv_file, lambda task_queue, checkpoint, progress_info, exit_event:
+                    _import.csv_reader(task_queue, csv_file, 'db', 'table', 'id', options,
+                                       checkpoint, progress_info, exit_event))]
+
+    def test_resume(self):
+        # Units of several batches each
+        _import.parse_chunk_size = 256
+        rows = _import.batch_size.rows.value
+        _import.batch_size.rows.value = 5
+        try:
+            self.check_resume()
+        finally:
+            _import.batch_size.rows.value = rows
+
+    def check_resume(self):
+        path = os.path.join(self.directory, "import.checkpoint")
+        for (filename, read) in self.readers():
+            checkpoint = _import.ImportCheckpoint(path, _import.parse_chunk_size, { })
+            checkpoint.add_file(filename)
+            (tasks, acks, progress) = run_reader(read, filename)
+            all_rows = sorted(task_rows(tasks), key=lambda row: row['id'])
+            self.assertEqual(len(all_rows), 200)
+
+            # The import stops with the first units in, and a batch of a later one
+            units = sorted(set(task[3][1] for task in tasks))
+            self.assertTrue(len(units) > 4)
+            acked = [task for task in tasks if task[3][1] < units[3]]
+            self.assertTrue(len([task for task in tasks if task[3][1] == units[3]]) > 1)
+            acked.append([task for task in tasks if task[3][1] == units[3]][0])
+            for message in acks:
+                checkpoint.handle(message)
+            for task in acked:
+                checkpoint.handle(("acked",) + task[3])
+            checkpoint.handle(("file", filename))
+            checkpoint.save()
+
+            saved = json.load(open(path))
+            self.assertEqual(saved["chunk_size"], 256)
+            self.assertFalse(saved["files"][filename]["complete"])
+            checkpoint = _import.ImportCheckpoint.load(path)
+            done = checkpoint.files[filename]["done"]
+            self.assertEqual(sorted(unit for unit in done if done[unit] is not None), units[:3])
+            self.assertTrue(units[3] not in done)
+            self.assertEqual(saved["files"][filename]["committed_offset"], done[units[2]])
+
+            # Resuming reads everything but the units that are in
+            (tasks, acks, progress) = run_reader(read, filename, done)
+            self.assertTrue(all(task[3][1] not in done for task in tasks))
+            self.assertEqual(sorted(task_rows(acked[:-1]) + task_rows(tasks), key=lambda row: row['id']), all_rows)
+
+            for message in acks:
+                checkpoint.handle(message)
+            for task in tasks:
+                checkpoint.handle(("acked",) + task[3])
+            checkpoint.handle(("file", filename))
+            self.assertTrue(checkpoint.files[filename]["complete"])
+            checkpoint.save()
+            self.assertEqual(json.load(open(path))["files"][filename]["committed_offset"], os.path.getsize(filename))
+            checkpoint.remove()
+            self.assertFalse(os.path.exists(path))
+
+    def test_changed_file(self):
+        filename = self.write_file("rows.json", "[ ]")
+        path = os.path.join(self.directory, "import.checkpoint")
+        checkpoint = _import.ImportCheckpoint(path, 100, { })
+        checkpoint.add_file(filename)
+        checkpoint.save()
+        _import.ImportCheckpoint.load(path).add_file(filename)
+        self.write_file("rows.json", '[{"id": 1}]')
+        self.assertRaisesRegexp(RuntimeError, "has changed since the import was checkpointed",
+                                _import.ImportCheckpoint.load(path).add_file, filename)
+        self.write_file("import.checkpoint", '{"chunk_size"')
+        self.assertRaisesRegexp(RuntimeError, "Could not read the checkpoint", _import.ImportCheckpoint.load, path)
+
+    def test_open_checkpoint(self):
+        files_info = [{"file":self.write_file("rows.json", "[ ]")}]
+        path = os.path.join(self.directory, "import.checkpoint")
+        options = {"checkpoint":path, "resume":True, "force":True}
+        self.assertRaisesRegexp(RuntimeError, "No checkpoint to resume from", _import.open_checkpoint, options, files_info)
+
+        _import.parse_chunk_size = 1000
+        options["resume"] = False
+        _import.open_checkpoint(options, files_info)
+        self.assertEqual(json.load(open(path))["chunk_size"], 1000)
+        options["force"] = False
+        self.assertRaisesRegexp(RuntimeError, "run with --resume", _import.open_checkpoint, options, files_info)
+
+        # The chunks are the ones the checkpoint was made with
+        _import.parse_chunk_size = 50
+        options["resume"] = True
+        checkpoint = _import.open_checkpoint(options, files_info)
+        self.assertEqual(_import.parse_chunk_size, 1000)
+        self.assertEqual(checkpoint.files.keys(), [files_info[0]["file"]])
+
+    def test_unwritable(self):
+        checkpoint = _import.ImportCheckpoint(os.path.join(self.directory, "missing", "import.checkpoint"), 100, { })
+        checkpoint.add_file(self.write_file("rows.json", "[ ]"))
+        stderr = sys.stderr
+        try:
+            sys.stderr = open(os.devnull, "w")
+            checkpoint.save()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(checkpoint.failed)
+
+def put_tasks(task_queue, count):
+    for i in xrange(0, count):
+        task_queue.put(('db', 'table', ['{}'], ('file', i)))
+
+class TestImportQueue(unittest.TestCase):
+    def test_batch_size(self):
+        batch_size = _import.BatchSize(200)
+        batch_size.adjust(200, 10.0)
+        self.assertEqual(batch_size.rows.value, 152)
+
+        # Batches cut short don't count
+        batch_size.adjust(75, 0.0)
+        self.assertEqual(batch_size.rows.value, 152)
+        batch_size.adjust(76, 0.0)
+        self.assertTrue(batch_size.rows.value > 152)
+
+        for i in xrange(0, 50):
+            batch_size.adjust(batch_size.rows.value, 0.0)
+        self.assertEqual(batch_size.rows.value, _import.max_batch_rows)
+        for i in xrange(0, 50):
+            batch_size.adjust(batch_size.rows.value, 60.0)
+        self.assertEqual(batch_size.rows.value, _import.min_batch_rows)
+
+        # Batches within the latency target converge on the rows that take it
+        for i in xrange(0, 50):
+            rows = batch_size.rows.value
+            batch_size.adjust(rows, rows * 0.001)
+        self.assertTrue(abs(batch_size.rows.value - 500) < 5)
+
+    def test_batcher_size(self):
+        rows = _import.batch_size.rows.value
+        try:
+            _import.batch_size.rows.value = 3
+            batcher = _import.ImportBatcher()
+            _import.batch_size.rows.value = 2
+            # The new size is taken up once the batch in progress is done
+            self.assertEqual([batcher.add({'id':i}) for i in xrange(0, 5)],
+                             [None, None, ['{"id": 0}', '{"id": 1}', '{"id": 2}'], None, ['{"id": 3}', '{"id": 4}']])
+        finally:
+            _import.batch_size.rows.value = rows
+
+    def test_depth(self):
+        task_queue = _import.TaskQueue(10, multiprocessing.Event())
+        tasks = [ ]
+        def collect():
+            for i in xrange(0, 2000):
+                tasks.append(task_queue.get())
+        collector = threading.Thread(target=collect)
+        collector.start()
+        readers = [multiprocessing.Process(target=put_tasks, args=(task_queue, 500)) for i in xrange(0, 4)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        collector.join()
+        self.assertEqual(len(tasks), 2000)
+        self.assertEqual(task_queue.depth.value, 0)
+
+    def test_bounded(self):
+        exit_event = multiprocessing.Event()
+        task_queue = _import.TaskQueue(2, exit_event)
+        put_tasks(task_queue, 2)
+        self.assertEqual(task_queue.depth.value, 2)
+
+        # A full queue holds readers up until the import stops, then drops their batches
+        timer = threading.Timer(0.3, exit_event.set)
+        timer.start()
+        put_tasks(task_queue, 1)
+        timer.join()
+        task_queue.put("exit")
+        self.assertEqual(task_queue.depth.value, 2)
+        self.assertEqual([task_queue.get()[3] for i in xrange(0, 2)], [('file', 0), ('file', 1)])
+        self.assertEqual(task_queue.get(), "exit")
+        self.assertTrue(task_queue.empty())
+        self.assertEqual(task_queue.depth.value, 0)
+
+# Answers each query with the given rows, as a list or in batches from a cursor
+class FakeConnection(object):
+    def __init__(self, rows, batch_rows=None):
+        self.rows = rows
+        self.batch_rows = batch_rows
+        self.queries = [ ]
+
+    def _start(self, term, **global_opt_args):
+        self.queries.append((str(term), global_opt_args))
+        if self.batch_rows is None:
+            return list(self.rows)
+        return FakeCursor([self.rows[i:i + self.batch_rows] for i in xrange(0, len(self.rows), self.batch_rows)])
+
+class FakeCursor(object):
+    def __init__(self, batches):
+        self.batches = batches
+
+    def next_batch(self):
+        if len(self.batches) == 0:
+            return None
+        return self.batches.pop(0)
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rows(self):
+        return [{'id':i, 'a':'x,"y"\n' * (i % 3), 'b':[i]} for i in xrange(0, 30)]
+
+    def test_join_parts(self):
+        writers = {"json":_export.json_writer, "jsonl":_export.jsonl_writer, "csv":_export.csv_writer}
+        for format in ["json", "jsonl", "csv"]:
+            for sizes in [[0, 10, 0, 20, 0], [30], [10, 20], [0, 0]]:
+                rows = self.rows()[:sum(sizes)]
+                filename = os.path.join(self.directory, "single." + format)
+                write_rows(writers[format], filename, ['id', 'a', 'b'], [dict(row) for row in rows])
+
+                part_filenames = [ ]
+                for (i, size) in enumerate(sizes):
+                    part_filenames.append(_export.table_filename(self.directory, "db", "table", format, i))
+                    if i == 0:
+                        os.mkdir(os.path.dirname(part_filenames[0]))
+                    part_rows = rows[sum(sizes[:i]):sum(sizes[:i + 1])]
+                    write_rows(writers[format], part_filenames[-1], ['id', 'a', 'b'], part_rows)
+                joined = _export.table_filename(self.directory, "db", "table", format)
+                _export.join_parts(format, part_filenames, joined)
+
+                self.assertEqual(open(joined).read(), open(filename).read())
+                self.assertEqual(os.listdir(os.path.dirname(joined)), ["table." + format])
+                shutil.rmtree(os.path.dirname(joined))
+
+    def test_table_filename(self):
+        self.assertEqual(_export.table_filename("out", "db", "table", "json"), "out/db/table.json")
+        self.assertEqual(_export.table_filename("out", "db", "table", "csv", 3), "out/db/table.3.csv")
+
+    def test_sample_split_keys(self):
+        conn = FakeConnection([{'id':i} for i in xrange(0, 64)])
+        self.assertEqual(_export.sample_split_keys(conn, 'db', 'table', 'id', 4), [16, 32, 48])
+        self.assertEqual(conn.queries[0][1], {'time_format':'raw'})
+        self.assertTrue("sample(64)" in conn.queries[0][0])
+
+        # Ranges would be empty between keys that are the same
+        conn = FakeConnection([{'id':'a'}] * 5 + [{'id':'b'}] * 3)
+        self.assertEqual(_export.sample_split_keys(conn, 'db', 'table', 'id', 4), ['a', 'b'])
+        conn = FakeConnection([ ])
+        self.assertEqual(_export.sample_split_keys(conn, 'db', 'table', 'id', 4), [ ])
+
+    def test_export_rows(self):
+        rows = self.rows()
+        conn = FakeConnection(rows, 7)
+        filename = os.path.join(self.directory, "rows.jsonl")
+        error_queue = multiprocessing.queues.SimpleQueue()
+        progress_info = (multiprocessing.Value(ctypes.c_longlong, 0),)
+        _export.export_rows(conn, 'db', 'table', (10, None), filename, None, "jsonl", error_queue,
+                            progress_info, multiprocessing.Event())
+        self.assertTrue(error_queue.empty())
+        self.assertEqual([json.loads(line) for line in open(filename)], rows)
+        self.assertEqual(progress_info[0].value, len(rows))
+        self.assertTrue("between(10, None)" in conn.queries[0][0])
+
+class TestImportBatches(unittest.TestCase):
+    def callback(self, obj, fields=None, text=None, exit_event=None):
+        if exit_event is None:
+            exit_event = multiprocessing.Event()
+        return _import.object_callback(obj, 'db', 'table', self.tasks, self.batcher, fields,
+                                       exit_event, text)
+
+    def setUp(self):
+        self.tasks = _import.ParsedBatches()
+        self.batcher = _import.RowBatcher(2, 1000, _import.encode_row)
+
+    def test_encode_row(self):
+        self.assertEqual(_import.encode_row('{"id": 1}'), '{"id": 1}')
+        self.assertEqual(json.loads(_import.encode_row({'id':1, 'a':[u'\u00e9']})),
+                         {'id':1, 'a':[u'\u00e9']})
+
+    def test_text_passed_through(self):
+        # The text is sent as it was in the file, whatever the object holds
+        self.callback({'id':1}, text='{"id":  1}')
+        self.callback({'id':2}, text='{"id":\n2}')
+        self.assertEqual(self.tasks, [('db', 'table', ['{"id":  1}', '{"id":\n2}'])])
+
+    def test_fields_reencoded(self):
+        obj = self.callback({'id':1, 'a':2, 'b':3}, fields=['id', 'b'], text='{"id":1,"a":2,"b":3}')
+        self.assertEqual(obj, {'id':1, 'b':3})
+        self.callback({'id':2}, fields=['id', 'b'])
+        self.assertEqual(self.tasks[0][:2], ('db', 'table'))
+        self.assertEqual(json.loads("[" + ",".join(self.tasks[0][2]) + "]"), [{'id':1, 'b':3}, {'id':2}])
+
+    def test_invalid_object(self):
+        self.assertRaisesRegexp(RuntimeError, "expected an object", self.callback, [1, 2])
+
+    def test_interrupted(self):
+        exit_event = multiprocessing.Event()
+        exit_event.set()
+        self.callback({'id':1}, exit_event=exit_event)
+        self.assertRaises(_import.InterruptedError, self.callback, {'id':2}, exit_event=exit_event)
+        self.assertEqual(self.tasks, [ ])
+
+if __name__ == '__main__':
+    print "Running py import and export tests"
+    suite = unittest.TestSuite()
+    loader = unittest.TestLoader()
+    suite.addTest(loader.loadTestsFromTestCase(TestJsonImport))
+    suite.addTest(loader.loadTestsFromTestCase(TestImportBatches))
+    suite.addTest(loader.loadTestsFromTestCase(TestCsvImport))
+    suite.addTest(loader.loadTestsFromTestCase(TestJsonlImport))
+    suite.addTest(loader.loadTestsFromTestCase(TestCheckpoint))
+    suite.addTest(loader.loadTestsFromTestCase(TestImportQueue))
+    suite.addTest(loader.loadTestsFromTestCase(TestExport))
+
+    res = unittest.TextTestRunner(verbosity=2).run(suite)
+
+    if not res.wasSuccessful():
+        exit(1)